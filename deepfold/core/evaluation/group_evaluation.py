@@ -0,0 +1,253 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def annotation_stats(go, real_annots, pred_annots):
+    """Per-protein sufficient statistics of the CAFA protein-centric metrics.
+
+    The sums of these arrays over any subset of proteins give back exactly the
+    numbers computed by ``evaluate_annotations`` on that subset, so a single
+    pass over the predictions is enough to evaluate any grouping of proteins.
+
+    Returns:
+        dict with `tp`, `fp`, `fn` (term counts), `ru` and `mi` (summed IC of
+        false negatives / false positives), one entry per protein.
+    """
+    n = len(real_annots)
+    tp = np.zeros(n, dtype=np.float64)
+    fp = np.zeros(n, dtype=np.float64)
+    fn = np.zeros(n, dtype=np.float64)
+    ru = np.zeros(n, dtype=np.float64)
+    mi = np.zeros(n, dtype=np.float64)
+    for i in range(n):
+        if len(real_annots[i]) == 0:
+            continue
+        tp_set = set(real_annots[i]).intersection(set(pred_annots[i]))
+        fp_set = pred_annots[i] - tp_set
+        fn_set = real_annots[i] - tp_set
+        tp[i] = len(tp_set)
+        fp[i] = len(fp_set)
+        fn[i] = len(fn_set)
+        mi[i] = sum(go.get_ic(go_id) for go_id in fp_set)
+        ru[i] = sum(go.get_ic(go_id) for go_id in fn_set)
+    return {'tp': tp, 'fp': fp, 'fn': fn, 'ru': ru, 'mi': mi}
+
+
+def propagation_matrix(go, terms, go_set):
+    """Sparse matrix mapping predicted terms to the evaluated terms.
+
+    Entry (i, j) is set if ``go_set[j]`` is ``terms[i]`` or one of its
+    ancestors, so ``(pred_mat @ propagation) > 0`` propagates a binary
+    protein x term prediction matrix and filters it to `go_set` at once.
+    """
+    term_index = {t: j for j, t in enumerate(go_set)}
+    rows, cols = [], []
+    for i, t in enumerate(terms):
+        for go_id in go.get_anchestors(t):
+            j = term_index.get(go_id)
+            if j is not None:
+                rows.append(i)
+                cols.append(j)
+    return sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                         shape=(len(terms), len(go_set)))
+
+
+def label_matrix(annots, go_set):
+    """Binary protein x term csr matrix of annotation sets, columns follow
+    `go_set`."""
+    term_index = {t: j for j, t in enumerate(go_set)}
+    rows, cols = [], []
+    for i, terms in enumerate(annots):
+        for t in terms:
+            j = term_index.get(t)
+            if j is not None:
+                rows.append(i)
+                cols.append(j)
+    return sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                         shape=(len(annots), len(go_set)))
+
+
+def sparse_annotation_stats(pred_mat, label_mat, ic):
+    """Same as ``annotation_stats`` for binary protein x term matrices.
+
+    Args:
+        pred_mat: binary csr matrix of (propagated) predictions.
+        label_mat: binary csr matrix of true annotations, same columns.
+        ic: information content of every column.
+    """
+    tp_mat = pred_mat.multiply(label_mat)
+    tp = np.asarray(tp_mat.sum(axis=1)).ravel()
+    tp_ic = tp_mat @ ic
+    return {
+        'tp': tp,
+        'fp': np.asarray(pred_mat.sum(axis=1)).ravel() - tp,
+        'fn': np.asarray(label_mat.sum(axis=1)).ravel() - tp,
+        'ru': label_mat @ ic - tp_ic,
+        'mi': pred_mat @ ic - tp_ic
+    }
+
+
+def evaluate_score_matrix(scores,
+                          propagation,
+                          label_mat,
+                          ic,
+                          thresholds,
+                          groups=None):
+    """Protein-centric CAFA evaluation of a sparse protein x term score
+    matrix.
+
+    For every threshold the predictions are binarized, propagated and
+    filtered with one sparse product, no python loop over proteins.
+
+    Returns:
+        the filled ``GroupedEvaluator``.
+    """
+    scores = sp.csr_matrix(scores)
+    evaluator = GroupedEvaluator(thresholds, groups)
+    for t_idx, threshold in enumerate(thresholds):
+        passed = scores.copy()
+        passed.data = (passed.data >= threshold).astype(np.float64)
+        passed.eliminate_zeros()
+        pred_mat = (passed @ propagation).tocsr()
+        pred_mat.data[:] = 1
+        stats = sparse_annotation_stats(pred_mat, label_mat, ic)
+        evaluator.update_stats(t_idx, **stats)
+    return evaluator
+
+
+class GroupedEvaluator(object):
+    """Protein-centric Fmax, Smin and AUPR for many protein groups in one pass.
+
+    For every threshold the evaluator accumulates, per group, the number of
+    annotated proteins, the number of proteins with at least one prediction
+    and the sums of precision, recall, remaining uncertainty and
+    misinformation. These are the sufficient statistics of
+    ``evaluate_annotations``, so a breakdown over dozens of organisms costs
+    the same as a single evaluation of the whole test set.
+
+    Args:
+        thresholds: the prediction score thresholds that will be evaluated.
+        groups: one group key per protein (e.g. the `orgs` or `cafa_target`
+            column). If None, only the overall metrics are tracked.
+    """
+    def __init__(self, thresholds, groups=None):
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        if groups is None:
+            groups = []
+        groups = np.asarray([str(g) for g in groups])
+        self.group_names, self.group_index = np.unique(groups,
+                                                       return_inverse=True)
+        self.group_index = self.group_index.reshape(-1)
+        self.has_groups = len(groups) > 0
+
+        # the last column holds the statistics of all proteins
+        shape = (len(self.thresholds), len(self.group_names) + 1)
+        self.total = np.zeros(shape, dtype=np.float64)
+        self.p_total = np.zeros(shape, dtype=np.float64)
+        self.precision = np.zeros(shape, dtype=np.float64)
+        self.recall = np.zeros(shape, dtype=np.float64)
+        self.ru = np.zeros(shape, dtype=np.float64)
+        self.mi = np.zeros(shape, dtype=np.float64)
+
+    def _group_sum(self, mask, weights=None):
+        num_groups = len(self.group_names)
+        if weights is None:
+            weights = np.ones(len(mask), dtype=np.float64)
+        sums = np.zeros(num_groups + 1, dtype=np.float64)
+        if self.has_groups:
+            sums[:num_groups] = np.bincount(self.group_index[mask],
+                                            weights=weights[mask],
+                                            minlength=num_groups)
+        sums[num_groups] = weights[mask].sum()
+        return sums
+
+    def update(self, threshold_idx, go, real_annots, pred_annots):
+        """Evaluate the (propagated) predictions made at one threshold.
+
+        Returns:
+            (fscore, precision, recall, s) over all proteins, as returned
+            by ``evaluate_annotations``.
+        """
+        stats = annotation_stats(go, real_annots, pred_annots)
+        return self.update_stats(threshold_idx, **stats)
+
+    def update_stats(self, threshold_idx, tp, fp, fn, ru, mi):
+        if self.has_groups:
+            assert len(tp) == len(self.group_index), (
+                'Number of proteins and group keys do not match')
+        tp = np.asarray(tp, dtype=np.float64)
+        fp = np.asarray(fp, dtype=np.float64)
+        fn = np.asarray(fn, dtype=np.float64)
+        has_label = (tp + fn) > 0
+        has_pred = has_label & ((tp + fp) > 0)
+        recall = tp / np.maximum(tp + fn, 1.0)
+        precision = tp / np.maximum(tp + fp, 1.0)
+
+        t = threshold_idx
+        self.total[t] += self._group_sum(has_label)
+        self.recall[t] += self._group_sum(has_label, recall)
+        self.ru[t] += self._group_sum(has_label, np.asarray(ru))
+        self.mi[t] += self._group_sum(has_label, np.asarray(mi))
+        self.p_total[t] += self._group_sum(has_pred)
+        self.precision[t] += self._group_sum(has_pred, precision)
+
+        fscore, prec, rec, s = [x[:, -1] for x in self._metrics(t)]
+        return fscore[0], prec[0], rec[0], s[0]
+
+    def _metrics(self, threshold_idx=None):
+        if threshold_idx is None:
+            threshold_idx = slice(None)
+        else:
+            threshold_idx = slice(threshold_idx, threshold_idx + 1)
+        total = np.maximum(self.total[threshold_idx], 1.0)
+        p_total = np.maximum(self.p_total[threshold_idx], 1.0)
+        rec = self.recall[threshold_idx] / total
+        prec = self.precision[threshold_idx] / p_total
+        ru = self.ru[threshold_idx] / total
+        mi = self.mi[threshold_idx] / total
+        denom = prec + rec
+        fscore = np.where(denom > 0, 2 * prec * rec / np.maximum(denom, 1e-12),
+                          0.0)
+        s = np.sqrt(ru * ru + mi * mi)
+        return fscore, prec, rec, s
+
+    def compute(self):
+        """Fmax, Smin and AUPR for every group.
+
+        Returns:
+            OrderedDict group -> OrderedDict of metrics. The key `all` holds
+            the metrics over all proteins.
+        """
+        fscore, prec, rec, s = self._metrics()
+        names = list(self.group_names) + ['all']
+        results = OrderedDict()
+        for g, name in enumerate(names):
+            best = int(np.argmax(fscore[:, g]))
+            sorted_index = np.argsort(rec[:, g])
+            aupr = np.trapz(prec[sorted_index, g], rec[sorted_index, g])
+            results[name] = OrderedDict([
+                ('proteins', int(self.total[:, g].max())),
+                ('fmax', float(fscore[best, g])),
+                ('tmax', float(self.thresholds[best])),
+                ('smin', float(s[:, g].min())),
+                ('aupr', float(aupr)),
+            ])
+        return results
+
+    def to_frame(self):
+        results = self.compute()
+        df = pd.DataFrame.from_dict(results, orient='index')
+        df.index.name = 'group'
+        return df
+
+
+def log_group_results(results, logger):
+    for name, metrics in results.items():
+        logger.info(f"[{name}] proteins: {metrics['proteins']}, "
+                    f"Fmax: {metrics['fmax']:0.3f}, "
+                    f"Smin: {metrics['smin']:0.3f}, "
+                    f"AUPR: {metrics['aupr']:0.3f}, "
+                    f"threshold: {metrics['tmax']}")
@@ -26,6 +26,20 @@ class AminoacidsVocab(object):
 
         self.acids_ngram = self.gen_acids_ngram()
 
+        # 256-entry lookup tables, sequences are encoded as ASCII bytes
+        self.index_table = self.encode_table()
+        self.invalid_table = np.zeros(256, dtype=bool)
+        for token in self.invalid_acids:
+            self.invalid_table[ord(token)] = True
+        self.onehot_table = np.eye(self.acids_num + 1, dtype=np.int32)
+
+    def encode_table(self):
+        """Vocabulary index of every ASCII character, 0 for unknown."""
+        table = np.zeros(256, dtype=np.uint8)
+        for token, idx in self.token_to_idx.items():
+            table[ord(token)] = idx
+        return table
+
     def gen_acids_ngram(self):
         acids_ngram = {}
         for i in range(20):
@@ -38,29 +52,78 @@ class AminoacidsVocab(object):
 
         return acids_ngram
 
+    @staticmethod
+    def to_bytes(seq):
+        return np.frombuffer(seq.encode('ascii', errors='replace'),
+                             dtype=np.uint8)
+
+    def to_indices(self, seq):
+        """Vocabulary indices of `seq` (0 for unknown), truncated to
+        `maxlen`."""
+        return self.index_table[self.to_bytes(seq[:self.maxlen])]
+
+    def batch_to_indices(self, seqs, maxlen=None):
+        """[batch, maxlen] zero-padded vocabulary indices and the lengths
+        of the truncated sequences."""
+        maxlen = maxlen or self.maxlen
+        seqs = [seq[:maxlen] for seq in seqs]
+        lengths = np.fromiter((len(seq) for seq in seqs),
+                              dtype=np.int64,
+                              count=len(seqs))
+        indices = np.zeros((len(seqs), maxlen), dtype=np.uint8)
+        # row-major order of the mask is the order of the concatenation
+        mask = np.arange(maxlen) < lengths[:, None]
+        indices[mask] = self.index_table[self.to_bytes(''.join(seqs))]
+        return indices, lengths
+
     def is_ok(self, seq):
-        for c in seq:
-            if c in self.invalid_acids:
-                return False
-        return True
+        return not self.invalid_table[self.to_bytes(seq)].any()
+
+    def batch_is_ok(self, seqs):
+        """Boolean array, True for the sequences without invalid residues."""
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+        invalid = self.invalid_table[self.to_bytes(''.join(seqs))]
+        num_invalid = np.concatenate([[0], np.cumsum(invalid)])
+        return num_invalid[offsets[1:]] == num_invalid[offsets[:-1]]
+
+    def indices_to_ngrams(self, indices):
+        """3-gram ids of vocabulary indices, 0 for n-grams with an unknown
+        residue."""
+        indices = np.asarray(indices, dtype=np.int32)
+        first, second, third = (indices[..., :-2], indices[...,
+                                                           1:-1], indices[...,
+                                                                          2:])
+        ngrams = 400 * (first - 1) + 20 * (second - 1) + third
+        ngrams[(first == 0) | (second == 0) | (third == 0)] = 0
+        return ngrams
 
     def to_ngrams(self, seq):
-        l = min(self.maxlen, len(seq) - 3)
-        ngrams = np.zeros((l, ), dtype=np.int32)
-        for i in range(l):
-            ngrams[i] = self.acids_ngram.get(seq[i:i + 3], 0)
+        l = max(min(self.maxlen, len(seq) - 3), 0)
+        indices = self.index_table[self.to_bytes(seq[:l + 2])]
+        return self.indices_to_ngrams(indices)[:l]
+
+    def batch_to_ngrams(self, seqs):
+        """[batch, maxlen] zero-padded 3-gram ids, as `to_ngrams`."""
+        indices, _ = self.batch_to_indices(seqs, self.maxlen + 2)
+        ngrams = self.indices_to_ngrams(indices)
+        num_ngrams = np.clip(
+            np.minimum(self.maxlen, [len(seq) - 3 for seq in seqs]), 0, None)
+        ngrams[np.arange(self.maxlen) >= num_ngrams[:, None]] = 0
         return ngrams
 
     def to_onehot(self, seq, start=0):
         # range(1, 21) 代表20种氨基酸
-        onehot = np.zeros((self.maxlen, 21), dtype=np.int32)
-        l = min(self.maxlen, len(seq))
-        for i in range(start, start + l):
-            onehot[i, self.token_to_idx.get(seq[i - start], 0)] = 1
         # index==0 的位置 表示 Unknow
-        onehot[0:start, 0] = 1
-        onehot[start + l:, 0] = 1
-        return onehot
+        indices = np.zeros((self.maxlen, ), dtype=np.uint8)
+        seq_indices = self.to_indices(seq)
+        indices[start:start + len(seq_indices)] = seq_indices
+        return self.onehot_table[indices]
+
+    def batch_to_onehot(self, seqs):
+        """[batch, maxlen, 21] one-hot encoding of a batch of sequences."""
+        indices, _ = self.batch_to_indices(seqs)
+        return self.onehot_table[indices]
 
 
 if __name__ == '__main__':
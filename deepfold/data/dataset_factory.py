@@ -5,6 +5,10 @@ from torch.utils.data import DataLoader
 
 from .esm_dataset import EmbeddingDataset, EsmDataset
 from .protein_dataset import ProtBertDataset, ProtSeqDataset
+from .samplers import (BucketBatchSampler, DistributedBucketBatchSampler,
+                       EpochBatchSampler, TokenBudgetBatchSampler)
+from .tensor_iterator import (TensorBatchIterator, embedding_dataset_nbytes,
+                              fits_in_memory)
 
 
 def get_dataloaders(args):
@@ -42,6 +46,35 @@ def get_dataloaders(args):
     else:
         raise NotImplementedError
 
+    if isinstance(train_dataset, EmbeddingDataset):
+        if getattr(args, 'tensor_iterator', True):
+            loaders = get_tensor_iterators(args, train_dataset, val_dataset)
+            if loaders is not None:
+                return loaders
+        # whole batches are gathered from the embedding matrix at once
+        if args.distributed:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(
+                train_dataset)
+            val_sampler = torch.utils.data.distributed.DistributedSampler(
+                val_dataset)
+        else:
+            train_sampler = torch.utils.data.RandomSampler(train_dataset)
+            val_sampler = torch.utils.data.SequentialSampler(val_dataset)
+        train_loader = get_batched_dataloader(train_dataset, train_sampler,
+                                              args.batch_size, args.workers)
+        val_loader = get_batched_dataloader(val_dataset, val_sampler,
+                                            args.batch_size, args.workers)
+        return train_loader, val_loader
+
+    # every dataset densifies the sparse labels of a batch in its collate_fn
+    collate_fn = train_dataset.collate_fn
+
+    batch_by_length = (getattr(args, 'bucket_batches', False)
+                       or getattr(args, 'max_tokens', None))
+    if batch_by_length:
+        return get_bucket_dataloaders(args, train_dataset, val_dataset,
+                                      collate_fn)
+
     if args.distributed:
         train_sampler = torch.utils.data.distributed.DistributedSampler(
             train_dataset)
@@ -51,11 +84,6 @@ def get_dataloaders(args):
         train_sampler = torch.utils.data.RandomSampler(train_dataset)
         val_sampler = torch.utils.data.RandomSampler(val_dataset)
 
-    if name in ['esm', 'protseq']:
-        collate_fn = train_dataset.collate_fn
-    else:
-        collate_fn = None
-
     # dataloders
     train_loader = DataLoader(
         train_dataset,
@@ -77,3 +105,97 @@ def get_dataloaders(args):
         pin_memory=True,
     )
     return train_loader, val_loader
+
+
+def get_tensor_iterators(args, train_dataset, val_dataset):
+    """Device-resident batch iterators of embedding datasets, or None if
+    the embeddings do not fit in the memory of the training device."""
+    if torch.cuda.is_available():
+        device = torch.device('cuda', getattr(args, 'gpu', 0))
+    else:
+        device = torch.device('cpu')
+    num_bytes = embedding_dataset_nbytes(
+        train_dataset) + embedding_dataset_nbytes(val_dataset)
+    if not fits_in_memory(num_bytes, device):
+        return None
+    seed = getattr(args, 'seed', 0)
+    train_loader = TensorBatchIterator.from_dataset(train_dataset,
+                                                    args.batch_size,
+                                                    device=device,
+                                                    shuffle=True,
+                                                    seed=seed)
+    val_loader = TensorBatchIterator.from_dataset(val_dataset,
+                                                  args.batch_size,
+                                                  device=device,
+                                                  shuffle=False)
+    return train_loader, val_loader
+
+
+def get_batched_dataloader(dataset,
+                           sampler,
+                           batch_size,
+                           num_workers=0,
+                           drop_last=False):
+    """DataLoader of a dataset indexed with whole batches, such as
+    `EmbeddingDataset`: the batches of indices are drawn from `sampler` and
+    ``dataset[indices]`` returns the batched tensors, without per-sample
+    fetching and collate."""
+    return DataLoader(
+        dataset,
+        sampler=EpochBatchSampler(sampler, batch_size, drop_last),
+        batch_size=None,
+        num_workers=num_workers,
+        pin_memory=True,
+    )
+
+
+def get_bucket_dataloaders(args, train_dataset, val_dataset, collate_fn):
+    """Dataloaders batching sequences of similar length together, up to
+    `args.max_tokens` tokens per batch if it is set."""
+    if not hasattr(train_dataset, 'lengths'):
+        raise ValueError(f'{type(train_dataset).__name__} has no sequence '
+                         'lengths to bucket batches on')
+    seed = getattr(args, 'seed', 0)
+    if getattr(args, 'max_tokens', None):
+        attention_cost = getattr(args, 'attention_cost', 0.0)
+        train_sampler = TokenBudgetBatchSampler(train_dataset.lengths,
+                                                args.max_tokens,
+                                                attention_cost=attention_cost,
+                                                shuffle=True,
+                                                seed=seed)
+        val_sampler = TokenBudgetBatchSampler(val_dataset.lengths,
+                                              args.max_tokens,
+                                              attention_cost=attention_cost,
+                                              shuffle=False,
+                                              seed=seed)
+    else:
+        sampler_cls = BucketBatchSampler
+        if args.distributed:
+            sampler_cls = DistributedBucketBatchSampler
+        num_buckets = getattr(args, 'num_buckets', 16)
+        train_sampler = sampler_cls(train_dataset.lengths,
+                                    args.batch_size,
+                                    num_buckets=num_buckets,
+                                    shuffle=True,
+                                    seed=seed)
+        val_sampler = sampler_cls(val_dataset.lengths,
+                                  args.batch_size,
+                                  num_buckets=num_buckets,
+                                  shuffle=False,
+                                  seed=seed)
+
+    train_loader = DataLoader(
+        train_dataset,
+        batch_sampler=train_sampler,
+        num_workers=args.workers,
+        collate_fn=collate_fn,
+        pin_memory=True,
+    )
+    val_loader = DataLoader(
+        val_dataset,
+        batch_sampler=val_sampler,
+        num_workers=args.workers,
+        collate_fn=collate_fn,
+        pin_memory=True,
+    )
+    return train_loader, val_loader
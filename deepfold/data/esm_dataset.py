@@ -5,36 +5,163 @@ from typing import Dict
 
 import esm
 import numpy as np
-import pandas as pd
+import scipy.sparse as sp
 import torch
 from torch.utils.data import Dataset
 
-from deepfold.utils.constant import DEFAULT_ESM_MODEL, ESM_LIST
+from deepfold.data.utils.columnar import (FixedColumn, read_columns,
+                                          read_terms, resolve_data_file)
+from deepfold.data.utils.label_matrix import (collate_labels, label_indices,
+                                              load_label_matrix)
+from deepfold.data.utils.token_store import load_token_store
+from deepfold.utils.constant import (DEFAULT_ESM_MODEL, ESM_ALPHABET_ARCH,
+                                     ESM_LIST)
+from deepfold.utils.residue_embedding_db import ResidueEmbeddingDB
 
 
 class EmbeddingDataset(Dataset):
+    """Precomputed protein embeddings and their labels.
+
+    The embeddings are kept as one contiguous (num_proteins, dim) matrix,
+    memory-mapped when they are read from a column store, in float32 or,
+    with `dtype='float16'`, half the memory. Besides single samples, the
+    dataset is indexed with a whole batch of indices, ``dataset[indices]``
+    gathers the batch with one fancy-indexing call and returns the batched
+    tensors, see `dataset_factory.get_batched_dataloader`.
+    """
     def __init__(self,
                  data_path: str = 'dataset/',
-                 file_name: str = 'xxx.pkl'):
-        self.file_path = os.path.join(data_path, file_name)
-        self.data_df = self.load_dataset(self.file_path)
-        self.embeddings = list(self.data_df['esm_embeddings'])
-        self.labels = list(self.data_df['labels'])
+                 file_name: str = 'xxx.pkl',
+                 dtype: str = None):
+        self.file_path = resolve_data_file(os.path.join(data_path, file_name))
+        embeddings, labels = self.load_dataset(self.file_path)
+        self.embeddings = embedding_matrix(embeddings, dtype)
+        # the precomputed dense labels are kept as a sparse matrix
+        self.label_mat = sp.csr_matrix(np.asarray(labels, dtype=np.uint8))
+        self.num_classes = self.label_mat.shape[1]
 
     def __len__(self):
-        return len(self.data_df)
+        return len(self.embeddings)
 
     def __getitem__(self, idx):
+        if isinstance(idx, (list, np.ndarray, torch.Tensor)):
+            return self.get_batch(idx)
         embedding = self.embeddings[idx]
-        labels = self.labels[idx]
         embeddings = torch.from_numpy(np.array(embedding, dtype=np.float32))
-        labels = torch.from_numpy(np.array(labels))
+        labels = label_indices(self.label_mat, idx)
         encoded_inputs = {'embeddings': embeddings, 'labels': labels}
         return encoded_inputs
 
+    def get_batch(self, indices) -> Dict[str, torch.Tensor]:
+        """Batched tensors of the samples `indices`, in that order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        embeddings = np.ascontiguousarray(self.embeddings[indices],
+                                          dtype=np.float32)
+        labels = self.label_mat[indices].toarray()
+        return {
+            'embeddings': torch.from_numpy(embeddings),
+            'labels': torch.from_numpy(labels).long()
+        }
+
+    def collate_fn(self, examples) -> Dict[str, torch.Tensor]:
+        encoded_inputs = {
+            'embeddings': torch.stack([ex['embeddings'] for ex in examples])
+        }
+        encoded_inputs['labels'] = collate_labels(
+            [ex['labels'] for ex in examples],
+            self.num_classes,
+            dtype=torch.long)
+        return encoded_inputs
+
     def load_dataset(self, data_path):
-        df = pd.read_pickle(data_path)
-        return df
+        return read_columns(data_path, ['esm_embeddings', 'labels'])
+
+
+class ResidueEmbeddingDataset(Dataset):
+    """Precomputed per-residue embeddings and their labels.
+
+    The embeddings are read from a `ResidueEmbeddingDB` (see
+    `tools/extract_residue_embeddings.py`), so label-wise attention heads
+    are trained without running the backbone. Batches are padded to their
+    longest protein.
+
+    Args:
+        data_path: data dir of the dataset.
+        file_name: data file, its `proteins` are looked up in the db.
+        db_dir: directory of the residue embedding db.
+        max_length: optional number of residues the proteins are cut to.
+    """
+    def __init__(self,
+                 data_path: str = 'dataset/',
+                 file_name: str = 'xxx.pkl',
+                 db_dir: str = 'residue_embeddings',
+                 max_length: int = None):
+        self.file_path = resolve_data_file(os.path.join(data_path, file_name))
+        self.terms_path = os.path.join(data_path, 'terms.pkl')
+        proteins, annotations = read_columns(self.file_path,
+                                             ['proteins', 'prop_annotations'])
+        self.terms = read_terms(self.terms_path)
+        self.num_classes = len(self.terms)
+        self.label_mat = load_label_matrix(self.file_path, self.terms,
+                                           annotations)
+        self.db = ResidueEmbeddingDB(db_dir)
+        missing = [p for p in proteins if str(p) not in self.db]
+        if missing:
+            raise KeyError(f'{len(missing)} proteins of {self.file_path} are '
+                           f'not in {db_dir}, e.g. {missing[0]}')
+        self.rows = np.array([self.db.id_to_index[str(p)] for p in proteins],
+                             dtype=np.int64)
+        self.max_length = max_length
+
+    @property
+    def embed_dim(self):
+        return self.db.dim
+
+    @property
+    def lengths(self):
+        """Number of residues of every sample, used to bucket batches."""
+        lengths = self.db.lengths[self.rows]
+        if self.max_length is not None:
+            lengths = np.minimum(lengths, self.max_length)
+        return lengths
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        embeddings = self.db.get_row(self.rows[idx])[:self.max_length]
+        return embeddings, label_indices(self.label_mat, idx)
+
+    def collate_fn(self, examples) -> Dict[str, torch.Tensor]:
+        lengths = [len(ex[0]) for ex in examples]
+        # [batch, max_len, embed_dim]
+        embeddings = torch.zeros((len(examples), max(lengths), self.embed_dim),
+                                 dtype=torch.float)
+        for i, ex in enumerate(examples):
+            embeddings[i, :lengths[i]] = torch.from_numpy(
+                np.asarray(ex[0], dtype=np.float32))
+        encoded_inputs = {
+            'embeddings': embeddings,
+            'lengths': torch.tensor(lengths, dtype=torch.int)
+        }
+        encoded_inputs['labels'] = collate_labels([ex[1] for ex in examples],
+                                                  self.num_classes,
+                                                  dtype=torch.long)
+        return encoded_inputs
+
+
+def embedding_matrix(embeddings, dtype=None):
+    """One contiguous matrix of the embedding rows, a memory-mapped column
+    is used as is unless it has to be converted to `dtype`."""
+    if isinstance(embeddings, FixedColumn):
+        matrix = embeddings.values
+    else:
+        matrix = np.stack([np.asarray(emb).reshape(-1) for emb in embeddings])
+    if dtype is None and matrix.dtype not in (np.float16, np.float32):
+        dtype = np.float32
+    if dtype is not None:
+        matrix = np.ascontiguousarray(matrix, dtype=dtype)
+    return matrix
 
 
 class EsmDataset(Dataset):
@@ -45,10 +172,11 @@ class EsmDataset(Dataset):
                  model_dir: str = 'esm1b_t33_650M_UR50S',
                  max_length: int = 1024,
                  truncate: bool = True,
-                 random_crop: bool = False):
+                 random_crop: bool = False,
+                 use_token_store: bool = True):
         super().__init__()
 
-        self.file_path = os.path.join(data_path, file_name)
+        self.file_path = resolve_data_file(os.path.join(data_path, file_name))
         self.terms_path = os.path.join(data_path, 'terms.pkl')
 
         self.seqs, self.labels, self.terms = self.load_dataset(
@@ -56,6 +184,8 @@ class EsmDataset(Dataset):
 
         self.terms_dict = {v: i for i, v in enumerate(self.terms)}
         self.num_classes = len(self.terms)
+        self.label_mat = load_label_matrix(self.file_path, self.terms,
+                                           self.labels)
         self.max_length = max_length
         self.truncate = truncate
         self.random_crop = random_crop
@@ -68,10 +198,16 @@ class EsmDataset(Dataset):
 
         self.is_msa = 'msa' in model_dir
 
-        esm_model, self.alphabet = esm.pretrained.load_model_and_alphabet(
-            model_dir)
+        self.alphabet = load_esm_alphabet(model_dir)
         self.batch_converter = self.alphabet.get_batch_converter()
-        self.free_memory(esm_model)
+
+        # single sequences are tokenized once and memory-mapped, msa inputs
+        # keep the batch converter
+        self.token_store = None
+        if use_token_store and not self.is_msa:
+            self.token_store = load_token_store(self.file_path, self.seqs,
+                                                'esm_' + model_dir,
+                                                self.encode_table())
 
     @property
     def vocab_size(self) -> int:
@@ -108,38 +244,44 @@ class EsmDataset(Dataset):
         """Returns a function which maps tokens to IDs."""
         return lambda x: self.alphabet.tok_to_idx[x]
 
-    def free_memory(self, esm_model):
-        del esm_model
-        gc.collect()
-        print('Delete the esm model, free memory!')
+    def encode_table(self):
+        """Token id of every ASCII character."""
+        return np.array([
+            self.alphabet.tok_to_idx.get(chr(c), self.alphabet.unk_idx)
+            for c in range(256)
+        ])
 
     def __len__(self):
         return len(self.labels)
 
+    @property
+    def lengths(self):
+        """Number of residues of every sample, used to bucket batches."""
+        if self.token_store is not None:
+            lengths = self.token_store.lengths
+        else:
+            lengths = np.array([len(seq) for seq in self.seqs])
+        if self.truncate or self.random_crop:
+            lengths = np.minimum(lengths, self.max_length - 2)
+        return lengths
+
     def __getitem__(self, idx):
 
-        sequence = self.seqs[idx]
+        if self.token_store is not None:
+            sequence = self.token_store[idx]
+        else:
+            sequence = self.seqs[idx]
         if self.random_crop:
             sequence = crop_sequence(sequence, crop_length=self.max_length - 2)
         if self.truncate:
             sequence = sequence[:self.max_length - 2]
 
         length = len(sequence)
-        label_list = self.labels[idx]
-        multilabel = [0] * self.num_classes
-        for t_id in label_list:
-            if t_id in self.terms_dict:
-                label_idx = self.terms_dict[t_id]
-                multilabel[label_idx] = 1
-        return sequence, length, multilabel
+        return sequence, length, label_indices(self.label_mat, idx)
 
     def load_dataset(self, data_path, term_path):
-        df = pd.read_pickle(data_path)
-        terms_df = pd.read_pickle(term_path)
-        terms = terms_df['terms'].values.flatten()
-
-        seq = list(df['sequences'])
-        label = list(df['prop_annotations'])
+        seq, label = read_columns(data_path, ['sequences', 'prop_annotations'])
+        terms = read_terms(term_path)
         assert len(seq) == len(label)
         return seq, label, terms
 
@@ -150,7 +292,9 @@ class EsmDataset(Dataset):
         lengths = [ex[1] for ex in examples]
         multilabel_list = [ex[2] for ex in examples]
 
-        if self.is_msa:
+        if self.token_store is not None:
+            all_tokens = self.pad_tokens(sequences_list)
+        elif self.is_msa:
             labels, strs, all_tokens = self.batch_converter(sequences_list)
         else:
             labels, strs, all_tokens = self.batch_converter([
@@ -170,10 +314,40 @@ class EsmDataset(Dataset):
             # 'token_type_ids': torch.zeros(all_tokens.shape),
         }
         encoded_inputs['lengths'] = torch.tensor(lengths, dtype=torch.int)
-        encoded_inputs['labels'] = torch.tensor(multilabel_list,
-                                                dtype=torch.int)
+        encoded_inputs['labels'] = collate_labels(multilabel_list,
+                                                  self.num_classes,
+                                                  dtype=torch.int)
         return encoded_inputs
 
+    def pad_tokens(self, tokens_list):
+        """Same layout as the esm batch converter for pre-tokenized
+        sequences."""
+        alphabet = self.alphabet
+        offset = int(alphabet.prepend_bos)
+        max_len = max(len(tokens) for tokens in tokens_list)
+        all_tokens = torch.full(
+            (len(tokens_list), max_len + offset + int(alphabet.append_eos)),
+            alphabet.padding_idx,
+            dtype=torch.int64)
+        for i, tokens in enumerate(tokens_list):
+            if alphabet.prepend_bos:
+                all_tokens[i, 0] = alphabet.cls_idx
+            all_tokens[i, offset:offset + len(tokens)] = torch.from_numpy(
+                tokens.astype(np.int64))
+            if alphabet.append_eos:
+                all_tokens[i, offset + len(tokens)] = alphabet.eos_idx
+        return all_tokens
+
+
+def load_esm_alphabet(model_dir):
+    """Alphabet of an esm model, without loading the model weights."""
+    if model_dir in ESM_ALPHABET_ARCH:
+        return esm.Alphabet.from_architecture(ESM_ALPHABET_ARCH[model_dir])
+    esm_model, alphabet = esm.pretrained.load_model_and_alphabet(model_dir)
+    del esm_model
+    gc.collect()
+    return alphabet
+
 
 def crop_sequence(sequence: str, crop_length: int) -> str:
     """If the length of the sequence is superior to crop_length, crop randomly
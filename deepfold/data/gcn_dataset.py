@@ -5,6 +5,9 @@ import pandas as pd
 import torch
 from torch.utils.data import Dataset
 
+from deepfold.data.utils.label_matrix import (collate_labels, label_indices,
+                                              load_label_matrix)
+
 
 class GCNDataset(Dataset):
     """ESMDataset."""
@@ -17,6 +20,9 @@ class GCNDataset(Dataset):
         self.embeddings, self.labels = self.load_dataset(self.data_path)
         self.terms_dict = label_map
         self.num_classes = len(self.terms_dict)
+        self.terms = sorted(self.terms_dict, key=self.terms_dict.get)
+        self.label_mat = load_label_matrix(self.data_path, self.terms,
+                                           self.labels)
 
     def __len__(self):
         return len(self.labels)
@@ -24,18 +30,21 @@ class GCNDataset(Dataset):
     def __getitem__(self, idx):
 
         embedding = self.embeddings[idx]
-        label_list = self.labels[idx]
-        multilabel = [0] * self.num_classes
-        for t_id in label_list:
-            if t_id in self.terms_dict:
-                label_idx = self.terms_dict[t_id]
-                multilabel[label_idx] = 1
-
         embeddings = torch.from_numpy(np.array(embedding, dtype=np.float32))
-        labels = torch.from_numpy(np.array(multilabel))
+        labels = label_indices(self.label_mat, idx)
         encoded_inputs = {'embeddings': embeddings, 'labels': labels}
         return encoded_inputs
 
+    def collate_fn(self, examples):
+        encoded_inputs = {
+            'embeddings': torch.stack([ex['embeddings'] for ex in examples])
+        }
+        encoded_inputs['labels'] = collate_labels(
+            [ex['labels'] for ex in examples],
+            self.num_classes,
+            dtype=torch.long)
+        return encoded_inputs
+
     def load_dataset(self, data_path):
         df = pd.read_pickle(data_path)
         embeddings = list(df['esm_embeddings'])
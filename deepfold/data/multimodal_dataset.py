@@ -5,6 +5,9 @@ import pandas as pd
 import torch
 from torch.utils.data import Dataset
 
+from deepfold.data.utils.label_matrix import (collate_labels, label_indices,
+                                              load_label_matrix)
+
 NAMESPACES = {
     'cco': 'cellular_component',
     'mfo': 'molecular_function',
@@ -32,6 +35,8 @@ class MultiModalDataset(Dataset):
             np.array(self.goterm_embedding, dtype=np.float32))
         self.terms_dict = {v: i for i, v in enumerate(self.terms)}
         self.num_classes = len(self.terms_dict)
+        self.label_mat = load_label_matrix(self.file_path, self.terms,
+                                           self.labels)
 
     def __len__(self):
         return len(self.labels)
@@ -39,18 +44,21 @@ class MultiModalDataset(Dataset):
     def __getitem__(self, idx):
 
         embedding = self.embeddings[idx]
-        label_list = self.labels[idx]
-        multilabel = [0] * self.num_classes
-        for t_id in label_list:
-            if t_id in self.terms_dict:
-                label_idx = self.terms_dict[t_id]
-                multilabel[label_idx] = 1
-
         embeddings = torch.from_numpy(np.array(embedding, dtype=np.float32))
-        labels = torch.from_numpy(np.array(multilabel))
+        labels = label_indices(self.label_mat, idx)
         encoded_inputs = {'embeddings': embeddings, 'labels': labels}
         return encoded_inputs
 
+    def collate_fn(self, examples):
+        encoded_inputs = {
+            'embeddings': torch.stack([ex['embeddings'] for ex in examples])
+        }
+        encoded_inputs['labels'] = collate_labels(
+            [ex['labels'] for ex in examples],
+            self.num_classes,
+            dtype=torch.long)
+        return encoded_inputs
+
     def load_dataset(self, data_path, term_path):
         df = pd.read_pickle(data_path)
         terms_df = pd.read_pickle(term_path)
@@ -90,7 +98,9 @@ if __name__ == '__main__':
         file_name='cco_esm1b_t33_650M_UR50S_embeddings_mean_test.pkl',
         namespace='cco')
     print(pro_dataset.num_classes)
-    data_loader = DataLoader(pro_dataset, batch_size=8)
+    data_loader = DataLoader(pro_dataset,
+                             batch_size=8,
+                             collate_fn=pro_dataset.collate_fn)
 
     for index, batch in enumerate(data_loader):
         for key, val in batch.items():
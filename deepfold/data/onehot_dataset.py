@@ -1,97 +1,106 @@
 import numpy as np
 import pandas as pd
 import torch
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 
 from .aminoacids import MAXLEN, AminoacidsVocab
+from .utils.label_matrix import (build_label_matrix, collate_labels,
+                                 label_indices, load_label_matrix)
+from .utils.token_store import TokenStore, encode_sequences
+
+DATA_TYPES = ['one-hot', 'label-index']
 
 
 # ------------------------------------------------------------------------------------------
 # Customized pytorch Dateset for annotated sequences
 class OneHotSequences(Dataset):
+    """Annotated sequences, one-hot encoded per batch.
+
+    The residues are stored as uint8 vocabulary indices (0 for unknown
+    residues) packed into one buffer, and only expanded in `collate_fn`:
+    to [batch, seq_len, 21] float one-hot tensors (`one-hot`) or to
+    [batch, seq_len] index tensors for embedding layers (`label-index`).
+    Padding positions get index 0, as in `AminoacidsVocab.to_onehot`.
+    Batches are padded to `MAXLEN`, or to their longest sequence with
+    `variable_length`. `transform` is applied to the expanded batch.
+    """
+    channels_first = False
+
     def __init__(self,
                  data_file,
                  terms_file,
                  transform=None,
                  target_transform=None,
-                 data_type='one-hot'):
+                 data_type='one-hot',
+                 variable_length=False):
         super().__init__()
 
         data_df, terms = self.load_data(data_file, terms_file)
-        # convert terms to dict
-        terms_dict = {v: i for i, v in enumerate(terms)}
-        # convert to tensor
+        label_mat = load_label_matrix(
+            data_file, terms, lambda: list(data_df['prop_annotations']))
+        self.init_sequences(data_df, terms, label_mat, transform,
+                            target_transform, data_type, variable_length)
+
+    def init_sequences(self, df, terms, label_mat, transform, target_transform,
+                       data_type, variable_length):
+        data_type = data_type.lower()
+        if data_type not in DATA_TYPES:
+            raise ValueError(f'{data_type} is not a supported data type, '
+                             f'valid data types are {DATA_TYPES}')
         self.aminoacids_vocab = AminoacidsVocab()
-        if data_type in ['one-hot', 'One-hot']:
-            data_tensor, labels = self.df_to_tensor(data_df, len(terms),
-                                                    terms_dict)
-        if data_type in ['label-index', 'Label-index']:
-            data_tensor, labels = self.df_to_tensor_label_index(
-                data_df, len(terms), terms_dict)
-        # self.
+        # [num_residues] uint8 vocabulary indices and [batch + 1] offsets
+        tokens, offsets = encode_sequences(
+            [seq[:MAXLEN] for seq in df['sequences']],
+            self.aminoacids_vocab.encode_table())
+        self.store = TokenStore(tokens, offsets)
         self.data_type = data_type
+        self.variable_length = variable_length
         self.terms = terms
         self.nb_classes = len(terms)
-        self.labels = labels
-        self.data = data_tensor
+        self.label_mat = label_mat
         self.transform = transform
         self.target_transform = target_transform
 
+    @property
+    def lengths(self):
+        return self.store.lengths
+
     def __len__(self):
-        if self.data_type in ['one-hot', 'One-hot']:
-            return len(self.data)
-        if self.data_type in ['label-index', 'Label-index']:
-            return self.data.size()[1]
+        return len(self.store)
 
     def __getitem__(self, idx):
-        if self.data_type in ['one-hot', 'One-hot']:
-            data = self.data[idx]
-            label = self.labels[idx]
-        if self.data_type in ['label-index', 'Label-index']:
-            data = self.data[:, idx]
-            label = self.labels[:, idx]
+        return self.store[idx], label_indices(self.label_mat, idx)
+
+    def collate_fn(self, examples):
+        if self.variable_length:
+            seq_len = max(max(len(ex[0]) for ex in examples), 1)
+        else:
+            seq_len = MAXLEN
+        # [batch, seq_len]
+        data = torch.zeros((len(examples), seq_len), dtype=torch.long)
+        for i, ex in enumerate(examples):
+            data[i, :len(ex[0])] = torch.from_numpy(ex[0].astype(np.int64))
+
+        if self.data_type == 'one-hot':
+            # [batch, seq_len, num_aa_feature]
+            data = F.one_hot(data, self.aminoacids_vocab.acids_num + 1)
+            data = data.float()
+            if self.channels_first:
+                # [batch, num_aa_feature, seq_len]
+                data = data.permute(0, 2, 1).contiguous()
+        else:
+            data = data.int()
+        # [batch, num_classes]
+        labels = collate_labels([ex[1] for ex in examples],
+                                self.nb_classes,
+                                dtype=torch.int)
+
         if self.transform:
             data = self.transform(data)
         if self.target_transform:
-            label = self.target_transform(label)
-        return data, label
-
-    def df_to_tensor(self, df, nb_classes, terms_dict):
-        # [batch, seq_len, num_aa_feature]
-        data_onehot = np.zeros((len(df), MAXLEN, 21), dtype=np.float32)
-        # [batch, num_classes]
-        labels = np.zeros((len(df), nb_classes), dtype=np.int32)
-
-        for i, row in enumerate(df.itertuples()):
-            seq = row.sequences
-            onehot = self.aminoacids_vocab.to_onehot(seq)
-            data_onehot[i, :, :] = onehot
-            for t_id in row.prop_annotations:
-                if t_id in terms_dict:
-                    labels[i, terms_dict[t_id]] = 1
-
-        data_onehot = torch.from_numpy(data_onehot).float()
-        labels = torch.from_numpy(labels).int()
-        return data_onehot, labels
-
-    # data type for transformer
-    def df_to_tensor_label_index(self, df, nb_classes, terms_dict):
-        # [seq_len, batch]
-        data_index = np.zeros((MAXLEN, len(df)), dtype=np.float32)
-        # [num_classes, batch]
-        labels = np.zeros((nb_classes, len(df)), dtype=np.int32)
-
-        for i, row in enumerate(df.itertuples()):
-            seq = row.sequences
-            label_index = self.aminoacids_vocab.to_label_index(seq)
-            data_index[:, i] = label_index
-            for t_id in row.prop_annotations:
-                if t_id in terms_dict:
-                    labels[terms_dict[t_id], i] = 1
-
-        data_index = torch.from_numpy(data_index).int()
-        labels = torch.from_numpy(labels).int()
-        return data_index, labels
+            labels = self.target_transform(labels)
+        return data, labels
 
     def load_data(self, data_file, terms_file):
         data_df = pd.read_pickle(data_file)
@@ -101,85 +110,19 @@ class OneHotSequences(Dataset):
 
 
 # Customized pytorch Dateset for annotated sequences of arbitrary length
-class AnnotatedSequencesXL(Dataset):
+class AnnotatedSequencesXL(OneHotSequences):
+    """Annotated sequences of a DataFrame, one-hot batches are laid out as
+    [batch, num_aa_feature, seq_len] for 1d convolutions."""
+    channels_first = True
+
     def __init__(self,
                  data_frame,
                  terms,
                  transform=None,
                  target_transform=None,
-                 data_type='one-hot'):
-        super().__init__()
-        # convert terms to dict
-        terms_dict = {v: i for i, v in enumerate(terms)}
-        # convert to tensor
-        if data_type in ['one-hot', 'One-hot']:
-            data_tensor, labels = self.df_to_tensor(data_frame, len(terms),
-                                                    terms_dict)
-        if data_type in ['label-index', 'Label-index']:
-            data_tensor, labels = self.df_to_tensor_label_index(
-                data_frame, len(terms), terms_dict)
-        # self.
-        self.vocab = AminoacidsVocab()
-        self.data_type = data_type
-        self.terms = terms
-        self.nb_classes = len(terms)
-        self.labels = labels
-        self.data = data_tensor
-        self.transform = transform
-        self.target_transform = target_transform
-
-    def __len__(self):
-        if self.data_type in ['one-hot', 'One-hot']:
-            return len(self.data)
-        if self.data_type in ['label-index', 'Label-index']:
-            return self.data.size()[1]
-
-    def __getitem__(self, idx):
-        if self.data_type in ['one-hot', 'One-hot']:
-            data = self.data[idx]
-            label = self.labels[idx]
-        if self.data_type in ['label-index', 'Label-index']:
-            data = self.data[:, idx]
-            label = self.labels[:, idx]
-        if self.transform:
-            data = self.transform(data)
-        if self.target_transform:
-            label = self.target_transform(label)
-        return data, label
-
-    def df_to_tensor(self, df, nb_classes, terms_dict):
-        # [batch, num_aa_feature, seq_len]
-        data_onehot = np.zeros((len(df), 21, MAXLEN), dtype=np.float32)
-        # [batch, num_classes]
-        labels = np.zeros((len(df), nb_classes), dtype=np.int32)
-
-        for i, row in enumerate(df.itertuples()):
-            seq = row.sequences
-            onehot = self.vocab.to_onehot(seq)
-            data_onehot[i, :, :] = onehot
-            for t_id in row.prop_annotations:
-                if t_id in terms_dict:
-                    labels[i, terms_dict[t_id]] = 1
-
-        data_onehot = torch.from_numpy(data_onehot).float()
-        labels = torch.from_numpy(labels).int()
-        return data_onehot, labels
-
-    # data type for transformer
-    def df_to_tensor_label_index(self, df, nb_classes, terms_dict):
-        # [seq_len, batch]
-        data_index = np.zeros((MAXLEN, len(df)), dtype=np.float32)
-        # [num_classes, batch]
-        labels = np.zeros((nb_classes, len(df)), dtype=np.int32)
-
-        for i, row in enumerate(df.itertuples()):
-            seq = row.sequences
-            label_index = self.vocab.to_label_index(seq)
-            data_index[:, i] = label_index
-            for t_id in row.prop_annotations:
-                if t_id in terms_dict:
-                    labels[terms_dict[t_id], i] = 1
-
-        data_index = torch.from_numpy(data_index).int()
-        labels = torch.from_numpy(labels).int()
-        return data_index, labels
+                 data_type='one-hot',
+                 variable_length=False):
+        Dataset.__init__(self)
+        label_mat = build_label_matrix(data_frame['prop_annotations'], terms)
+        self.init_sequences(data_frame, terms, label_mat, transform,
+                            target_transform, data_type, variable_length)
@@ -3,16 +3,23 @@ import random
 import re
 import sys
 
-import pandas as pd
+import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset
 from transformers import AutoTokenizer, RobertaTokenizer
 
 from deepfold.data.protein_tokenizer import ProteinTokenizer
+from deepfold.data.utils.columnar import (read_columns, read_terms,
+                                          resolve_data_file)
+from deepfold.data.utils.label_matrix import (collate_labels, label_indices,
+                                              load_label_matrix)
+from deepfold.data.utils.token_store import load_token_store
 
 sys.path.append('../../')
 
+RARE_AMINO_ACIDS = re.compile(r'[UZOB]')
+
 
 class ProtRobertaDataset(Dataset):
     def __init__(self,
@@ -22,7 +29,7 @@ class ProtRobertaDataset(Dataset):
                  split='train',
                  max_length=1024):
 
-        self.file_path = os.path.join(data_path, file_name)
+        self.file_path = resolve_data_file(os.path.join(data_path, file_name))
         self.terms_path = os.path.join(data_path, 'terms.pkl')
 
         self.seqs, self.labels, self.terms = self.load_dataset(
@@ -38,41 +45,51 @@ class ProtRobertaDataset(Dataset):
         self.max_length = max_length
         self.id2label = {idx: label for idx, label in enumerate(self.terms)}
         self.label2id = {label: idx for idx, label in enumerate(self.terms)}
+        self.label_mat = load_label_matrix(self.file_path, self.terms,
+                                           self.labels)
 
     def __len__(self):
         return len(self.labels)
 
+    @property
+    def lengths(self):
+        """Number of residues of every sample, used to bucket batches."""
+        return np.minimum([len(seq) for seq in self.seqs], self.max_length - 2)
+
     def __getitem__(self, idx):
 
         # Make sure there is a space between every token, and map rarely amino acids
         sequence = self.seqs[idx]
         length = len(sequence)
 
-        seq_ids = self.tokenizer(sequence,
-                                 padding='max_length',
-                                 max_length=self.max_length,
-                                 truncation=True)
-
-        sample = {key: torch.tensor(val) for key, val in seq_ids.items()}
+        # padded to the longest sequence of the batch in collate_fn
+        sample = self.tokenizer(sequence,
+                                max_length=self.max_length,
+                                truncation=True)
 
-        label_list = self.labels[idx]
-        multilabel = [0] * self.num_classes
-        for t_id in label_list:
-            if t_id in self.label2id:
-                label_idx = self.label2id[t_id]
-                multilabel[label_idx] = 1
-
-        sample['labels'] = torch.tensor(multilabel, dtype=torch.int)
-        sample['lengths'] = torch.tensor(length, dtype=torch.int)
+        sample['labels'] = label_indices(self.label_mat, idx)
+        sample['lengths'] = length
         return sample
 
-    def load_dataset(self, data_path, term_path):
-        df = pd.read_pickle(data_path)
-        terms_df = pd.read_pickle(term_path)
-        terms = terms_df['terms'].values.flatten()
+    def collate_fn(self, examples):
+        encoded_inputs = self.tokenizer.pad([{
+            key: val
+            for key, val in ex.items() if key not in ('labels', 'lengths')
+        } for ex in examples],
+                                            padding='longest',
+                                            return_tensors='pt')
+        encoded_inputs = dict(encoded_inputs)
+        encoded_inputs['lengths'] = torch.tensor(
+            [ex['lengths'] for ex in examples], dtype=torch.int)
+        encoded_inputs['labels'] = collate_labels(
+            [ex['labels'] for ex in examples],
+            self.num_classes,
+            dtype=torch.int)
+        return encoded_inputs
 
-        seq = list(df['sequences'])
-        label = list(df['prop_annotations'])
+    def load_dataset(self, data_path, term_path):
+        seq, label = read_columns(data_path, ['sequences', 'prop_annotations'])
+        terms = read_terms(term_path)
         assert len(seq) == len(label)
         return seq, label, terms
 
@@ -84,7 +101,7 @@ class ProtBertDataset(Dataset):
                  tokenizer_name='Rostlab/prot_bert_bfd',
                  max_length=1024):
 
-        self.file_path = os.path.join(data_path, file_name)
+        self.file_path = resolve_data_file(os.path.join(data_path, file_name))
         self.terms_path = os.path.join(data_path, 'terms.pkl')
 
         self.seqs, self.labels, self.terms = self.load_dataset(
@@ -97,49 +114,56 @@ class ProtBertDataset(Dataset):
         self.max_length = max_length
         self.id2label = {idx: label for idx, label in enumerate(self.terms)}
         self.label2id = {label: idx for idx, label in enumerate(self.terms)}
+        self.label_mat = load_label_matrix(self.file_path, self.terms,
+                                           self.labels)
 
     def load_dataset(self, data_path, term_path):
-        df = pd.read_pickle(data_path)
-        terms_df = pd.read_pickle(term_path)
-        terms = terms_df['terms'].values.flatten()
-
-        seq = list(df['sequences'])
-        label = list(df['prop_annotations'])
+        seq, label = read_columns(data_path, ['sequences', 'prop_annotations'])
+        terms = read_terms(term_path)
         assert len(seq) == len(label)
         return seq, label, terms
 
     def __len__(self):
         return len(self.labels)
 
+    @property
+    def lengths(self):
+        """Number of residues of every sample, used to bucket batches."""
+        return np.minimum([len(seq) for seq in self.seqs], self.max_length - 2)
+
     def __getitem__(self, idx):
 
         # Make sure there is a space between every token, and map rarely amino acids
-        seq = ' '.join(''.join(self.seqs[idx].split()))
-        seq = re.sub(r'[UZOB]', 'X', seq)
+        seq = ' '.join(
+            RARE_AMINO_ACIDS.sub('X', ''.join(self.seqs[idx].split())))
 
-        seq_ids = self.tokenizer(
+        # padded to the longest sequence of the batch in collate_fn
+        sample = self.tokenizer(
             seq,
             # add_special_tokens=True,  #Add [CLS] [SEP] tokens
-            padding='max_length',
             max_length=self.max_length,
             truncation=True,  # Truncate data beyond max length
             # return_token_type_ids=False,
             # return_attention_mask=True,  # diff normal/pad tokens
-            # return_tensors='pt'  # PyTorch Tensor format
         )
 
-        sample = {key: torch.tensor(val) for key, val in seq_ids.items()}
-
-        label_list = self.labels[idx]
-        multilabel = [0] * self.num_classes
-        for t_id in label_list:
-            if t_id in self.label2id:
-                label_idx = self.label2id[t_id]
-                multilabel[label_idx] = 1
-
-        sample['labels'] = torch.tensor(multilabel)
+        sample['labels'] = label_indices(self.label_mat, idx)
         return sample
 
+    def collate_fn(self, examples):
+        encoded_inputs = self.tokenizer.pad(
+            [{key: val
+              for key, val in ex.items() if key != 'labels'}
+             for ex in examples],
+            padding='longest',
+            return_tensors='pt')
+        encoded_inputs = dict(encoded_inputs)
+        encoded_inputs['labels'] = collate_labels(
+            [ex['labels'] for ex in examples],
+            self.num_classes,
+            dtype=torch.long)
+        return encoded_inputs
+
 
 class ProtSeqDataset(Dataset):
     def __init__(self,
@@ -147,48 +171,69 @@ class ProtSeqDataset(Dataset):
                  file_name: str = 'xxx.pkl',
                  max_length: int = 1024,
                  truncate: bool = True,
-                 random_crop: bool = False):
+                 random_crop: bool = False,
+                 use_token_store: bool = True):
         super().__init__()
 
-        self.file_path = os.path.join(data_path, file_name)
+        self.file_path = resolve_data_file(os.path.join(data_path, file_name))
         self.terms_path = os.path.join(data_path, 'terms.pkl')
         self.seqs, self.labels, self.terms = self.load_dataset(
             self.file_path, self.terms_path)
 
-        # self.
         self.tokenizer = ProteinTokenizer()
+        # the whole dataset is tokenized once and memory-mapped
+        self.token_store = None
+        if use_token_store:
+            self.token_store = load_token_store(self.file_path, self.seqs,
+                                                'protein_tokenizer',
+                                                self.tokenizer.encode_table())
         self.num_classes = len(self.terms)
         self.max_length = max_length
         self.truncate = truncate
         self.random_crop = random_crop
         self.id2label = {idx: label for idx, label in enumerate(self.terms)}
         self.label2id = {label: idx for idx, label in enumerate(self.terms)}
+        self.label_mat = load_label_matrix(self.file_path, self.terms,
+                                           self.labels)
 
     def __len__(self):
         return len(self.labels)
 
+    @property
+    def lengths(self):
+        """Number of residues of every sample, used to bucket batches."""
+        if self.token_store is not None:
+            lengths = self.token_store.lengths
+        else:
+            lengths = np.array([len(seq) for seq in self.seqs])
+        if self.truncate or self.random_crop:
+            lengths = np.minimum(lengths, self.max_length - 2)
+        return lengths
+
     def __getitem__(self, idx):
 
-        sequence = self.seqs[idx]
+        if self.token_store is not None:
+            sequence = self.token_store[idx]
+        else:
+            sequence = self.seqs[idx]
         if self.random_crop:
             sequence = crop_sequence(sequence, crop_length=self.max_length - 2)
         if self.truncate:
             sequence = sequence[:self.max_length - 2]
 
         length = len(sequence)
-        multilabel = [0] * self.num_classes
-        anno_term_list = self.labels[idx]
-        for t_id in anno_term_list:
-            if t_id in self.label2id:
-                label_idx = self.label2id[t_id]
-                multilabel[label_idx] = 1
-
-        token_ids = self.tokenizer.gen_token_ids(sequence)
-        return token_ids, length, multilabel
+        if self.token_store is not None:
+            token_ids = np.empty(length + 2, dtype=np.int64)
+            token_ids[0] = self.tokenizer.start_token_id
+            token_ids[1:-1] = sequence
+            token_ids[-1] = self.tokenizer.end_token_id
+        else:
+            token_ids = self.tokenizer.gen_token_ids(sequence)
+        return token_ids, length, label_indices(self.label_mat, idx)
 
     def collate_fn(self, examples):
         # 从独立样本集合中构建batch输入输出
-        inputs = [torch.tensor(ex[0]) for ex in examples]
+        inputs = [torch.as_tensor(ex[0]) for ex in examples]
         lengths = [ex[1] for ex in examples]
         targets = [ex[2] for ex in examples]
 
@@ -198,16 +243,15 @@ class ProtSeqDataset(Dataset):
                               padding_value=self.tokenizer.padding_token_id)
         encoded_inputs = {'input_ids': inputs}
         encoded_inputs['lengths'] = torch.tensor(lengths, dtype=torch.int)
-        encoded_inputs['labels'] = torch.tensor(targets, dtype=torch.int)
+        encoded_inputs['labels'] = collate_labels(targets,
+                                                  self.num_classes,
+                                                  dtype=torch.int)
         return encoded_inputs
 
     def load_dataset(self, data_path, term_path):
-        df = pd.read_pickle(data_path)
-        terms_df = pd.read_pickle(term_path)
-        terms = terms_df['terms'].values.flatten()
-
-        prot_seqs = list(df['sequences'])
-        anno_terms = list(df['prop_annotations'])
+        prot_seqs, anno_terms = read_columns(data_path,
+                                             ['sequences', 'prop_annotations'])
+        terms = read_terms(term_path)
         assert len(prot_seqs) == len(anno_terms)
         return prot_seqs, anno_terms, terms
 
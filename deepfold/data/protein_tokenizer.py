@@ -3,6 +3,7 @@ from abc import ABC, abstractmethod
 from collections import OrderedDict, defaultdict
 from typing import List
 
+import numpy as np
 from tokenizers import ByteLevelBPETokenizer
 
 IUPAC_CODES = OrderedDict([('Ala', 'A'), ('Asx', 'B'), ('Cys', 'C'),
@@ -142,6 +143,15 @@ class ProteinTokenizer(Tokenizer):
                                   ('X', 27), ('Y', 28), ('Z', 29)])
         self.tokens = list(self.vocab.keys())
 
+    def encode_table(self):
+        """Token id of every ASCII character, tokenizes a whole dataset at
+        once in `deepfold.data.utils.token_store`."""
+        table = np.full(256, self.unknown_token_id, dtype=np.int64)
+        for token, token_id in self.vocab.items():
+            if len(token) == 1:
+                table[ord(token)] = token_id
+        return table
+
     def tokenize(self, sequence):
         """Split the sequence into token list.
 
@@ -0,0 +1,290 @@
+import logging
+import math
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import BatchSampler, Sampler
+
+logger = logging.getLogger(__name__)
+
+
+def padding_efficiency(batches, lengths):
+    """Fraction of the padded batch tensors that holds real tokens."""
+    lengths = np.asarray(lengths)
+    num_tokens = 0
+    num_padded = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        num_tokens += int(batch_lengths.sum())
+        num_padded += len(batch) * int(batch_lengths.max())
+    return num_tokens / max(num_padded, 1)
+
+
+def distribute_batches(batches, num_replicas, rank):
+    """Batches of one process, every process gets the same number.
+
+    The batch list is padded by repeating batches from its start up to a
+    multiple of `num_replicas`, then dealt out round-robin.
+    """
+    total_size = math.ceil(len(batches) / num_replicas) * num_replicas
+    if batches:
+        repeats = math.ceil(total_size / len(batches))
+        batches = (batches * repeats)[:total_size]
+    return batches[rank:total_size:num_replicas]
+
+
+def batch_order(batch_sampler):
+    """Sample indices in the order a batch sampler yields them, outputs
+    computed in that order are restored with ``outputs[np.argsort(order)]``.
+    """
+    return np.concatenate(
+        [np.asarray(batch, dtype=np.int64) for batch in batch_sampler])
+
+
+class EpochBatchSampler(BatchSampler):
+    """`BatchSampler` that forwards `set_epoch` to its sampler.
+
+    Used as the sampler of a DataLoader with ``batch_size=None`` for
+    datasets indexed with a whole batch of indices at once.
+    """
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of sequences of similar length.
+
+    The samples are sorted by length (ties broken at random) and split into
+    `num_buckets` buckets of equal size. Every epoch the samples are shuffled
+    inside their bucket, cut into batches, and the batches of all buckets
+    are shuffled together, so a batch only pads up to the longest sequence
+    of its bucket while the batch order stays random. The permutation only
+    depends on `seed` and the epoch set with `set_epoch`.
+
+    Args:
+        lengths: length of every sample of the dataset.
+        batch_size: number of samples per batch.
+        num_buckets: number of length buckets.
+        shuffle: shuffle within and across buckets, otherwise the batches
+            are yielded from the shortest to the longest sequences.
+        drop_last: drop the last incomplete batch of every bucket.
+        seed: random seed shared by all processes.
+    """
+    def __init__(self,
+                 lengths,
+                 batch_size,
+                 num_buckets=16,
+                 shuffle=True,
+                 drop_last=False,
+                 seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_buckets = max(1, min(num_buckets, len(self.lengths)))
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_batches(self):
+        """Batches of the current epoch, as lists of sample indices."""
+        rng = np.random.RandomState(self.seed + self.epoch)
+        if self.shuffle:
+            order = np.lexsort((rng.rand(len(self.lengths)), self.lengths))
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+
+        batches = []
+        for bucket in np.array_split(order, self.num_buckets):
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            for start in range(0, len(bucket), self.batch_size):
+                batch = bucket[start:start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def log_padding_efficiency(self, batches):
+        efficiency = padding_efficiency(batches, self.lengths)
+        logger.info(f'Epoch {self.epoch}: {len(batches)} length-bucketed '
+                    f'batches, padding efficiency {efficiency:.3f}')
+
+    def __iter__(self):
+        batches = self.get_batches()
+        self.log_padding_efficiency(batches)
+        return iter(batches)
+
+    def __len__(self):
+        bucket_sizes = [
+            len(bucket) for bucket in np.array_split(
+                np.arange(len(self.lengths)), self.num_buckets)
+        ]
+        if self.drop_last:
+            return sum(size // self.batch_size for size in bucket_sizes)
+        return sum(math.ceil(size / self.batch_size) for size in bucket_sizes)
+
+
+class DistributedBucketBatchSampler(BucketBatchSampler):
+    """Length-bucketed batches split across distributed processes.
+
+    Every process builds the same batch list from the shared seed and takes
+    every `num_replicas`-th batch. The list is padded by repeating batches
+    from its start, so all processes run the same number of steps.
+
+    Args:
+        lengths: length of every sample of the dataset.
+        batch_size: number of samples per batch and process.
+        num_replicas: number of processes, defaults to the world size.
+        rank: rank of the current process, defaults to the global rank.
+        **kwargs: see `BucketBatchSampler`.
+    """
+    def __init__(self,
+                 lengths,
+                 batch_size,
+                 num_replicas=None,
+                 rank=None,
+                 **kwargs):
+        super().__init__(lengths, batch_size, **kwargs)
+        if num_replicas is None:
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            rank = dist.get_rank()
+        if rank >= num_replicas or rank < 0:
+            raise ValueError(f'Invalid rank {rank}, rank should be in the '
+                             f'interval [0, {num_replicas - 1}]')
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        batches = distribute_batches(self.get_batches(), self.num_replicas,
+                                     self.rank)
+        if self.rank == 0:
+            self.log_padding_efficiency(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return math.ceil(super().__len__() / self.num_replicas)
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Batches holding up to `max_tokens` padded tokens.
+
+    The samples are sorted by length (ties broken at random) and packed
+    greedily, so a batch holds many short or few long sequences, as with
+    the `toks_per_batch` batching of ESM. The cost of a batch of `n`
+    sequences padded to length `L` is ``n * (T + attention_cost * T ** 2)``
+    with ``T = L + special_tokens`` the padded token count, a positive
+    `attention_cost` accounts for the quadratic cost of self attention and
+    shrinks the batches of long sequences further. A sequence over the
+    budget on its own forms a batch of one. The batches are
+    shuffled with `seed` + epoch; in distributed mode every process gets
+    the same number of batches.
+
+    Args:
+        lengths: length of every sample of the dataset.
+        max_tokens: token budget of a batch.
+        max_batch_size: optional upper bound on the number of samples.
+        attention_cost: weight of the quadratic attention term.
+        special_tokens: number of tokens added to every sequence, e.g. the
+            `<cls>` and `<eos>` tokens of ESM.
+        shuffle: shuffle the batches, otherwise they are yielded from the
+            shortest to the longest sequences.
+        seed: random seed shared by all processes.
+        num_replicas: number of processes, defaults to the world size in
+            distributed mode and 1 otherwise.
+        rank: rank of the current process.
+    """
+    def __init__(self,
+                 lengths,
+                 max_tokens,
+                 max_batch_size=None,
+                 attention_cost=0.0,
+                 special_tokens=2,
+                 shuffle=True,
+                 seed=0,
+                 num_replicas=None,
+                 rank=None):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.attention_cost = attention_cost
+        self.special_tokens = special_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized(
+            ) else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+        if rank >= num_replicas or rank < 0:
+            raise ValueError(f'Invalid rank {rank}, rank should be in the '
+                             f'interval [0, {num_replicas - 1}]')
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # the packing only depends on the sorted lengths, so the number of
+        # batches is the same for every epoch
+        self.num_batches = len(
+            self.pack(np.argsort(self.lengths, kind='stable')))
+        num_oversized = int(
+            (self.batch_cost(1, self.lengths) > self.max_tokens).sum())
+        if num_oversized > 0:
+            logger.warning(f'{num_oversized} sequences exceed the token '
+                           f'budget of {max_tokens} on their own')
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batch_cost(self, batch_size, max_length):
+        num_tokens = max_length + self.special_tokens
+        return batch_size * (num_tokens + self.attention_cost * num_tokens**2)
+
+    def pack(self, order):
+        """Greedily cut the length-sorted `order` into batches."""
+        batches = []
+        start = 0
+        for end in range(1, len(order) + 1):
+            size = end - start
+            if size == 1:
+                continue
+            over_budget = self.batch_cost(
+                size, self.lengths[order[end - 1]]) > self.max_tokens
+            if over_budget or (self.max_batch_size is not None
+                               and size > self.max_batch_size):
+                batches.append(order[start:end - 1].tolist())
+                start = end - 1
+        if start < len(order):
+            batches.append(order[start:].tolist())
+        return batches
+
+    def get_batches(self):
+        """Batches of the current epoch, as lists of sample indices."""
+        rng = np.random.RandomState(self.seed + self.epoch)
+        if self.shuffle:
+            order = np.lexsort((rng.rand(len(self.lengths)), self.lengths))
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+        batches = self.pack(order)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.get_batches()
+        if self.num_replicas > 1:
+            batches = distribute_batches(batches, self.num_replicas, self.rank)
+        if self.rank == 0:
+            efficiency = padding_efficiency(batches, self.lengths)
+            logger.info(f'Epoch {self.epoch}: {len(batches)} batches of up '
+                        f'to {self.max_tokens} tokens, padding efficiency '
+                        f'{efficiency:.3f}')
+        return iter(batches)
+
+    def __len__(self):
+        return math.ceil(self.num_batches / self.num_replicas)
@@ -2,11 +2,20 @@ import os
 import random
 from typing import Dict
 
-import pandas as pd
+import numpy as np
 import torch
 from allennlp.modules.elmo import batch_to_ids
 from torch.utils.data import Dataset
 
+from deepfold.data.utils.columnar import (read_columns, read_terms,
+                                          resolve_data_file)
+from deepfold.data.utils.label_matrix import (collate_labels, label_indices,
+                                              load_label_matrix)
+from deepfold.data.utils.token_store import load_token_store
+
+# residues are stored as their ASCII code
+CHAR_TABLE = np.minimum(np.arange(256), 127)
+
 
 class Seq2VecDataset(Dataset):
     """Seq2vec Dataset."""
@@ -15,10 +24,11 @@ class Seq2VecDataset(Dataset):
                  file_name: str = 'xxx.pkl',
                  max_length: int = 1024,
                  truncate: bool = False,
-                 random_crop: bool = False):
+                 random_crop: bool = False,
+                 use_token_store: bool = True):
         super().__init__()
 
-        self.file_path = os.path.join(data_path, file_name)
+        self.file_path = resolve_data_file(os.path.join(data_path, file_name))
         self.terms_path = os.path.join(data_path, 'terms.pkl')
 
         self.seqs, self.labels, self.terms = self.load_dataset(
@@ -26,36 +36,48 @@ class Seq2VecDataset(Dataset):
 
         self.terms_dict = {v: i for i, v in enumerate(self.terms)}
         self.num_classes = len(self.terms)
+        self.label_mat = load_label_matrix(self.file_path, self.terms,
+                                           self.labels)
         self.max_length = max_length
         self.truncate = truncate
         self.random_crop = random_crop
 
+        self.token_store = None
+        self.char_ids = None
+        if use_token_store:
+            self.token_store = load_token_store(self.file_path, self.seqs,
+                                                'seq2vec_chars', CHAR_TABLE)
+
     def __len__(self):
         return len(self.labels)
 
+    @property
+    def lengths(self):
+        """Number of residues of every sample, used to bucket batches."""
+        if self.token_store is not None:
+            lengths = self.token_store.lengths
+        else:
+            lengths = np.array([len(seq) for seq in self.seqs])
+        if self.truncate or self.random_crop:
+            lengths = np.minimum(lengths, self.max_length - 2)
+        return lengths
+
     def __getitem__(self, idx):
 
-        sequence = self.seqs[idx]
+        if self.token_store is not None:
+            sequence = self.token_store[idx]
+        else:
+            sequence = self.seqs[idx]
         if self.random_crop:
             sequence = crop_sequence(sequence, crop_length=self.max_length - 2)
         if self.truncate:
             sequence = sequence[:self.max_length - 2]
 
-        label_list = self.labels[idx]
-        multilabel = [0] * self.num_classes
-        for t_id in label_list:
-            if t_id in self.terms_dict:
-                label_idx = self.terms_dict[t_id]
-                multilabel[label_idx] = 1
-        return sequence, multilabel
+        return sequence, label_indices(self.label_mat, idx)
 
     def load_dataset(self, data_path, term_path):
-        df = pd.read_pickle(data_path)
-        terms_df = pd.read_pickle(term_path)
-        terms = terms_df['terms'].values.flatten()
-
-        seq = list(df['sequences'])
-        label = list(df['prop_annotations'])
+        seq, label = read_columns(data_path, ['sequences', 'prop_annotations'])
+        terms = read_terms(term_path)
         assert len(seq) == len(label)
         return seq, label, terms
 
@@ -65,7 +87,10 @@ class Seq2VecDataset(Dataset):
         sequences_list = [ex[0] for ex in examples]
         multilabel_list = [ex[1] for ex in examples]
 
-        all_tokens = batch_to_ids(sequences_list)
+        if self.token_store is not None:
+            all_tokens = self.chars_to_ids(sequences_list)
+        else:
+            all_tokens = batch_to_ids(sequences_list)
 
         if self.truncate:
             all_tokens = all_tokens[:, :self.max_length]
@@ -74,10 +99,27 @@ class Seq2VecDataset(Dataset):
         encoded_inputs = {
             'inputs': all_tokens,
         }
-        encoded_inputs['labels'] = torch.tensor(multilabel_list,
-                                                dtype=torch.int)
+        encoded_inputs['labels'] = collate_labels(multilabel_list,
+                                                  self.num_classes,
+                                                  dtype=torch.int)
         return encoded_inputs
 
+    def chars_to_ids(self, chars_list):
+        """`batch_to_ids` of pre-tokenized sequences, the elmo character ids
+        of every residue are looked up in a (128, 50) table."""
+        if self.char_ids is None:
+            self.char_ids = batch_to_ids([[chr(c) for c in range(128)]])[0]
+        max_len = max(len(chars) for chars in chars_list)
+        all_chars = torch.zeros((len(chars_list), max_len), dtype=torch.int64)
+        mask = torch.zeros((len(chars_list), max_len), dtype=torch.bool)
+        for i, chars in enumerate(chars_list):
+            all_chars[i, :len(chars)] = torch.from_numpy(chars.astype(
+                np.int64))
+            mask[i, :len(chars)] = True
+        all_tokens = self.char_ids[all_chars]
+        all_tokens[~mask] = 0
+        return all_tokens
+
 
 def crop_sequence(sequence: str, crop_length: int) -> str:
     """If the length of the sequence is superior to crop_length, crop randomly
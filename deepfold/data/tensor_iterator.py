@@ -0,0 +1,180 @@
+import logging
+import math
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+
+class SparseRows(object):
+    """Csr matrix held as tensors, rows are densified per batch.
+
+    Args:
+        indptr: (num_rows + 1, ) row pointers.
+        indices: column index of every non-zero.
+        num_cols: number of columns of the dense rows.
+        dtype: dtype of the dense rows.
+    """
+    def __init__(self, indptr, indices, num_cols, dtype=torch.long):
+        self.indptr = indptr
+        self.indices = indices
+        self.num_cols = num_cols
+        self.dtype = dtype
+
+    @classmethod
+    def from_csr(cls, csr_mat, dtype=torch.long, device=None):
+        return cls(
+            torch.as_tensor(csr_mat.indptr.astype(np.int64), device=device),
+            torch.as_tensor(csr_mat.indices.astype(np.int64), device=device),
+            csr_mat.shape[1], dtype)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, rows):
+        """Dense (len(rows), num_cols) rows."""
+        if isinstance(rows, slice):
+            rows = torch.arange(*rows.indices(len(self)),
+                                device=self.indptr.device)
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        dense = torch.zeros((len(rows), self.num_cols),
+                            dtype=self.dtype,
+                            device=self.indptr.device)
+        total = int(counts.sum())
+        if total > 0:
+            batch_rows = torch.repeat_interleave(
+                torch.arange(len(rows), device=dense.device), counts)
+            # position of every non-zero inside its row
+            row_starts = torch.cumsum(counts, 0) - counts
+            inner = torch.arange(
+                total,
+                device=dense.device) - row_starts.repeat_interleave(counts)
+            cols = self.indices[starts.repeat_interleave(counts) + inner]
+            dense[batch_rows, cols] = 1
+        return dense
+
+
+class TensorBatchIterator(object):
+    """DataLoader-free batches of tensors held in (device) memory.
+
+    For heads trained on precomputed features that fit in memory: the
+    features and labels live on the training device, every epoch draws one
+    permutation and a batch is a single gather per tensor, with no workers,
+    per-sample fetch or collate. It yields the same dicts as the
+    DataLoaders of the dataset and plugs into `trainer.training.train_loop`
+    (`len`, `set_epoch`). In distributed mode every process takes an equal
+    share of the permutation, as `DistributedSampler`.
+
+    Args:
+        tensors: dict name -> tensor (or `SparseRows`), same number of rows.
+        batch_size: number of samples per batch.
+        shuffle: draw a new permutation every epoch.
+        drop_last: drop the last incomplete batch.
+        seed: random seed shared by all processes.
+        num_replicas: number of processes, defaults to the world size in
+            distributed mode and 1 otherwise.
+        rank: rank of the current process.
+    """
+    def __init__(self,
+                 tensors,
+                 batch_size,
+                 shuffle=True,
+                 drop_last=False,
+                 seed=0,
+                 num_replicas=None,
+                 rank=None):
+        self.tensors = tensors
+        first = next(iter(tensors.values()))
+        self.num_samples = len(first)
+        self.device = first.indptr.device if isinstance(
+            first, SparseRows) else first.device
+        if any(len(val) != self.num_samples for val in tensors.values()):
+            raise ValueError('All tensors must have the same number of rows')
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized(
+            ) else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    @classmethod
+    def from_dataset(cls, dataset, batch_size, device=None, **kwargs):
+        """Iterator over the embeddings and labels of an
+        `EmbeddingDataset`."""
+        embeddings = torch.as_tensor(np.asarray(dataset.embeddings),
+                                     device=device)
+        tensors = {
+            'embeddings': embeddings.float(),
+            'labels': SparseRows.from_csr(dataset.label_mat, device=device)
+        }
+        logger.info(f'Holding {embedding_dataset_nbytes(dataset) / 2**20:.1f}'
+                    f' MB of embeddings and labels on {embeddings.device}')
+        return cls(tensors, batch_size, **kwargs)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def num_local_samples(self):
+        return math.ceil(self.num_samples / self.num_replicas)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_local_samples() // self.batch_size
+        return math.ceil(self.num_local_samples() / self.batch_size)
+
+    def local_indices(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.num_samples, generator=generator)
+        else:
+            indices = torch.arange(self.num_samples)
+        if self.num_replicas > 1:
+            total_size = self.num_local_samples() * self.num_replicas
+            indices = indices.repeat(math.ceil(total_size /
+                                               self.num_samples))[:total_size]
+            indices = indices[self.rank:total_size:self.num_replicas]
+        return indices
+
+    def __iter__(self):
+        indices = self.local_indices()
+        contiguous = not self.shuffle and self.num_replicas == 1
+        indices = indices.to(self.device)
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            if contiguous:
+                rows = slice(start, start + self.batch_size)
+            else:
+                rows = indices[start:start + self.batch_size]
+            yield {key: val[rows] for key, val in self.tensors.items()}
+
+
+def fits_in_memory(num_bytes, device, fraction=0.5):
+    """Whether `num_bytes` fit in `fraction` of the free memory of
+    `device`."""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+    else:
+        try:
+            free = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            return False
+    return num_bytes <= fraction * free
+
+
+def embedding_dataset_nbytes(dataset):
+    """Memory of an `EmbeddingDataset` held as float32 tensors."""
+    num_rows, dim = dataset.embeddings.shape
+    label_mat = dataset.label_mat
+    return 4 * num_rows * dim + 8 * (len(label_mat.indptr) +
+                                     len(label_mat.indices))
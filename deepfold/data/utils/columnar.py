@@ -0,0 +1,307 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+META_FILE = 'meta.json'
+STORE_SUFFIX = '.columns'
+COLUMN_KINDS = ['fixed', 'ragged', 'string', 'string_list']
+
+
+class FixedColumn(object):
+    """Column of fixed-shape numeric values, one (num_rows, ...) array."""
+    def __init__(self, store_dir, name, meta):
+        self.name = name
+        self.meta = meta
+        self.values = np.load(os.path.join(store_dir, name + '.npy'),
+                              mmap_mode='r')
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def read(self, start, stop):
+        """Rows `start` to `stop` as one array."""
+        return np.asarray(self.values[start:stop])
+
+
+class RaggedColumn(object):
+    """Column of variable-length numeric arrays, stored back to back with
+    an offsets array, row `i` is ``values[offsets[i]:offsets[i + 1]]``."""
+    def __init__(self, store_dir, name, meta):
+        self.name = name
+        self.meta = meta
+        self.values = np.load(os.path.join(store_dir, name + '.values.npy'),
+                              mmap_mode='r')
+        self.offsets = np.load(os.path.join(store_dir, name + '.offsets.npy'))
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_row(self, idx):
+        return self.values[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.get_row(i) for i in range(*idx.indices(len(self)))]
+        if isinstance(idx, (list, np.ndarray)):
+            return [self.get_row(i) for i in idx]
+        return self.get_row(idx)
+
+    def __iter__(self):
+        return (self.get_row(i) for i in range(len(self)))
+
+    def read(self, start, stop):
+        """Rows `start` to `stop` with a single read of the values."""
+        stop = min(stop, len(self))
+        offsets = self.offsets[start:stop + 1]
+        values = np.asarray(self.values[offsets[0]:offsets[-1]])
+        return np.split(values, offsets[1:-1] - offsets[0])
+
+
+class StringColumn(RaggedColumn):
+    """Column of strings, stored as utf-8 bytes with offsets."""
+    def get_row(self, idx):
+        row = self.values[self.offsets[idx]:self.offsets[idx + 1]]
+        return row.tobytes().decode()
+
+    def read(self, start, stop):
+        return [row.tobytes().decode() for row in super().read(start, stop)]
+
+
+class StringListColumn(RaggedColumn):
+    """Column of lists of strings (e.g. GO annotations), stored as int32
+    codes into the vocabulary of the column with offsets."""
+    def __init__(self, store_dir, name, meta):
+        super().__init__(store_dir, name, meta)
+        with open(os.path.join(store_dir, name + '.vocab.json')) as f:
+            self.vocab = json.load(f)
+
+    def get_row(self, idx):
+        return [
+            self.vocab[code]
+            for code in self.values[self.offsets[idx]:self.offsets[idx + 1]]
+        ]
+
+    def read(self, start, stop):
+        return [[self.vocab[code] for code in row]
+                for row in super().read(start, stop)]
+
+
+COLUMN_TYPES = {
+    'fixed': FixedColumn,
+    'ragged': RaggedColumn,
+    'string': StringColumn,
+    'string_list': StringListColumn,
+}
+
+
+class ColumnStore(object):
+    """Columnar on-disk table, the replacement of the pandas pickles.
+
+    A store is a directory with one or a few `.npy` files per column and a
+    ``meta.json`` header listing the columns, their kind and the content
+    digest of the store. Columns are only opened when they are accessed and
+    their arrays are memory-mapped, so opening a store is instant and a
+    dataset only reads the rows and columns it touches. Every column
+    behaves like a read-only list (`len`, `[idx]`, iteration) and
+    `read(start, stop)` reads a row group at once.
+
+    Column kinds:
+
+    - `fixed`: numeric values of the same shape (embeddings, dense labels),
+    - `ragged`: variable-length numeric arrays (per-residue features),
+    - `string`: strings (protein ids, sequences),
+    - `string_list`: lists of strings (GO annotations).
+
+    Args:
+        store_dir: directory of the store, see `write`.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        self._columns = {}
+
+    @staticmethod
+    def exists(store_dir):
+        return os.path.exists(os.path.join(store_dir, META_FILE))
+
+    @property
+    def columns(self):
+        return list(self.meta['columns'])
+
+    def __len__(self):
+        return self.meta['num_rows']
+
+    def __contains__(self, name):
+        return name in self.meta['columns']
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            if name not in self.meta['columns']:
+                raise KeyError(f'{name} is not a column of {self.store_dir}')
+            meta = self.meta['columns'][name]
+            self._columns[name] = COLUMN_TYPES[meta['kind']](self.store_dir,
+                                                             name, meta)
+        return self._columns[name]
+
+    def read_rows(self, start, stop, columns=None):
+        """Row group `start` to `stop` as a DataFrame."""
+        columns = columns or self.columns
+        data = {}
+        for name in columns:
+            rows = self[name].read(start, stop)
+            if isinstance(rows, np.ndarray) and rows.ndim > 1:
+                rows = list(rows)
+            data[name] = rows
+        return pd.DataFrame(data)
+
+    def to_pandas(self, columns=None):
+        return self.read_rows(0, len(self), columns)
+
+    @classmethod
+    def write(cls, df, store_dir, columns=None, overwrite=False):
+        """Write the columns of a DataFrame as a column store."""
+        if cls.exists(store_dir) and not overwrite:
+            raise FileExistsError(f'{store_dir} already holds a column store')
+        os.makedirs(store_dir, exist_ok=True)
+        columns = columns or list(df.columns)
+        digest = hashlib.blake2b(digest_size=16)
+        meta = {'num_rows': len(df), 'columns': {}}
+        for name in columns:
+            arrays, column_meta = encode_column(df[name])
+            for suffix, array in arrays.items():
+                np.save(os.path.join(store_dir, name + suffix), array)
+                digest.update(name.encode() + suffix.encode())
+                digest.update(np.ascontiguousarray(array).tobytes())
+            if 'vocab' in column_meta:
+                vocab = column_meta.pop('vocab')
+                with open(os.path.join(store_dir, name + '.vocab.json'),
+                          'w') as f:
+                    json.dump(vocab, f)
+                digest.update(json.dumps(vocab).encode())
+            meta['columns'][name] = column_meta
+        meta['digest'] = digest.hexdigest()
+        # the header is written last, it marks the store as complete
+        with open(os.path.join(store_dir, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+        return cls(store_dir)
+
+
+def _is_string_list(value):
+    return isinstance(value, (list, tuple, set, frozenset)) and all(
+        isinstance(v, str) for v in value)
+
+
+def encode_column(series):
+    """Arrays and header of one column, see `ColumnStore` for the kinds."""
+    values = list(series)
+    first = next((v for v in values if v is not None), None)
+    if isinstance(first, str):
+        encoded = [v.encode() for v in values]
+        return _ragged_arrays(np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                              [len(v) for v in encoded]), {
+                                  'kind': 'string'
+                              }
+    if first is not None and _is_string_list(first) and all(
+            _is_string_list(v) for v in values):
+        rows = [
+            sorted(v) if isinstance(v, (set, frozenset)) else list(v)
+            for v in values
+        ]
+        vocab = sorted(set(t for row in rows for t in row))
+        codes = {t: i for i, t in enumerate(vocab)}
+        flat = np.fromiter((codes[t] for row in rows for t in row),
+                           dtype=np.int32,
+                           count=sum(len(row) for row in rows))
+        return _ragged_arrays(flat, [len(row) for row in rows]), {
+            'kind': 'string_list',
+            'vocab': vocab
+        }
+
+    try:
+        arrays = [np.asarray(v) for v in values]
+    except (TypeError, ValueError):
+        arrays = None
+    if arrays is None or any(a.dtype == object for a in arrays):
+        raise ValueError(f'Column {series.name} can not be stored in a '
+                         f'column store, supported kinds are {COLUMN_KINDS}')
+    if len(set(a.shape for a in arrays)) <= 1:
+        array = np.stack(arrays) if arrays else np.empty(0)
+        return {
+            '.npy': array
+        }, {
+            'kind': 'fixed',
+            'dtype': array.dtype.name,
+            'shape': list(array.shape[1:])
+        }
+    if any(a.ndim == 0 for a in arrays):
+        raise ValueError(f'Column {series.name} mixes scalars and arrays')
+    values = np.concatenate(arrays)
+    return _ragged_arrays(values, [len(a) for a in arrays]), {
+        'kind': 'ragged',
+        'dtype': values.dtype.name,
+        'shape': list(values.shape[1:])
+    }
+
+
+def _ragged_arrays(values, lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return {'.values.npy': values, '.offsets.npy': offsets}
+
+
+def store_path(file_path):
+    """Column store of a pickle file, `xxx.pkl` -> `xxx.columns`."""
+    return os.path.splitext(file_path)[0] + STORE_SUFFIX
+
+
+def resolve_data_file(file_path):
+    """The column store converted from `file_path` if there is one."""
+    if ColumnStore.exists(file_path):
+        return file_path
+    if ColumnStore.exists(store_path(file_path)):
+        return store_path(file_path)
+    return file_path
+
+
+def read_columns(file_path, columns):
+    """List-like columns of a pickled DataFrame or of a column store.
+
+    Column store columns are read lazily, pickles are loaded whole.
+    """
+    file_path = resolve_data_file(file_path)
+    if ColumnStore.exists(file_path):
+        store = ColumnStore(file_path)
+        return [store[name] for name in columns]
+    df = pd.read_pickle(file_path)
+    return [list(df[name]) for name in columns]
+
+
+def read_terms(terms_file):
+    """GO terms of `terms.pkl` or of its column store."""
+    terms_file = resolve_data_file(terms_file)
+    if ColumnStore.exists(terms_file):
+        store = ColumnStore(terms_file)
+        return np.asarray(store['terms'].read(0, len(store)), dtype=object)
+    terms_df = pd.read_pickle(terms_file)
+    return terms_df['terms'].values.flatten()
+
+
+def convert_pickle(file_in, store_dir=None, columns=None, overwrite=False):
+    """Convert a pickled DataFrame into a column store."""
+    store_dir = store_dir or store_path(file_in)
+    df = pd.read_pickle(file_in)
+    return ColumnStore.write(df, store_dir, columns, overwrite=overwrite)
@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import os
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+
+logger = logging.getLogger(__name__)
+
+LABEL_CACHE_DIR = '.label_cache'
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    """Content hash of a file, or of the header of a column store directory
+    (which holds the digest of its columns)."""
+    if os.path.isdir(file_path):
+        file_path = os.path.join(file_path, 'meta.json')
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def terms_digest(terms):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update('\n'.join(str(t) for t in terms).encode())
+    return digest.hexdigest()
+
+
+def build_label_matrix(annotations, terms):
+    """Binary (num_proteins, num_terms) csr matrix of GO annotations.
+
+    Annotations that are not in `terms` are ignored, as in the datasets.
+
+    :param annotations: list of annotated GO terms per protein
+    :param terms: GO terms of the classifier, the column order
+    """
+    terms_dict = {v: i for i, v in enumerate(terms)}
+    indptr = [0]
+    indices = []
+    for annots in annotations:
+        indices.extend(
+            sorted(set(terms_dict[t] for t in annots if t in terms_dict)))
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.uint8)
+    return sp.csr_matrix(
+        (data, np.asarray(indices, dtype=np.int32), np.asarray(indptr)),
+        shape=(len(indptr) - 1, len(terms)))
+
+
+def load_label_matrix(data_file, terms, annotations, cache_dir=None):
+    """Label matrix of `data_file`, cached on disk.
+
+    The cache key is the content hash of the data file and of the term list,
+    so the cache is rebuilt whenever either changes.
+
+    :param data_file: data file the annotations were read from
+    :param terms: GO terms of the classifier, the column order
+    :param annotations: list of annotated GO terms per protein, or a
+        callable returning it (only called on a cache miss)
+    :param cache_dir: cache directory, defaults to `.label_cache` next to
+        the data file
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(data_file), LABEL_CACHE_DIR)
+    key = file_digest(data_file) + '_' + terms_digest(terms)
+    cache_file = os.path.join(
+        cache_dir,
+        os.path.basename(data_file) + '.' + key + '.labels.npz')
+    if os.path.exists(cache_file):
+        return sp.load_npz(cache_file).tocsr()
+
+    if callable(annotations):
+        annotations = annotations()
+    label_mat = build_label_matrix(annotations, terms)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + '.' + str(os.getpid()) + '.tmp.npz'
+        sp.save_npz(tmp_file, label_mat)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logger.warning(f'Could not cache the label matrix: {e}')
+    return label_mat
+
+
+def label_indices(label_mat, idx):
+    """Term indices of row `idx` of a csr label matrix."""
+    return label_mat.indices[label_mat.indptr[idx]:label_mat.indptr[idx + 1]]
+
+
+def collate_labels(index_list, num_classes, dtype=torch.int):
+    """Scatter the term indices of a batch into a dense multi-hot tensor."""
+    labels = torch.zeros((len(index_list), num_classes), dtype=dtype)
+    lengths = [len(indices) for indices in index_list]
+    if sum(lengths) > 0:
+        rows = torch.repeat_interleave(torch.arange(len(index_list)),
+                                       torch.tensor(lengths))
+        cols = torch.from_numpy(
+            np.concatenate(index_list).astype(np.int64, copy=False))
+        labels[rows, cols] = 1
+    return labels
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from deepfold.data.utils.label_matrix import file_digest
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CACHE_DIR = '.token_cache'
+META_FILE = 'meta.json'
+TOKENS_FILE = 'tokens.bin'
+OFFSETS_FILE = 'offsets.npy'
+
+
+def encode_sequences(sequences, encode_table):
+    """Tokenize all sequences at once with a per-character lookup table.
+
+    :param sequences: list of protein sequences
+    :param encode_table: (256,) array, token id of every ASCII character
+    :return: concatenated token ids, (len(sequences) + 1,) offsets
+    """
+    lengths = np.fromiter((len(s) for s in sequences),
+                          dtype=np.int64,
+                          count=len(sequences))
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    buffer = ''.join(sequences).encode('ascii', errors='replace')
+    tokens = encode_table[np.frombuffer(buffer, dtype=np.uint8)]
+    return tokens, offsets
+
+
+def token_dtype(encode_table):
+    return np.int8 if int(encode_table.max()) < 128 else np.int16
+
+
+class TokenStore(object):
+    """Packed token ids of a whole dataset.
+
+    The tokens of all sequences are stored back to back in one int8/int16
+    buffer (`tokens.bin`) with an offsets array (`offsets.npy`), so the
+    tokens of sequence `i` are ``tokens[offsets[i]:offsets[i + 1]]``. Only
+    the residue tokens are stored, special tokens are added by the
+    datasets, and random cropping / truncation are plain slicing. The
+    buffer is memory-mapped, so DataLoader workers share its pages.
+    """
+    def __init__(self, tokens, offsets, meta=None):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.meta = meta or {}
+
+    @classmethod
+    def open(cls, store_dir):
+        with open(os.path.join(store_dir, META_FILE)) as f:
+            meta = json.load(f)
+        offsets = np.load(os.path.join(store_dir, OFFSETS_FILE))
+        if meta['num_tokens'] == 0:
+            tokens = np.empty(0, dtype=meta['dtype'])
+        else:
+            tokens = np.memmap(os.path.join(store_dir, TOKENS_FILE),
+                               dtype=meta['dtype'],
+                               mode='r',
+                               shape=(meta['num_tokens'], ))
+        return cls(tokens, offsets, meta)
+
+    def save(self, store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        self.tokens.tofile(os.path.join(store_dir, TOKENS_FILE))
+        np.save(os.path.join(store_dir, OFFSETS_FILE), self.offsets)
+        # the header is written last, it marks the store as complete
+        with open(os.path.join(store_dir, META_FILE), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.tokens[self.offsets[idx]:self.offsets[idx + 1]]
+
+
+def load_token_store(data_file,
+                     sequences,
+                     tokenizer_name,
+                     encode_table,
+                     cache_dir=None):
+    """Token store of the sequences of `data_file` for one tokenizer.
+
+    The store is built on the first call and cached next to the data file,
+    keyed by the content hash of the data file, the tokenizer name and its
+    lookup table.
+
+    :param data_file: data file the sequences were read from
+    :param sequences: list of sequences, or a callable returning it (only
+        called when the store has to be built)
+    :param tokenizer_name: name of the tokenizer, part of the cache key
+    :param encode_table: (256,) array, token id of every ASCII character
+    :param cache_dir: cache directory, defaults to `.token_cache` next to
+        the data file
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(data_file), TOKEN_CACHE_DIR)
+    encode_table = np.asarray(encode_table)
+    table_digest = hashlib.blake2b(encode_table.astype(np.int64).tobytes(),
+                                   digest_size=8).hexdigest()
+    key = file_digest(data_file) + '_' + tokenizer_name + '_' + table_digest
+    store_dir = os.path.join(cache_dir,
+                             os.path.basename(data_file) + '.' + key)
+    if os.path.exists(os.path.join(store_dir, META_FILE)):
+        return TokenStore.open(store_dir)
+
+    if callable(sequences):
+        sequences = sequences()
+    tokens, offsets = encode_sequences(sequences, encode_table)
+    tokens = tokens.astype(token_dtype(encode_table))
+    meta = {
+        'tokenizer': tokenizer_name,
+        'dtype': np.dtype(tokens.dtype).name,
+        'num_sequences': len(sequences),
+        'num_tokens': int(offsets[-1])
+    }
+    store = TokenStore(tokens, offsets, meta)
+    try:
+        # build in a private directory first, concurrent builders (e.g. one
+        # per distributed rank) then race on an atomic rename
+        tmp_dir = store_dir + '.' + str(os.getpid()) + '.tmp'
+        store.save(tmp_dir)
+        try:
+            os.rename(tmp_dir, store_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return TokenStore.open(store_dir)
+    except OSError as e:
+        logger.warning(f'Could not cache the token store: {e}')
+    return store
@@ -3,12 +3,91 @@ import sys
 import numpy
 from sklearn.metrics import pairwise, pairwise_distances
 
+from deepfold.utils.embedding_db import EmbeddingDB
+
+from .index import SUPPORTED_METRICS, build_index, load_index, topk_smallest
+
 
 class EmbeddingLookup(object):
-    def __init__(self, embedding_db):
+    """Nearest-neighbour lookup of query embeddings in a reference set.
+
+    :param embedding_db: dict protein id -> embedding, or an `EmbeddingDB`
+        whose memory-mapped matrix is used without copying
+    :param index_type: nearest-neighbour index, see `index.build_index`
+    :param rows: optional indices of the reference proteins to look up in,
+        by default all of them
+    """
+    def __init__(self,
+                 embedding_db,
+                 index_type='exact',
+                 rows=None,
+                 **index_kwargs):
         self.embedding_db = embedding_db
         # prepare data
-        self.ids, self.embedding_mat = zip(*self.embedding_db.items())
+        if isinstance(embedding_db, EmbeddingDB):
+            # memory-mapped matrix, only a row subset is gathered
+            self.ids = embedding_db.ids
+            self.embedding_mat = embedding_db.matrix
+        else:
+            self.ids, self.embedding_mat = zip(*self.embedding_db.items())
+            self.embedding_mat = numpy.asarray(self.embedding_mat,
+                                               dtype=numpy.float32)
+        self.rows = rows
+        if rows is not None:
+            rows = numpy.asarray(rows, dtype=numpy.int64)
+            self.ids = [self.ids[i] for i in rows]
+            self.embedding_mat = self.embedding_mat[rows]
+
+        self.index_type = index_type
+        self.index_kwargs = index_kwargs
+        self.index = None
+
+    def build_index(self, metric='euclidean'):
+        """Build the nearest-neighbour index over the lookup database.
+
+        :param metric: metric of the index [euclidean|cosine]
+        :return: the index
+        """
+        index_kwargs = dict(self.index_kwargs)
+        quantized = 'quantized' in (self.index_type,
+                                    index_kwargs.get('shard_type'))
+        if quantized and isinstance(self.embedding_db,
+                                    EmbeddingDB) and self.rows is None:
+            # re-rank from the memory-mapped db once the index is reloaded
+            index_kwargs.setdefault('rerank_db', self.embedding_db.db_dir)
+        self.index = build_index(self.embedding_mat,
+                                 index_type=self.index_type,
+                                 metric=metric,
+                                 **index_kwargs)
+        return self.index
+
+    def save_index(self, index_dir):
+        self.index.save(index_dir)
+
+    def load_index(self, index_dir, mmap=True, **kwargs):
+        """Load a prebuilt index, the index arrays are memory-mapped.
+
+        :param index_dir: directory written by `save_index`
+        :param mmap: memory-map the index arrays instead of reading them
+        :return: the index
+        """
+        self.index = load_index(index_dir, mmap=mmap, **kwargs)
+        assert len(self.index) == len(
+            self.ids), ('Index size does not match the lookup database')
+        return self.index
+
+    @staticmethod
+    def _prepare_querys(querys):
+        if isinstance(querys, dict):
+            query_ids, raw_data_query = zip(*querys.items())
+        else:
+            raw_data_query = querys
+            query_ids = range(0, numpy.shape(querys)[0])
+
+        raw_data_query = numpy.array(raw_data_query).squeeze()
+        if len(query_ids) == 1:
+            raw_data_query = raw_data_query.reshape(1, -1)
+        return raw_data_query, query_ids
 
     def run_embedding_lookup_distance(self, querys, metric):
         """Calculate embedding distance of all querys against the lookup
@@ -20,15 +99,7 @@ class EmbeddingLookup(object):
         """
 
         if metric in pairwise.distance_metrics():
-            if isinstance(querys, dict):
-                query_ids, raw_data_query = zip(*querys.items())
-            else:
-                raw_data_query = querys
-                query_ids = range(0, numpy.shape(querys)[0])
-
-            raw_data_query = numpy.array(raw_data_query).squeeze()
-            if len(query_ids) == 1:
-                raw_data_query = raw_data_query.reshape(1, -1)
+            raw_data_query, query_ids = self._prepare_querys(querys)
 
             distances = pairwise_distances(raw_data_query,
                                            self.embedding_mat,
@@ -39,3 +110,83 @@ class EmbeddingLookup(object):
                      'for all possible distance metrics'.format(metric))
 
         return distances, query_ids
+
+    def run_embedding_lookup_knn(self, querys, metric, k, include_ties=False):
+        """Find the k nearest neighbours of all querys in the lookup database
+        without computing the full distance matrix.
+
+        :param querys: querys for which neighbours should be retrieved
+        :param metric: metric to use to calculate distances, the index
+            supports euclidean and cosine, other sklearn metrics are searched
+            on the full distance matrix
+        :param k: number of neighbours
+        :param include_ties: also return every further neighbour at the same
+            distance as the k-th one, a query can then have more than k hits
+        :return: distances, indices into the lookup database (both sorted by distance), query ids
+        """
+        if metric not in SUPPORTED_METRICS:
+            distances, query_ids = self.run_embedding_lookup_distance(
+                querys, metric)
+            distances, indices = self._knn_from_distances(
+                distances, k, include_ties)
+            return distances, indices, query_ids
+
+        if self.index is None or self.index.metric != metric:
+            self.build_index(metric)
+
+        raw_data_query, query_ids = self._prepare_querys(querys)
+        raw_data_query = numpy.atleast_2d(raw_data_query)
+        distances, indices = self.index.search(raw_data_query, k)
+        if include_ties:
+            distances, indices = self._include_ties(raw_data_query, distances,
+                                                    indices, k)
+        return distances, indices, query_ids
+
+    @staticmethod
+    def _knn_from_distances(distances, k, include_ties):
+        """k nearest neighbours (and their ties) of every row of a query x
+        lookup distance matrix, padded like the index search results."""
+        num_neighbours = min(k, distances.shape[1])
+        if include_ties and num_neighbours > 0:
+            kth = num_neighbours - 1
+            max_dists = numpy.partition(distances, kth, axis=1)[:, kth:kth + 1]
+            num_neighbours = int((distances <= max_dists).sum(axis=1).max())
+        dists, indices = topk_smallest(distances, num_neighbours)
+        if include_ties and num_neighbours > 0:
+            tied = dists <= max_dists
+            dists = numpy.where(tied, dists, numpy.inf)
+            indices = numpy.where(tied, indices, -1)
+        pad = max(k - dists.shape[1], 0)
+        dists = numpy.pad(dists, ((0, 0), (0, pad)), constant_values=numpy.inf)
+        indices = numpy.pad(indices, ((0, 0), (0, pad)), constant_values=-1)
+        return dists, indices
+
+    def _include_ties(self, querys, distances, indices, k):
+        """Widen the search of the querys whose last neighbour is still at
+        the k-th distance until all the ties are found, then drop the
+        neighbours beyond the k-th distance.
+
+        Missing neighbours have index -1 and an infinite distance.
+        """
+        num_neighbours = k
+        while num_neighbours < len(self.ids):
+            max_dists = distances[:, k - 1]
+            open_rows = numpy.nonzero(
+                numpy.isfinite(max_dists)
+                & (distances[:, -1] <= max_dists))[0]
+            if len(open_rows) == 0:
+                break
+            num_neighbours = min(2 * num_neighbours, len(self.ids))
+            pad = num_neighbours - distances.shape[1]
+            distances = numpy.pad(distances, ((0, 0), (0, pad)),
+                                  constant_values=numpy.inf)
+            indices = numpy.pad(indices, ((0, 0), (0, pad)),
+                                constant_values=-1)
+            distances[open_rows], indices[open_rows] = self.index.search(
+                querys[open_rows], num_neighbours)
+
+        tied = (indices >= 0) & (distances <= distances[:, k - 1:k])
+        num_cols = max(k, int(tied.sum(axis=1).max(initial=0)))
+        distances = numpy.where(tied, distances, numpy.inf)[:, :num_cols]
+        indices = numpy.where(tied, indices, -1)[:, :num_cols]
+        return distances, indices
@@ -2,33 +2,102 @@ import sys
 from collections import defaultdict
 
 import numpy
+import scipy.sparse as sp
 
 from .embedding_lookup import EmbeddingLookup
 
+GO_TYPES = ['mfo', 'bpo', 'cco']
 
-class FunctionPrediction(object):
-    def __init__(self, embedding_db, go_annotation, gene_ontology, go_type):
-        self.gen_ontology = gene_ontology
 
-        if go_type == 'all':
-            self.embedding_lookup = EmbeddingLookup(embedding_db)
-            self.go_annotation = go_annotation
-        elif go_type == 'mfo' or go_type == 'bpo' or go_type == 'cco':
-            # only use proteins in the annotation set which actually have an annotation in this ontology
-            self.go_annotation = defaultdict(set)
-            embedding_db_reduced = dict()
-            for k in embedding_db.keys():
-                terms = go_annotation[k]
-                go_terms = self.get_terms_by_go(terms)[go_type]
-                if len(go_terms) > 0:
-                    embedding_db_reduced[k] = embedding_db[k]
-                    self.go_annotation[k] = go_terms
-            self.embedding_lookup = EmbeddingLookup(embedding_db_reduced)
-        else:
+class FunctionPrediction(object):
+    """Embedding-based annotation transfer (goPredSim).
+
+    The GO annotations of the lookup database are stored as a sparse
+    protein x term matrix, so transferring the labels of the hits to a set of
+    querys is one sparse product between a query x hit similarity matrix and
+    the annotation matrix. The reduction to leaf terms uses the ancestor
+    closure of the annotated terms as a term x term matrix.
+    """
+    def __init__(self,
+                 embedding_db,
+                 go_annotation,
+                 gene_ontology,
+                 go_type,
+                 index_type='exact',
+                 **index_kwargs):
+        self.gene_ontology = gene_ontology
+
+        if go_type != 'all' and go_type not in GO_TYPES:
             sys.exit(
                 '{} is not a valid GO. Valid GOs are [all|mfo|bpo|cco]'.format(
                     go_type))
 
+        ids = numpy.array(list(embedding_db.keys()), dtype=object)
+        lookup_rows = None
+        terms, annotation_mat = self.build_annotation_matrix(
+            ids, go_annotation)
+        self.term_namespace = numpy.array(
+            [self.gene_ontology.get_ontology(t) for t in terms])
+
+        if go_type in GO_TYPES:
+            # only use proteins in the annotation set which actually have an annotation in this ontology
+            term_mask = self.term_namespace == go_type
+            terms = terms[term_mask]
+            self.term_namespace = self.term_namespace[term_mask]
+            annotation_mat = annotation_mat[:, term_mask]
+            protein_mask = numpy.diff(annotation_mat.indptr) > 0
+            ids = ids[protein_mask]
+            annotation_mat = annotation_mat[protein_mask]
+            if not protein_mask.all():
+                lookup_rows = numpy.nonzero(protein_mask)[0]
+
+        self.terms = terms
+        self.annotation_mat = annotation_mat
+        self.ancestor_mat = self.build_ancestor_matrix(terms)
+        self.go_annotation = {
+            k: set(terms[annotation_mat.indices[start:stop]])
+            for k, start, stop in zip(ids, annotation_mat.indptr[:-1],
+                                      annotation_mat.indptr[1:])
+        }
+        self.embedding_lookup = EmbeddingLookup(embedding_db,
+                                                index_type,
+                                                rows=lookup_rows,
+                                                **index_kwargs)
+
+    @staticmethod
+    def build_annotation_matrix(ids, go_annotation):
+        """Binary protein x term matrix of the annotations of `ids`.
+
+        :return: term ids (column order), csr annotation matrix
+        """
+        rows, cols = [], []
+        term_index = dict()
+        for i, k in enumerate(ids):
+            for t in go_annotation.get(k, ()):
+                rows.append(i)
+                cols.append(term_index.setdefault(t, len(term_index)))
+        terms = numpy.array(list(term_index.keys()), dtype=object)
+        annotation_mat = sp.csr_matrix(
+            (numpy.ones(len(rows), dtype=numpy.float64), (rows, cols)),
+            shape=(len(ids), len(terms)))
+        annotation_mat.sum_duplicates()
+        return terms, annotation_mat
+
+    def build_ancestor_matrix(self, terms):
+        """Term x term matrix with entry (i, j) set if term j is an ancestor
+        of term i, restricted to `terms`."""
+        term_index = {t: i for i, t in enumerate(terms)}
+        rows, cols = [], []
+        for i, t in enumerate(terms):
+            for p in self.gene_ontology.get_parent_terms(t):
+                j = term_index.get(p)
+                if j is not None and j != i:
+                    rows.append(i)
+                    cols.append(j)
+        return sp.csr_matrix(
+            (numpy.ones(len(rows), dtype=numpy.float64), (rows, cols)),
+            shape=(len(terms), len(terms)))
+
     def get_terms_by_go(self, terms):
         terms_by_go = {'mfo': set(), 'bpo': set(), 'cco': set()}
 
@@ -39,6 +108,100 @@ class FunctionPrediction(object):
 
         return terms_by_go
 
+    @staticmethod
+    def distance_to_similarity(dists, distance):
+        dists = numpy.asarray(dists, dtype=numpy.float64)
+        if distance == 'euclidean':
+            # scale distance to reflect a similarity [0;1]
+            return 0.5 / (0.5 + dists)
+        elif distance == 'cosine':
+            return 1 - dists
+        return dists
+
+    def transfer_annotations(self, query_rows, hit_rows, hit_sims, num_querys):
+        """Reliability index of every term for every query.
+
+        The RI of a term is the summed similarity of the hits annotated with
+        it divided by the number of hits of the query.
+
+        :param query_rows: query index of every hit
+        :param hit_rows: lookup database index of every hit
+        :param hit_sims: similarity of every hit
+        :param num_querys: number of querys
+        :return: csr query x term matrix of RIs, see `finalize_scores`
+        """
+        query_rows = numpy.asarray(query_rows, dtype=numpy.int64)
+        num_hits = numpy.bincount(query_rows, minlength=num_querys)
+        # if multiple hits are included RIs get smaller --> predictions retrieved for different
+        # numbers of hits are not directly comparable
+        weights = numpy.asarray(hit_sims,
+                                dtype=numpy.float64) / num_hits[query_rows]
+        hit_mat = sp.csr_matrix(
+            (weights, (query_rows, numpy.asarray(hit_rows))),
+            shape=(num_querys, self.annotation_mat.shape[0]))
+        return self.finalize_scores(hit_mat @ self.annotation_mat)
+
+    def finalize_scores(self, scores):
+        """Round RIs to two decimals, remove terms with RI 0.00 and reduce
+        the prediction to leaf terms, i.e. drop terms that are an ancestor of
+        another predicted term."""
+        scores = scores.tocsr()
+        # round ri and remove hits with ri == 0.00
+        scores.data = numpy.round(scores.data, 2)
+        scores.eliminate_zeros()
+
+        # exclude terms that are parent terms, i.e. there are more specific terms also part of this prediction
+        predicted = scores.copy()
+        predicted.data[:] = 1
+        covered = (predicted @ self.ancestor_mat).tocsr()
+        covered.data[:] = 1
+        scores = (scores - scores.multiply(covered)).tocsr()
+        scores.eliminate_zeros()
+        return scores
+
+    def run_prediction_knn_sweep(self, querys, distance, hits):
+        """Predictions for several numbers of closest hits from one search.
+
+        The lookup is searched once for the largest number of hits, with its
+        ties. The neighbours come back sorted by distance, so the hits of
+        every smaller k are the neighbours at most as far as the k-th one
+        (ties included, as in goPredSim) and are derived from the same
+        search.
+
+        :param querys: proteins for which GO terms should be predicted
+        :param distance: distance measure to use [euclidean|cosine]
+        :param hits: numbers of closest hits to evaluate
+        :return: query ids, dict k -> csr query x term matrix of RIs (columns
+            follow `self.terms`), dict k -> (query rows, lookup indices,
+            similarities) of the hits, neighbour indices
+        """
+        ks = sorted(set(int(h) for h in hits))
+        knn_dists, knn_indices, query_ids = self.embedding_lookup.run_embedding_lookup_knn(
+            querys, distance, ks[-1], include_ties=True)
+
+        found = knn_indices >= 0
+        knn_sims = self.distance_to_similarity(knn_dists, distance)
+        scores = dict()
+        hits_by_k = dict()
+        for k in ks:
+            # every hit at most as far as the k-th closest one
+            query_rows, cols = numpy.nonzero(
+                found & (knn_dists <= knn_dists[:, k - 1:k]))
+            hit_rows = knn_indices[query_rows, cols]
+            hit_sims = knn_sims[query_rows, cols]
+            scores[k] = self.transfer_annotations(query_rows, hit_rows,
+                                                  hit_sims, len(query_ids))
+            hits_by_k[k] = (query_rows, hit_rows, hit_sims)
+        return query_ids, scores, hits_by_k, knn_indices
+
+    def score_row_to_dict(self, scores, i):
+        start, stop = scores.indptr[i], scores.indptr[i + 1]
+        return {
+            t: float(ri)
+            for t, ri in zip(self.terms[scores.indices[start:stop]],
+                             scores.data[start:stop])
+        }
+
     def run_prediction_embedding_all(self, querys, distance, hits, criterion):
         """Perform inference based on embedding-similarity.
 
@@ -52,92 +215,42 @@ class FunctionPrediction(object):
         predictions = defaultdict(defaultdict)
         hit_ids = defaultdict(defaultdict)
 
-        distances, query_ids = self.embedding_lookup.run_embedding_lookup_distance(
-            querys, distance)
-
-        for i in range(0, len(query_ids)):
-            query = query_ids[i]
-            dists = distances[i, :].squeeze()
-            for h in hits:
-                prediction = dict()
-                if criterion == 'dist':  # extract hits within a certain distance
-                    h = float(h)
-                    indices = numpy.nonzero(dists <= h)
-                elif criterion == 'num':  # extract h closest hits
-                    h = int(h)
-                    indices_tmp = numpy.argpartition(dists, h)[0:h]
-                    dists_tmp = [dists[i] for i in indices_tmp]
-                    max_dist = numpy.amax(dists_tmp)
-                    indices = numpy.nonzero(dists <= max_dist)[0]
-
-                    if len(indices) > h:
-                        print(
-                            'Multiple hits with same distance found, resulting in {} hits'
-                            .format(len(indices)))
-
-                else:
-                    sys.exit(
-                        'No valid criterion defined, valid criterions are [dist|num]'
-                    )
-
-                num_hits = len(indices)
-
-                #  1. 对每个 qury 蛋白, 在数据库中找到符合标准的 K 个相似蛋白
-                #       2. 对 K 个相似蛋白， 根据找到的蛋白id 获取 Go term annotation 及 对应的距离
-                #       3. 将距离标准化为x相似性得分
-                #       4. 预测结果输出 :
-                #                     {'GO:001: 0.878',
-                #                       'GO:002: 0.8'}
-                for ind in indices:
-                    lookup_id = self.embedding_lookup.ids[ind]
-                    go_terms = self.go_annotation[lookup_id]
-                    dist = dists[ind]
-
-                    if distance == 'euclidean':
-                        # scale distance to reflect a similarity [0;1]
-                        dist = 0.5 / (0.5 + dist)
-                    elif distance == 'cosine':
-                        dist = 1 - dist
-
-                    for g in go_terms:
-                        if g in prediction.keys():
-                            # if multiple hits are included RIs get smaller --> predictions retrieved for different
-                            # numbers of hits are not directly comparable
-                            prediction[g] += dist / num_hits
-                        else:
-                            prediction[g] = dist / num_hits
-
-                    if query not in hit_ids[h].keys():
-                        hit_ids[h][query] = dict()
-                    hit_ids[h][query][lookup_id] = round(dist, 2)
-
-                # round ri and remove hits with ri == 0.00
-                keys_for_deletion = set()
-                for p in prediction:
-                    ri = round(prediction[p], 2)
-                    if ri == 0.00:
-                        keys_for_deletion.add(p)
-                    else:
-                        prediction[p] = ri
-
-                for k in keys_for_deletion:
-                    del prediction[k]
-
-                # reduce prediction to leaf terms
-                parent_terms = []
-                for p in prediction.keys():
-                    parents = self.gen_ontology.get_parent_terms(p)
-                    parent_terms += parents
-                # exclude terms that are parent terms, i.e. there are more specific terms also part of this prediction
-                keys_for_deletion = set()
-                for p in prediction.keys():
-                    if p in parent_terms:
-                        keys_for_deletion.add(p)
-
-                for k in keys_for_deletion:
-                    del prediction[k]
-
-                predictions[h][query] = prediction
+        lookup_ids = numpy.array(self.embedding_lookup.ids, dtype=object)
+        if criterion == 'dist':
+            distances, query_ids = self.embedding_lookup.run_embedding_lookup_distance(
+                querys, distance)
+            scores_by_hits = dict()
+            for h in hits:  # extract hits within a certain distance
+                h = float(h)
+                query_rows, hit_rows = numpy.nonzero(distances <= h)
+                hit_sims = self.distance_to_similarity(
+                    distances[query_rows, hit_rows], distance)
+                scores_by_hits[h] = (self.transfer_annotations(
+                    query_rows, hit_rows, hit_sims,
+                    len(query_ids)), query_rows, hit_rows, hit_sims)
+        elif criterion == 'num':
+            # extract h closest hits and their ties, one search for all values of h
+            query_ids, scores, hits_by_k, _ = self.run_prediction_knn_sweep(
+                querys, distance, hits)
+            scores_by_hits = {
+                h: (scores[h], ) + hits_by_k[h]
+                for h in scores.keys()
+            }
+        else:
+            sys.exit(
+                'No valid criterion defined, valid criterions are [dist|num]')
+
+        for h, (scores, query_rows, hit_rows,
+                hit_sims) in scores_by_hits.items():
+            for q, lookup_id, sim in zip(query_rows, lookup_ids[hit_rows],
+                                         numpy.round(hit_sims, 2)):
+                query = query_ids[q]
+                if query not in hit_ids[h].keys():
+                    hit_ids[h][query] = dict()
+                hit_ids[h][query][lookup_id] = float(sim)
+
+            for i, query in enumerate(query_ids):
+                predictions[h][query] = self.score_row_to_dict(scores, i)
 
         return predictions, hit_ids
 
@@ -153,73 +266,28 @@ class FunctionPrediction(object):
         :return: GO term predictions with RI
         """
 
-        prediction = dict()
-        distances, _ = self.embedding_lookup.run_embedding_lookup_distance(
-            query_embedding, distance)
-        dists = distances[0, :].squeeze().numpy()
-
         if criterion == 'dist':  # extract hits within a certain distance
             k = float(k)
-            indices = numpy.nonzero(dists <= k)
-        elif criterion == 'num':  # extract h closest hits
+            distances, _ = self.embedding_lookup.run_embedding_lookup_distance(
+                query_embedding, distance)
+            dists = distances[0, :].squeeze()
+            indices = numpy.nonzero(dists <= k)[0]
+            hit_dists = dists[indices]
+        elif criterion == 'num':  # extract h closest hits and their ties
             k = int(k)
-            indices_tmp = numpy.argpartition(dists, k)[0:k]
-            dists_tmp = [dists[i] for i in indices_tmp]
-            max_dist = numpy.amax(dists_tmp)
-            indices = numpy.nonzero(dists <= max_dist)[0]
+            knn_dists, knn_indices, _ = self.embedding_lookup.run_embedding_lookup_knn(
+                query_embedding, distance, k, include_ties=True)
+            found = knn_indices[0] >= 0
+            indices = knn_indices[0][found]
+            hit_dists = knn_dists[0][found]
         else:
             sys.exit(
                 'No valid criterion defined, valid criterions are [dist|num]')
 
-        num_hits = len(indices)
-
-        for ind in indices:
-            lookup_id = self.embedding_lookup.ids[ind]
-            go_terms = self.go_annotation[lookup_id]
-            dist = dists[ind]
-
-            if distance == 'euclidean':
-                # scale distance to reflect a similarity [0;1]
-                dist = 0.5 / (0.5 + dist)
-            elif distance == 'cosine':
-                dist = 1 - dist
-
-            for g in go_terms:
-                if g in prediction.keys():
-                    # if multiple hits are included RIs get smaller --> predictions retrieved for different
-                    # numbers of hits are not directly comparable
-                    prediction[g] += dist / num_hits
-                else:
-                    prediction[g] = dist / num_hits
-
-                # round ri and remove hits with ri == 0.00
-                keys_for_deletion = set()
-                for p in prediction:
-                    ri = round(prediction[p], 2)
-                    if ri == 0.00:
-                        keys_for_deletion.add(p)
-                    else:
-                        prediction[p] = ri
-
-                for j in keys_for_deletion:
-                    del prediction[j]
-
-                # reduce prediction to leaf terms
-                parent_terms = []
-                for p in prediction.keys():
-                    parents = self.gen_ontology.get_parent_terms(p)
-                    parent_terms += parents
-
-                # exclude terms that are parent terms, i.e. there are more specific terms also part of this prediction
-                keys_for_deletion = set()
-                for p in prediction.keys():
-                    if p in parent_terms:
-                        keys_for_deletion.add(p)
-
-                for k in keys_for_deletion:
-                    del prediction[k]
-
-        return prediction
+        hit_sims = self.distance_to_similarity(hit_dists, distance)
+        scores = self.transfer_annotations(numpy.zeros(len(indices)), indices,
+                                           hit_sims, 1)
+        return self.score_row_to_dict(scores, 0)
 
     @staticmethod
     def write_predictions(predictions, out_file):
@@ -0,0 +1,1052 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from deepfold.utils.embedding_db import EmbeddingDB
+
+INDEX_META_FILE = 'index.json'
+SUPPORTED_METRICS = ['euclidean', 'cosine']
+
+
+def normalize_embeddings(embeddings):
+    """L2-normalize the rows of an embedding matrix."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+def pairwise_distances_gemm(queries,
+                            vectors,
+                            metric,
+                            vector_sq_norms=None,
+                            dtype=np.float64):
+    """Distances between two sets of embeddings computed with one GEMM.
+
+    For `cosine` both inputs are expected to be L2-normalized already.
+    Norms and dot products are accumulated in `dtype`: in float32 the
+    expansion ``|q|^2 + |v|^2 - 2 q.v`` cancels catastrophically for close
+    embeddings far from the origin, so only approximate searches (k-means,
+    coarse quantizers, codes) should pass float32. Returns float32.
+    """
+    queries = np.asarray(queries, dtype=dtype)
+    vectors = np.asarray(vectors, dtype=dtype)
+    dots = np.dot(queries, vectors.T)
+    if metric == 'cosine':
+        dists = 1.0 - dots
+    else:
+        if vector_sq_norms is None:
+            vector_sq_norms = np.einsum('ij,ij->i', vectors, vectors)
+        vector_sq_norms = np.asarray(vector_sq_norms, dtype=dtype)
+        query_sq_norms = np.einsum('ij,ij->i', queries, queries)
+        dists = query_sq_norms[:, None] + vector_sq_norms[None, :] - 2 * dots
+        np.maximum(dists, 0, out=dists)
+        np.sqrt(dists, out=dists)
+    return dists.astype(np.float32, copy=False)
+
+
+def topk_smallest(dists, k):
+    """Indices and values of the k smallest entries of every row, sorted."""
+    k = min(k, dists.shape[1])
+    if k < dists.shape[1]:
+        indices = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.tile(np.arange(dists.shape[1]), (dists.shape[0], 1))
+    values = np.take_along_axis(dists, indices, axis=1)
+    order = np.argsort(values, axis=1, kind='stable')
+    return (np.take_along_axis(values, order, axis=1),
+            np.take_along_axis(indices, order, axis=1))
+
+
+def merge_topk(dists, indices, new_dists, new_indices, k):
+    """Merge two sorted candidate lists of every row, keep the k best."""
+    dists = np.concatenate([dists, new_dists], axis=1)
+    indices = np.concatenate([indices, new_indices], axis=1)
+    dists, order = topk_smallest(dists, k)
+    return dists, np.take_along_axis(indices, order, axis=1)
+
+
+def blocked_knn_search(queries,
+                       vectors,
+                       k,
+                       metric='euclidean',
+                       vector_sq_norms=None,
+                       query_block_size=1024,
+                       db_block_size=16384,
+                       num_workers=1):
+    """Exact k-NN search that never materializes the full distance matrix.
+
+    Queries and database are tiled, every (query block, database block)
+    tile is one GEMM and the running top-k of each query block is merged
+    with the k best candidates of the tile. Peak memory is bounded by
+    ``query_block_size * db_block_size`` float64 distances per worker. Query
+    blocks
+    are processed by `num_workers` threads, numpy releases the GIL in the
+    GEMM so this scales with the number of cores.
+
+    Returns:
+        distances, indices: arrays of shape (num_queries, k) sorted by
+        increasing distance, padded with inf / -1 if k > len(vectors).
+    """
+    num_queries = queries.shape[0]
+    num_vectors = vectors.shape[0]
+    if vector_sq_norms is None and metric == 'euclidean':
+        vector_sq_norms = np.einsum('ij,ij->i',
+                                    vectors,
+                                    vectors,
+                                    dtype=np.float64)
+
+    distances = np.full((num_queries, k), np.inf, dtype=np.float32)
+    indices = np.full((num_queries, k), -1, dtype=np.int64)
+
+    def search_block(start):
+        stop = min(start + query_block_size, num_queries)
+        block = queries[start:stop]
+        best_dists = np.full((stop - start, 0), np.inf, dtype=np.float32)
+        best_indices = np.full((stop - start, 0), -1, dtype=np.int64)
+        for db_start in range(0, num_vectors, db_block_size):
+            db_stop = min(db_start + db_block_size, num_vectors)
+            sq_norms = None
+            if vector_sq_norms is not None:
+                sq_norms = vector_sq_norms[db_start:db_stop]
+            dists = pairwise_distances_gemm(block, vectors[db_start:db_stop],
+                                            metric, sq_norms)
+            tile_dists, tile_indices = topk_smallest(dists, k)
+            best_dists, best_indices = merge_topk(best_dists, best_indices,
+                                                  tile_dists,
+                                                  tile_indices + db_start, k)
+        num_found = best_dists.shape[1]
+        distances[start:stop, :num_found] = best_dists
+        indices[start:stop, :num_found] = best_indices
+
+    starts = range(0, num_queries, query_block_size)
+    if num_workers > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(search_block, starts))
+    else:
+        for start in starts:
+            search_block(start)
+    return distances, indices
+
+
+def kmeans(embeddings, num_clusters, num_iters=20, seed=42):
+    """Plain Lloyd's k-means used to train the coarse quantizer."""
+    rng = np.random.RandomState(seed)
+    num_samples = embeddings.shape[0]
+    init = rng.choice(num_samples, num_clusters, replace=False)
+    centroids = np.array(embeddings[init], dtype=np.float32)
+    for _ in range(num_iters):
+        dists = pairwise_distances_gemm(embeddings,
+                                        centroids,
+                                        'euclidean',
+                                        dtype=np.float32)
+        assign = np.argmin(dists, axis=1)
+        counts = np.bincount(assign, minlength=num_clusters)
+        non_empty = counts > 0
+        order = np.argsort(assign, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.add.reduceat(embeddings[order], offsets[non_empty], axis=0)
+        centroids[non_empty] = sums / counts[non_empty, None]
+        # re-seed empty clusters with random points
+        num_empty = int((~non_empty).sum())
+        if num_empty > 0:
+            centroids[~non_empty] = embeddings[rng.choice(num_samples,
+                                                          num_empty,
+                                                          replace=False)]
+    return centroids
+
+
+class EmbeddingIndex(object):
+    """Base class of the nearest-neighbour indexes used by EmbeddingLookup.
+
+    An index is built once from the reference embeddings, can be saved to a
+    directory and is memory-mapped when loaded back.
+    """
+    index_type = None
+
+    def __init__(self, metric='euclidean'):
+        if metric not in SUPPORTED_METRICS:
+            raise ValueError(
+                f'{metric} is not a supported index metric, valid metrics are '
+                f'{SUPPORTED_METRICS}')
+        self.metric = metric
+        self.vectors = None
+        self.sq_norms = None
+
+    def __len__(self):
+        return 0 if self.vectors is None else self.vectors.shape[0]
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def _prepare(self, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            embeddings = embeddings.reshape(1, -1)
+        if self.metric == 'cosine':
+            embeddings = normalize_embeddings(embeddings)
+        return embeddings
+
+    def _prepare_vectors(self, embeddings, chunk_size=65536):
+        """Reference embeddings as stored by the index.
+
+        float16 embeddings stay float16 and a float32 (memory-mapped)
+        matrix is used as is for `euclidean`; for `cosine` the rows are
+        normalized chunk by chunk into a matrix of the same dtype.
+        """
+        embeddings = np.asarray(embeddings)
+        if embeddings.dtype not in (np.float16, np.float32):
+            embeddings = embeddings.astype(np.float32)
+        if self.metric == 'cosine':
+            normalized = np.empty(embeddings.shape, dtype=embeddings.dtype)
+            for start in range(0, len(embeddings), chunk_size):
+                normalized[start:start + chunk_size] = normalize_embeddings(
+                    embeddings[start:start + chunk_size])
+            embeddings = normalized
+        return embeddings
+
+    @staticmethod
+    def _sq_norms(vectors, chunk_size=65536):
+        """float64 squared norms of the rows, computed chunk by chunk."""
+        sq_norms = np.empty(len(vectors), dtype=np.float64)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = np.asarray(vectors[start:start + chunk_size],
+                               dtype=np.float64)
+            sq_norms[start:start + chunk_size] = np.einsum(
+                'ij,ij->i', chunk, chunk)
+        return sq_norms
+
+    def build(self, embeddings):
+        raise NotImplementedError
+
+    def search(self, queries, k):
+        """Find the k nearest reference embeddings of every query.
+
+        Returns:
+            distances, indices: arrays of shape (num_queries, k) sorted by
+            increasing distance. Missing neighbours have index -1 and an
+            infinite distance.
+        """
+        raise NotImplementedError
+
+    def params(self):
+        return {}
+
+    def arrays(self):
+        return {'vectors': self.vectors, 'sq_norms': self.sq_norms}
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        for name, array in self.arrays().items():
+            np.save(os.path.join(index_dir, name + '.npy'), array)
+        meta = {
+            'index_type': self.index_type,
+            'metric': self.metric,
+            'size': len(self),
+            'dim': self.dim,
+            'params': self.params()
+        }
+        with open(os.path.join(index_dir, INDEX_META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    def _load_arrays(self, index_dir, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        for name in self.arrays().keys():
+            setattr(
+                self, name,
+                np.load(os.path.join(index_dir, name + '.npy'),
+                        mmap_mode=mmap_mode))
+
+
+class ExactIndex(EmbeddingIndex):
+    """Brute-force search over all reference embeddings.
+
+    The search is blocked over queries and reference embeddings (see
+    `blocked_knn_search`), so its memory use does not grow with the size of
+    the database.
+
+    Args:
+        metric: `euclidean` or `cosine`.
+        batch_size: number of queries compared with the database at once.
+        db_block_size: number of reference embeddings per distance tile.
+        num_workers: number of threads searching query blocks in parallel.
+    """
+    index_type = 'exact'
+
+    def __init__(self,
+                 metric='euclidean',
+                 batch_size=1024,
+                 db_block_size=16384,
+                 num_workers=1):
+        super().__init__(metric)
+        self.batch_size = batch_size
+        self.db_block_size = db_block_size
+        self.num_workers = num_workers
+
+    def build(self, embeddings):
+        self.vectors = self._prepare_vectors(embeddings)
+        self.sq_norms = self._sq_norms(self.vectors)
+        return self
+
+    def search(self, queries, k):
+        queries = self._prepare(queries)
+        return blocked_knn_search(queries,
+                                  self.vectors,
+                                  k,
+                                  metric=self.metric,
+                                  vector_sq_norms=self.sq_norms,
+                                  query_block_size=self.batch_size,
+                                  db_block_size=self.db_block_size,
+                                  num_workers=self.num_workers)
+
+    def params(self):
+        return {
+            'batch_size': self.batch_size,
+            'db_block_size': self.db_block_size,
+            'num_workers': self.num_workers
+        }
+
+
+class IVFIndex(EmbeddingIndex):
+    """Inverted-file index: approximate search restricted to the `nprobe`
+    clusters closest to the query.
+
+    The reference embeddings are clustered with k-means into `nlist` lists
+    and stored contiguously list after list, so probing a list reads one
+    slice of the (memory-mapped) vector matrix.
+
+    Args:
+        metric: `euclidean` or `cosine`.
+        nlist: number of inverted lists, usually around sqrt(N).
+        nprobe: number of lists scanned per query. Larger values give better
+            recall at the cost of speed, `nprobe == nlist` is exact search.
+        num_iters: k-means iterations.
+        max_train_samples: number of embeddings used to train k-means.
+        seed: random seed of the k-means initialization.
+    """
+    index_type = 'ivf'
+
+    def __init__(self,
+                 metric='euclidean',
+                 nlist=1024,
+                 nprobe=16,
+                 num_iters=20,
+                 max_train_samples=100000,
+                 seed=42):
+        super().__init__(metric)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.num_iters = num_iters
+        self.max_train_samples = max_train_samples
+        self.seed = seed
+        self.centroids = None
+        self.row_ids = None
+        self.list_offsets = None
+
+    def build(self, embeddings):
+        embeddings = self._prepare(embeddings)
+        num_samples = embeddings.shape[0]
+        self.nlist = min(self.nlist, num_samples)
+
+        rng = np.random.RandomState(self.seed)
+        if num_samples > self.max_train_samples:
+            train = embeddings[rng.choice(num_samples,
+                                          self.max_train_samples,
+                                          replace=False)]
+        else:
+            train = embeddings
+        self.centroids = kmeans(train,
+                                self.nlist,
+                                num_iters=self.num_iters,
+                                seed=self.seed)
+
+        assign = np.empty(num_samples, dtype=np.int64)
+        step = 65536
+        for start in range(0, num_samples, step):
+            dists = pairwise_distances_gemm(embeddings[start:start + step],
+                                            self.centroids,
+                                            'euclidean',
+                                            dtype=np.float32)
+            assign[start:start + step] = np.argmin(dists, axis=1)
+
+        self.row_ids = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=self.nlist)
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.vectors = embeddings[self.row_ids]
+        self.sq_norms = self._sq_norms(self.vectors)
+        return self
+
+    def search(self, queries, k, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        queries = self._prepare(queries)
+        num_queries = queries.shape[0]
+        coarse = pairwise_distances_gemm(queries,
+                                         self.centroids,
+                                         'euclidean',
+                                         dtype=np.float32)
+        _, probes = topk_smallest(coarse, nprobe)
+
+        distances = np.full((num_queries, k), np.inf, dtype=np.float32)
+        indices = np.full((num_queries, k), -1, dtype=np.int64)
+        for i in range(num_queries):
+            starts = self.list_offsets[probes[i]]
+            stops = self.list_offsets[probes[i] + 1]
+            rows = np.concatenate(
+                [np.arange(a, b) for a, b in zip(starts, stops)])
+            if len(rows) == 0:
+                continue
+            dists = pairwise_distances_gemm(queries[i:i + 1],
+                                            self.vectors[rows], self.metric,
+                                            self.sq_norms[rows])
+            dists, top = topk_smallest(dists, k)
+            num_found = dists.shape[1]
+            distances[i, :num_found] = dists[0]
+            indices[i, :num_found] = self.row_ids[rows[top[0]]]
+        return distances, indices
+
+    def params(self):
+        return {
+            'nlist': self.nlist,
+            'nprobe': self.nprobe,
+            'num_iters': self.num_iters,
+            'max_train_samples': self.max_train_samples,
+            'seed': self.seed
+        }
+
+    def arrays(self):
+        arrays = super().arrays()
+        arrays.update({
+            'centroids': self.centroids,
+            'row_ids': self.row_ids,
+            'list_offsets': self.list_offsets
+        })
+        return arrays
+
+
+class ScalarQuantizer(object):
+    """8-bit scalar quantizer, every dimension is mapped linearly from its
+    [min, max] range on the training set to the 256 uint8 codes."""
+    def __init__(self):
+        self.vmin = None
+        self.scale = None
+
+    def train(self, embeddings):
+        self.vmin = embeddings.min(axis=0).astype(np.float32)
+        vmax = embeddings.max(axis=0).astype(np.float32)
+        self.scale = np.maximum(vmax - self.vmin, 1e-12) / 255.0
+        return self
+
+    def encode(self, embeddings):
+        codes = np.rint((embeddings - self.vmin) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return codes.astype(np.float32) * self.scale + self.vmin
+
+    def arrays(self):
+        return {'sq_vmin': self.vmin, 'sq_scale': self.scale}
+
+    def load_arrays(self, arrays):
+        self.vmin = np.asarray(arrays['sq_vmin'])
+        self.scale = np.asarray(arrays['sq_scale'])
+
+
+class ProductQuantizer(object):
+    """Product quantizer with 8-bit codes.
+
+    The embedding is split into `num_subspaces` sub-vectors and every
+    sub-vector is replaced by the id of its closest centroid out of 256,
+    k-means trained per subspace. A 1280-d float32 embedding with 64
+    subspaces takes 64 bytes instead of 5120.
+    """
+    def __init__(self, num_subspaces=64, num_iters=20, seed=42):
+        self.num_subspaces = num_subspaces
+        self.num_iters = num_iters
+        self.seed = seed
+        self.codebooks = None
+
+    def _split(self, dim):
+        if dim % self.num_subspaces != 0:
+            raise ValueError(
+                f'Embedding dim {dim} is not divisible by the number of '
+                f'subspaces {self.num_subspaces}')
+        return dim // self.num_subspaces
+
+    def train(self, embeddings):
+        dsub = self._split(embeddings.shape[1])
+        ksub = min(256, embeddings.shape[0])
+        self.codebooks = np.stack([
+            kmeans(np.ascontiguousarray(embeddings[:,
+                                                   j * dsub:(j + 1) * dsub]),
+                   ksub,
+                   num_iters=self.num_iters,
+                   seed=self.seed) for j in range(self.num_subspaces)
+        ])
+        return self
+
+    def encode(self, embeddings):
+        dsub = self.codebooks.shape[2]
+        codes = np.empty((embeddings.shape[0], self.num_subspaces),
+                         dtype=np.uint8)
+        for j in range(self.num_subspaces):
+            sub_vectors = np.ascontiguousarray(embeddings[:, j * dsub:(j + 1) *
+                                                          dsub])
+            dists = pairwise_distances_gemm(sub_vectors,
+                                            self.codebooks[j],
+                                            'euclidean',
+                                            dtype=np.float32)
+            codes[:, j] = np.argmin(dists, axis=1)
+        return codes
+
+    def decode(self, codes):
+        return np.concatenate(
+            [self.codebooks[j][codes[:, j]] for j in range(codes.shape[1])],
+            axis=1)
+
+    def distance_tables(self, queries):
+        """Squared distances of every query sub-vector to every centroid of
+        its subspace, shape (num_queries, num_subspaces, 256)."""
+        dsub = self.codebooks.shape[2]
+        return np.stack([
+            pairwise_distances_gemm(queries[:, j * dsub:(j + 1) * dsub],
+                                    self.codebooks[j],
+                                    'euclidean',
+                                    dtype=np.float32)**2
+            for j in range(self.num_subspaces)
+        ],
+                        axis=1)
+
+    def arrays(self):
+        return {'pq_codebooks': self.codebooks}
+
+    def load_arrays(self, arrays):
+        self.codebooks = np.asarray(arrays['pq_codebooks'])
+
+
+class QuantizedIndex(EmbeddingIndex):
+    """Search over 8-bit scalar (`sq8`) or product (`pq`) quantized codes.
+
+    Distances between the float queries and the quantized reference
+    embeddings are computed asymmetrically (the queries are not quantized):
+    on the decoded codes for `sq8` and with per-query lookup tables for
+    `pq`. The `k * rerank` best candidates are then re-ranked with exact
+    distances on the original embeddings. The index only holds the codes,
+    4x smaller than float32 for `sq8` and dim * 4 / pq_m times smaller for
+    `pq`: the original embeddings are not copied nor saved with it, they are
+    read for the shortlist from the matrix the index was built from, or
+    from `rerank_db` (memory-mapped) once the index is loaded back.
+
+    Args:
+        metric: `euclidean` or `cosine`.
+        quantizer: `sq8` or `pq`.
+        pq_m: number of pq subspaces, must divide the embedding dim.
+        rerank: shortlist size as a multiple of k, 0 returns the
+            approximate distances without re-ranking.
+        rerank_db: `EmbeddingDB` directory or `.npy` file of the original
+            embeddings, needed to re-rank with a loaded index.
+        rerank_offset: row of `rerank_db` the indexed embeddings start at.
+        batch_size: number of queries searched at once.
+        db_block_size: number of codes scanned per block.
+        num_iters: k-means iterations of the pq codebooks.
+        max_train_samples: number of embeddings used to train the quantizer.
+        seed: random seed.
+    """
+    index_type = 'quantized'
+
+    def __init__(self,
+                 metric='euclidean',
+                 quantizer='sq8',
+                 pq_m=64,
+                 rerank=10,
+                 rerank_db=None,
+                 rerank_offset=0,
+                 batch_size=1024,
+                 db_block_size=65536,
+                 num_iters=20,
+                 max_train_samples=100000,
+                 seed=42):
+        super().__init__(metric)
+        if quantizer == 'sq8':
+            self.quantizer = ScalarQuantizer()
+        elif quantizer == 'pq':
+            self.quantizer = ProductQuantizer(pq_m, num_iters, seed)
+        else:
+            raise ValueError(f'{quantizer} is not a valid quantizer, valid '
+                             f'quantizers are [sq8|pq]')
+        self.quantizer_type = quantizer
+        self.pq_m = pq_m
+        self.rerank = rerank
+        self.rerank_db = rerank_db
+        self.rerank_offset = rerank_offset
+        self.batch_size = batch_size
+        self.db_block_size = db_block_size
+        self.num_iters = num_iters
+        self.max_train_samples = max_train_samples
+        self.seed = seed
+        self.codes = None
+        self.code_sq_norms = None
+
+    def __len__(self):
+        return 0 if self.codes is None else self.codes.shape[0]
+
+    @property
+    def dim(self):
+        if self.quantizer_type == 'sq8':
+            return self.codes.shape[1]
+        return self.quantizer.codebooks.shape[
+            0] * self.quantizer.codebooks.shape[2]
+
+    def build(self, embeddings):
+        num_samples = embeddings.shape[0]
+        rng = np.random.RandomState(self.seed)
+        if num_samples > self.max_train_samples:
+            train = embeddings[np.sort(
+                rng.choice(num_samples, self.max_train_samples,
+                           replace=False))]
+        else:
+            train = embeddings
+        self.quantizer.train(self._prepare(train))
+
+        self.codes = np.concatenate([
+            self.quantizer.encode(
+                self._prepare(embeddings[start:start + self.db_block_size]))
+            for start in range(0, num_samples, self.db_block_size)
+        ])
+        if self.quantizer_type == 'sq8':
+            self.code_sq_norms = np.concatenate([
+                np.einsum('ij,ij->i', decoded, decoded)
+                for decoded in self._decoded_blocks()
+            ])
+        # the original embeddings are only referenced, for re-ranking
+        self.vectors = None
+        if self.rerank > 0:
+            self.vectors = embeddings if self.rerank_db is None else (
+                self._open_rerank_db())
+        return self
+
+    def _open_rerank_db(self):
+        """Memory-mapped original embeddings of the indexed rows."""
+        if os.path.isdir(self.rerank_db):
+            matrix = EmbeddingDB(self.rerank_db).matrix
+        else:
+            matrix = np.load(self.rerank_db, mmap_mode='r')
+        return matrix[self.rerank_offset:self.rerank_offset + len(self)]
+
+    def _decoded_blocks(self):
+        for start in range(0, len(self), self.db_block_size):
+            yield self.quantizer.decode(self.codes[start:start +
+                                                   self.db_block_size])
+
+    def approximate_distances(self, queries, start, stop, tables=None):
+        """Squared euclidean distances between queries and codes[start:stop].
+
+        :param tables: pq distance tables of the queries, see
+            `ProductQuantizer.distance_tables`, computed if not given
+        """
+        codes = self.codes[start:stop]
+        if self.quantizer_type == 'sq8':
+            decoded = self.quantizer.decode(codes)
+            dists = pairwise_distances_gemm(queries,
+                                            decoded,
+                                            'euclidean',
+                                            self.code_sq_norms[start:stop],
+                                            dtype=np.float32)
+            return dists**2
+        if tables is None:
+            tables = self.quantizer.distance_tables(queries)
+        dists = np.zeros((queries.shape[0], codes.shape[0]), dtype=np.float32)
+        for j in range(codes.shape[1]):
+            dists += tables[:, j, codes[:, j]]
+        return dists
+
+    def _to_metric(self, sq_dists):
+        # the embeddings are normalized for cosine: |a - b|^2 = 2 - 2 cos
+        if self.metric == 'cosine':
+            return sq_dists / 2.0
+        return np.sqrt(np.maximum(sq_dists, 0))
+
+    def _exact_distances(self, queries, cand_indices, batch_size=32):
+        """Exact distances between every query and its candidates, read
+        from the (memory-mapped) original embeddings and computed in
+        float64 on the differences, so close candidates keep their order."""
+        dists = np.empty(cand_indices.shape, dtype=np.float32)
+        for start in range(0, queries.shape[0], batch_size):
+            rows = cand_indices[start:start + batch_size]
+            vectors = self._prepare(self.vectors[rows.ravel()])
+            vectors = vectors.reshape(rows.shape + (-1, )).astype(np.float64)
+            block = queries[start:start + batch_size].astype(np.float64)
+            if self.metric == 'cosine':
+                dists[start:start + batch_size] = 1.0 - np.einsum(
+                    'qd,qcd->qc', block, vectors)
+            else:
+                diffs = vectors - block[:, None, :]
+                dists[start:start + batch_size] = np.sqrt(
+                    np.einsum('qcd,qcd->qc', diffs, diffs))
+        return dists
+
+    def search(self, queries, k):
+        queries = self._prepare(queries)
+        num_queries = queries.shape[0]
+        num_candidates = k * self.rerank if self.rerank > 0 else k
+        distances = np.full((num_queries, k), np.inf, dtype=np.float32)
+        indices = np.full((num_queries, k), -1, dtype=np.int64)
+
+        for q_start in range(0, num_queries, self.batch_size):
+            q_stop = min(q_start + self.batch_size, num_queries)
+            block = queries[q_start:q_stop]
+            tables = None
+            if self.quantizer_type == 'pq':
+                tables = self.quantizer.distance_tables(block)
+            cand_dists = np.full((q_stop - q_start, 0),
+                                 np.inf,
+                                 dtype=np.float32)
+            cand_indices = np.full((q_stop - q_start, 0), -1, dtype=np.int64)
+            for start in range(0, len(self), self.db_block_size):
+                stop = min(start + self.db_block_size, len(self))
+                dists = self.approximate_distances(block, start, stop, tables)
+                tile_dists, tile_indices = topk_smallest(dists, num_candidates)
+                cand_dists, cand_indices = merge_topk(cand_dists, cand_indices,
+                                                      tile_dists,
+                                                      tile_indices + start,
+                                                      num_candidates)
+
+            if self.rerank > 0:
+                cand_dists = self._exact_distances(block, cand_indices)
+            else:
+                cand_dists = self._to_metric(cand_dists)
+            best_dists, order = topk_smallest(cand_dists, k)
+            num_found = best_dists.shape[1]
+            distances[q_start:q_stop, :num_found] = best_dists
+            indices[q_start:q_stop, :num_found] = np.take_along_axis(
+                cand_indices, order, axis=1)
+        return distances, indices
+
+    def params(self):
+        return {
+            'quantizer': self.quantizer_type,
+            'pq_m': self.pq_m,
+            'rerank': self.rerank,
+            'rerank_db': self.rerank_db,
+            'rerank_offset': self.rerank_offset,
+            'batch_size': self.batch_size,
+            'db_block_size': self.db_block_size,
+            'num_iters': self.num_iters,
+            'max_train_samples': self.max_train_samples,
+            'seed': self.seed
+        }
+
+    def arrays(self):
+        arrays = {'codes': self.codes}
+        if self.quantizer_type == 'sq8':
+            arrays['code_sq_norms'] = self.code_sq_norms
+        arrays.update(self.quantizer.arrays())
+        return arrays
+
+    def _load_arrays(self, index_dir, mmap=True):
+        super()._load_arrays(index_dir, mmap=mmap)
+        self.quantizer.load_arrays(
+            {name: getattr(self, name)
+             for name in self.quantizer.arrays()})
+        self.vectors = None
+        if self.rerank > 0:
+            if self.rerank_db is None:
+                raise ValueError(
+                    'Re-ranking needs the original embeddings, load the '
+                    'index with rerank_db or with rerank=0')
+            self.vectors = self._open_rerank_db()
+
+
+def _shard_worker(conn, shards, shard_params):
+    """Worker process of a ShardedIndex, serves searches over its shards.
+
+    The shards are memory-mapped, so the worker only pages in the parts of
+    the reference set it actually scans. Errors are sent back instead of a
+    result and re-raised by the parent.
+    """
+    error = None
+    try:
+        indexes = [(load_index(shard_dir, mmap=True, **shard_params), offset)
+                   for shard_dir, offset in shards]
+    except Exception as e:
+        error = e
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        result = error
+        if error is None:
+            queries, k = msg
+            try:
+                result = _search_shards(indexes, queries, k)
+            except Exception as e:
+                result = e
+        try:
+            conn.send(result)
+        except Exception:
+            # the exception itself could not be pickled
+            conn.send(RuntimeError(repr(result)))
+    conn.close()
+
+
+def _search_shards(indexes, queries, k):
+    distances = np.full((queries.shape[0], 0), np.inf, dtype=np.float32)
+    indices = np.full((queries.shape[0], 0), -1, dtype=np.int64)
+    for index, offset in indexes:
+        dists, ids = index.search(queries, k)
+        ids = np.where(ids >= 0, ids + offset, -1)
+        distances, indices = merge_topk(distances, indices, dists, ids, k)
+    return distances, indices
+
+
+class ShardedIndex(EmbeddingIndex):
+    """Reference set split into shards searched by local worker processes.
+
+    Every shard is an index of its own (`shard_type`), built over a
+    contiguous range of the reference embeddings. A search is fanned out to
+    all shards and the per-shard top-k are merged. When the shards live on
+    disk (`shard_dir` at build time, or an index opened with `load_index`)
+    they are searched by `num_workers` processes that memory-map their
+    shards, so throughput scales with the number of cores and the reference
+    set does not have to fit in the address space of one process. Shards
+    built in memory only are searched by a thread pool.
+
+    Args:
+        metric: `euclidean` or `cosine`.
+        num_shards: number of shards.
+        shard_type: index type of the shards, `exact`, `ivf` or `quantized`.
+        num_workers: number of worker processes, defaults to `num_shards`.
+        shard_dir: directory the shards are written to by `build`.
+        shard_params: parameters of the shard indexes, e.g. `nprobe`.
+    """
+    index_type = 'sharded'
+
+    def __init__(self,
+                 metric='euclidean',
+                 num_shards=4,
+                 shard_type='exact',
+                 num_workers=None,
+                 shard_dir=None,
+                 **shard_params):
+        # set first, `close` runs from __del__ even if __init__ raises
+        self._workers = None
+        super().__init__(metric)
+        if shard_type == self.index_type or shard_type not in INDEX_TYPES:
+            raise ValueError(f'{shard_type} is not a valid shard index type')
+        self.num_shards = num_shards
+        self.shard_type = shard_type
+        self.num_workers = num_workers or num_shards
+        self.shard_dir = shard_dir
+        self.shard_params = shard_params
+        self.shards = None
+        self.offsets = None
+        self._dim = None
+
+    def __len__(self):
+        return 0 if self.offsets is None else int(self.offsets[-1])
+
+    @property
+    def dim(self):
+        return self._dim
+
+    def build(self, embeddings):
+        if (self.shard_dir is not None
+                and self.shard_type == QuantizedIndex.index_type):
+            shard = QuantizedIndex(metric=self.metric, **self.shard_params)
+            if shard.rerank > 0 and shard.rerank_db is None:
+                raise ValueError(
+                    'Quantized shards written to shard_dir re-rank from '
+                    'rerank_db in the workers, pass rerank_db or rerank=0')
+        num_samples = embeddings.shape[0]
+        self._dim = embeddings.shape[1]
+        bounds = np.linspace(0, num_samples, self.num_shards + 1).astype(int)
+        self.offsets = bounds
+        self.close()
+        self.shards = []
+        for i in range(self.num_shards):
+            params = dict(self.shard_params)
+            if params.get('rerank_db') is not None:
+                # quantized shards re-rank from their rows of the shared db
+                params['rerank_offset'] = int(bounds[i])
+            shard = build_index(embeddings[bounds[i]:bounds[i + 1]],
+                                index_type=self.shard_type,
+                                metric=self.metric,
+                                **params)
+            if self.shard_dir is not None:
+                shard.save(self._shard_path(self.shard_dir, i))
+            else:
+                self.shards.append(shard)
+        if self.shard_dir is not None:
+            # the workers open the saved shards, nothing is kept here
+            self.shards = None
+        return self
+
+    @staticmethod
+    def _shard_path(index_dir, i):
+        return os.path.join(index_dir, f'shard_{i:04d}')
+
+    def _start_workers(self):
+        context = multiprocessing.get_context('spawn')
+        num_workers = min(self.num_workers, self.num_shards)
+        self._workers = []
+        try:
+            for w in range(num_workers):
+                shards = [(self._shard_path(self.shard_dir,
+                                            i), int(self.offsets[i]))
+                          for i in range(w, self.num_shards, num_workers)]
+                parent_conn, child_conn = context.Pipe()
+                process = context.Process(target=_shard_worker,
+                                          args=(child_conn, shards,
+                                                self.shard_params),
+                                          daemon=True)
+                process.start()
+                child_conn.close()
+                self._workers.append((process, parent_conn))
+        except Exception:
+            # do not keep a partial pool, the next search starts a new one
+            self.close()
+            raise
+
+    def close(self):
+        """Stop the worker processes."""
+        if self._workers is None:
+            return
+        for process, conn in self._workers:
+            try:
+                conn.send(None)
+                conn.close()
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(timeout=10)
+        self._workers = None
+
+    def __del__(self):
+        self.close()
+
+    def search(self, queries, k):
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries.reshape(1, -1)
+        if self.shards is not None:
+            indexes = list(zip(self.shards, self.offsets[:-1]))
+            with ThreadPoolExecutor(
+                    max_workers=min(self.num_workers, len(indexes))) as pool:
+                results = list(
+                    pool.map(lambda x: _search_shards([x], queries, k),
+                             indexes))
+        else:
+            if self._workers is None:
+                self._start_workers()
+            for _, conn in self._workers:
+                conn.send((queries, k))
+            results = [conn.recv() for _, conn in self._workers]
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+
+        distances = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        indices = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        merged_dists = distances[:, :0]
+        merged_indices = indices[:, :0]
+        for dists, ids in results:
+            merged_dists, merged_indices = merge_topk(merged_dists,
+                                                      merged_indices, dists,
+                                                      ids, k)
+        num_found = merged_dists.shape[1]
+        distances[:, :num_found] = merged_dists
+        indices[:, :num_found] = merged_indices
+        return distances, indices
+
+    def params(self):
+        params = {
+            'num_shards': self.num_shards,
+            'shard_type': self.shard_type,
+            'num_workers': self.num_workers
+        }
+        params.update(self.shard_params)
+        return params
+
+    def arrays(self):
+        return {'offsets': self.offsets}
+
+    def save(self, index_dir):
+        if self.shards is None:
+            if os.path.abspath(index_dir) != os.path.abspath(self.shard_dir):
+                raise ValueError(
+                    f'The shards are stored in {self.shard_dir}, they can '
+                    f'not be saved to another directory')
+        else:
+            for i, shard in enumerate(self.shards):
+                shard.save(self._shard_path(index_dir, i))
+        super().save(index_dir)
+
+    def _load_arrays(self, index_dir, mmap=True):
+        self.close()
+        self.offsets = np.load(os.path.join(index_dir, 'offsets.npy'))
+        with open(os.path.join(index_dir, INDEX_META_FILE)) as f:
+            self._dim = json.load(f)['dim']
+        self.shard_dir = index_dir
+        self.shards = None
+        if not mmap:
+            self.shards = [
+                load_index(self._shard_path(index_dir, i),
+                           mmap=False,
+                           **self.shard_params) for i in range(self.num_shards)
+            ]
+
+
+def compute_recall(indices, exact_indices):
+    """Recall@k of an approximate search: the fraction of the exact k
+    nearest neighbours that were retrieved."""
+    k = exact_indices.shape[1]
+    hits = 0
+    for found, exact in zip(indices, exact_indices):
+        exact = exact[exact >= 0]
+        hits += len(np.intersect1d(found[:k], exact))
+    num_exact = int((exact_indices >= 0).sum())
+    return hits / max(num_exact, 1)
+
+
+INDEX_TYPES = {
+    ExactIndex.index_type: ExactIndex,
+    IVFIndex.index_type: IVFIndex,
+    QuantizedIndex.index_type: QuantizedIndex,
+    ShardedIndex.index_type: ShardedIndex,
+}
+
+
+def build_index(embeddings, index_type='exact', metric='euclidean', **kwargs):
+    """Build a nearest-neighbour index over the reference embeddings.
+
+    Args:
+        embeddings: (N, dim) reference embedding matrix.
+        index_type: `exact`, `ivf`, `quantized` or `sharded`.
+        metric: `euclidean` or `cosine`.
+        kwargs: index specific parameters, e.g. `nlist` and `nprobe` for ivf,
+            `quantizer` and `rerank` for quantized.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(
+            f'{index_type} is not a valid index type, valid types are '
+            f'{list(INDEX_TYPES.keys())}')
+    index = INDEX_TYPES[index_type](metric=metric, **kwargs)
+    return index.build(embeddings)
+
+
+def load_index(index_dir, mmap=True, **kwargs):
+    """Load an index saved with `EmbeddingIndex.save`.
+
+    The index arrays are memory-mapped unless `mmap` is False, so opening a
+    large index is instant and its pages are shared between processes.
+    `kwargs` override the saved search parameters, e.g. `nprobe`.
+    """
+    with open(os.path.join(index_dir, INDEX_META_FILE)) as f:
+        meta = json.load(f)
+    params = meta['params']
+    params.update(kwargs)
+    index = INDEX_TYPES[meta['index_type']](metric=meta['metric'], **params)
+    index._load_arrays(index_dir, mmap=mmap)
+    return index
@@ -6,6 +6,7 @@ import torch.nn as nn
 from torch.nn import BCEWithLogitsLoss
 
 from deepfold.utils.constant import (DEFAULT_ESM_MODEL, ESM_LIST,
+                                     EXTRACTION_POOLING_MODES,
                                      POOLING_MODE_LIST)
 
 from .layers.transformer_represention import (AttentionPooling, CNNPooler,
@@ -59,6 +60,34 @@ class ESMPooler(nn.Module):
         return pooled_output
 
 
+def pool_residues(hidden_states, lengths, pool_mode):
+    """Parameter-free pooling of [batch, seq_len, hidden] representations.
+
+    `cls` takes the first token, the other modes pool the residues at
+    positions 1 to `lengths`, skipping the special tokens and padding.
+    `mean_max` concatenates the mean and the max.
+    """
+    if pool_mode not in EXTRACTION_POOLING_MODES:
+        raise ValueError(f'{pool_mode} is not a supported pooling, valid '
+                         f'poolings are {EXTRACTION_POOLING_MODES}')
+    if pool_mode == 'cls':
+        return hidden_states[:, 0]
+    positions = torch.arange(hidden_states.shape[1],
+                             device=hidden_states.device)
+    lengths = lengths.to(hidden_states.device)
+    # [batch, seq_len, 1]
+    mask = ((positions[None] >= 1) &
+            (positions[None] <= lengths[:, None])).unsqueeze(-1)
+    pooled = []
+    if pool_mode in ('mean', 'mean_max'):
+        sums = (hidden_states * mask).sum(1)
+        pooled.append(sums / lengths.clamp(min=1)[:, None])
+    if pool_mode in ('max', 'mean_max'):
+        pooled.append(
+            hidden_states.masked_fill(~mask, float('-inf')).max(1).values)
+    return torch.cat(pooled, 1)
+
+
 class EsmTransformer(nn.Module):
     """ESMTransformer."""
     def __init__(self,
@@ -210,6 +239,50 @@ class EsmTransformer(nn.Module):
 
         return outputs
 
+    def compute_pooled_embeddings(
+        self,
+        input_ids,
+        lengths,
+        layers: List[int] = None,
+        pool_modes: List[str] = ('mean', )
+    ) -> Dict[Tuple[int, str], torch.Tensor]:
+        """Embeddings of several layers and poolings from one forward pass.
+
+        Args:
+            layers: layers to pool, negative layers count from the last
+                one, defaults to `repr_layers`.
+            pool_modes: poolings, see `pool_residues`.
+        Returns:
+            dict (layer, pool_mode) -> [batch, hidden_size] embeddings
+            ([batch, 2 * hidden_size] for `mean_max`).
+        """
+        if layers is None:
+            layers = self.repr_layers
+        layers = [(i + self.num_layers + 1) % (self.num_layers + 1)
+                  for i in layers]
+        model_outputs = self._model(input_ids, repr_layers=layers)
+        embeddings_dict = {}
+        for layer in layers:
+            hidden_states = model_outputs['representations'][layer]
+            for pool_mode in pool_modes:
+                embeddings_dict[(layer, pool_mode)] = pool_residues(
+                    hidden_states, lengths, pool_mode)
+        return embeddings_dict
+
+    def compute_residue_embeddings(self,
+                                   input_ids,
+                                   lengths,
+                                   layer: int = -1) -> List[torch.Tensor]:
+        """[length, hidden_size] residue representations of every sequence
+        at `layer`, without the special tokens and padding."""
+        layer = (layer + self.num_layers + 1) % (self.num_layers + 1)
+        model_outputs = self._model(input_ids, repr_layers=[layer])
+        hidden_states = model_outputs['representations'][layer]
+        return [
+            emb[1:int(length) + 1]
+            for emb, length in zip(hidden_states, lengths)
+        ]
+
     def compute_embeddings(
             self, input_ids, lengths,
             labels) -> Dict[str, Union[List[torch.Tensor], torch.Tensor]]:
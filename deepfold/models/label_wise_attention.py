@@ -129,10 +129,12 @@ class P2GO(nn.Module):
                  batch_size=4,
                  nb_classes=5874):
         super().__init__()
-        # backbone
+        # backbone, None when the model is trained on precomputed residue
+        # embeddings (see `ResidueEmbeddingDataset`)
         self.backbone = backbone
-        for p in self.backbone.parameters():
-            p.requires_grad = False
+        if self.backbone is not None:
+            for p in self.backbone.parameters():
+                p.requires_grad = False
         self.batch_size = batch_size
         self.nb_classes = nb_classes
         # AA_emebdding transform
@@ -166,9 +168,10 @@ class P2GO(nn.Module):
             nn.Linear(int(2 * latent_dim), latent_dim), nn.ReLU())
 
     def forward(self, x, valid_len, adj, term_ids):
-        # backbone
-        x = self.backbone(x, repr_layers=[33])['representations'][33]
-        x = x[:, 1:]
+        # backbone, without it x holds the residue embeddings [B,L,aa_dim]
+        if self.backbone is not None:
+            x = self.backbone(x, repr_layers=[33])['representations'][33]
+            x = x[:, 1:]
         # x [B,L,C]
         # AA_embedding transform
         x = self.aa_transform(x)
@@ -2,6 +2,113 @@ import time
 
 import numpy as np
 import torch
+from torch.utils.data import DataLoader, Subset
+
+from deepfold.data.samplers import TokenBudgetBatchSampler, batch_order
+
+
+class BatchWriter(object):
+    """Writes batches of (device) tensors into one preallocated array.
+
+    Every batch is copied into a pinned host staging buffer with a
+    non-blocking copy and written to the output one batch later, so the
+    device to host copy overlaps with the next forward pass and neither
+    the device nor the host holds more than two batches besides the
+    output. The output is allocated at the first batch unless it is given,
+    e.g. as a `np.memmap` to stream large outputs to disk.
+
+    Args:
+        num_samples: number of rows of the output.
+        out: optional (num_samples, ...) output array.
+    """
+    def __init__(self, num_samples, out=None):
+        self.num_samples = num_samples
+        self.out = out
+        self.pos = 0
+        self.step = 0
+        self.buffers = [None, None]
+        self.pending = None
+
+    def write(self, batch):
+        batch = batch.detach()
+        if self.out is None:
+            dtype = torch.empty(0, dtype=batch.dtype).numpy().dtype
+            self.out = np.empty((self.num_samples, ) + tuple(batch.shape[1:]),
+                                dtype=dtype)
+        # two staging buffers, one is copied into while the other one is
+        # written to the output
+        slot = self.step % 2
+        self.step += 1
+        buffer = self.buffers[slot]
+        if (buffer is None or len(buffer) < len(batch)
+                or buffer.shape[1:] != batch.shape[1:]):
+            buffer = torch.empty(batch.shape,
+                                 dtype=batch.dtype,
+                                 pin_memory=batch.is_cuda)
+            self.buffers[slot] = buffer
+        buffer[:len(batch)].copy_(batch, non_blocking=batch.is_cuda)
+        event = None
+        if batch.is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self.flush()
+        self.pending = (buffer, len(batch), event)
+
+    def flush(self):
+        if self.pending is None:
+            return
+        buffer, size, event = self.pending
+        if event is not None:
+            event.synchronize()
+        self.out[self.pos:self.pos + size] = buffer[:size].numpy()
+        self.pos += size
+        self.pending = None
+
+    def close(self):
+        """The output, cut to the rows written."""
+        self.flush()
+        if self.out is None:
+            return np.empty((0, ))
+        if self.pos != len(self.out):
+            return self.out[:self.pos]
+        return self.out
+
+
+def extraction_loader(dataset,
+                      indices,
+                      batch_size,
+                      num_workers=4,
+                      max_tokens=None):
+    """DataLoader over the samples `indices` of `dataset`.
+
+    With `max_tokens` the samples are batched by token budget (at most
+    `batch_size` per batch) and `order` is returned to put the outputs back
+    in the order of `indices` (``outputs[order]``), otherwise `order` is
+    None.
+
+    :return: data_loader, order
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    subset = Subset(dataset, indices.tolist())
+    if max_tokens is None:
+        data_loader = DataLoader(subset,
+                                 batch_size=batch_size,
+                                 shuffle=False,
+                                 num_workers=num_workers,
+                                 collate_fn=dataset.collate_fn,
+                                 pin_memory=True)
+        return data_loader, None
+    lengths = np.asarray(dataset.lengths)[indices]
+    batch_sampler = TokenBudgetBatchSampler(lengths,
+                                            max_tokens,
+                                            max_batch_size=batch_size,
+                                            shuffle=False)
+    data_loader = DataLoader(subset,
+                             batch_sampler=batch_sampler,
+                             num_workers=num_workers,
+                             collate_fn=dataset.collate_fn,
+                             pin_memory=True)
+    return data_loader, np.argsort(batch_order(batch_sampler))
 
 
 def extract_esm_embedds(model, data_loader, pool_mode, logger, device='cuda'):
@@ -39,43 +146,141 @@ def extract_esm_embedds(model, data_loader, pool_mode, logger, device='cuda'):
     return embeddings, true_labels
 
 
-def extract_seq_embedds(model, data_loader, pool_mode, logger, device='cuda'):
-    true_labels = torch.Tensor()
-    embeddings = torch.Tensor()
+def extract_pooled_embedds(model,
+                           data_loader,
+                           layers,
+                           pool_modes,
+                           logger,
+                           device='cuda'):
+    """Embeddings of every (layer, pool_mode) from one pass over the data,
+    see `EsmTransformer.compute_pooled_embeddings`.
+
+    :return: dict (layer, pool_mode) -> embeddings, true_labels
+    """
+    embeddings = {}
+    true_labels = []
     steps = len(data_loader)
     with torch.no_grad():
         end = time.time()
         start = time.time()
         for batch_idx, batch in enumerate(data_loader):
+            data_time = time.time() - end
+            batch = {key: val.to(device) for key, val in batch.items()}
+            embeddings_dict = model.compute_pooled_embeddings(
+                batch['input_ids'],
+                batch['lengths'],
+                layers=layers,
+                pool_modes=pool_modes)
+            for key, val in embeddings_dict.items():
+                embeddings.setdefault(key, []).append(val.to('cpu').numpy())
+            true_labels.append(batch['labels'].to('cpu').numpy())
+            batch_time = time.time() - end
+            total_time = time.time() - start
+            end = time.time()
+            logger.info('{0}: [{1:>2d}/{2}] '
+                        'Datat Time: {data_time:.3f} '
+                        'Batch Time: {batch_time:.3f} '
+                        'Total Time: {total_time:.3f} '.format(
+                            'Extract embeddings',
+                            batch_idx + 1,
+                            steps,
+                            data_time=data_time,
+                            batch_time=batch_time,
+                            total_time=total_time))
+    embeddings = {
+        key: np.concatenate(val, axis=0)
+        for key, val in embeddings.items()
+    }
+    true_labels = np.concatenate(true_labels, axis=0)
+    return embeddings, true_labels
 
-            batch_labels = batch['labels']
-            batch_lengths = batch['lengths']
-            model_inputs = {key: val.to(device) for key, val in batch.items()}
-            model_outputs = model(**model_inputs, output_hidden_states=True)
 
-            last_hidden_state = model_outputs.hidden_states[-1].detach().cpu()
-            # batch_embeddings: batch_size * seq_length * embedding_dim
+def extract_residue_embedds(model, data_loader, layer, logger, device='cuda'):
+    """Yield the per-residue embeddings of every batch, as lists of
+    (length, hidden_size) float32 arrays, see
+    `EsmTransformer.compute_residue_embeddings`."""
+    steps = len(data_loader)
+    with torch.no_grad():
+        end = time.time()
+        start = time.time()
+        for batch_idx, batch in enumerate(data_loader):
+            data_time = time.time() - end
+            residue_embeddings = model.compute_residue_embeddings(
+                batch['input_ids'].to(device), batch['lengths'], layer=layer)
+            yield [emb.float().cpu().numpy() for emb in residue_embeddings]
+            batch_time = time.time() - end
+            total_time = time.time() - start
+            end = time.time()
+            logger.info('{0}: [{1:>2d}/{2}] '
+                        'Datat Time: {data_time:.3f} '
+                        'Batch Time: {batch_time:.3f} '
+                        'Total Time: {total_time:.3f} '.format(
+                            'Extract residue embeddings',
+                            batch_idx + 1,
+                            steps,
+                            data_time=data_time,
+                            batch_time=batch_time,
+                            total_time=total_time))
 
-            batch_embedding_list = [emb for emb in last_hidden_state]
-            # Remove class token and padding
-            batch_length_list = [ll for ll in batch_lengths]
 
-            filtered_embeddings = [
-                emb[1:(length + 1), :]
-                for emb, length in zip(batch_embedding_list, batch_length_list)
-            ]
+def mean_pool_tokens(hidden_state, attention_mask):
+    """Mean of the hidden states of the tokens between the class and the
+    end token of every (right padded) sequence.
 
-            if 'mean' in pool_mode:
-                batch_embeddings = torch.stack(
-                    [torch.mean(emb, dim=0) for emb in filtered_embeddings])
+    The tokens are counted from the attention mask rather than from the
+    number of residues, which differs for subword tokenizers, so the
+    embedding of a sequence does not depend on the padding of its batch.
+    """
+    num_tokens = attention_mask.sum(dim=1)
+    mask = attention_mask.clone()
+    mask[:, 0] = 0
+    mask[torch.arange(len(mask), device=mask.device), num_tokens - 1] = 0
+    mask = mask.unsqueeze(-1).to(hidden_state.dtype)
+    return (hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
 
-            # keep class token only
-            if 'cls' in pool_mode:
-                batch_embeddings = torch.stack(
-                    [emb[0, :] for emb in batch_embedding_list])
 
-            embeddings = torch.cat((embeddings, batch_embeddings), dim=0)
-            true_labels = torch.cat((true_labels, batch_labels), dim=0)
+def extract_seq_embedds(model,
+                        data_loader,
+                        pool_mode,
+                        logger,
+                        device='cuda',
+                        out=None):
+    """Pooled last hidden states of a transformers model.
+
+    The output is preallocated from the dataset length and every batch is
+    pooled on the device and copied into place, see `BatchWriter`.
+
+    :param out: optional (len(dataset), hidden_size) array the embeddings
+        are written to, e.g. a `np.memmap`, allocated if None
+    :return: embeddings, true_labels
+    """
+    num_samples = len(data_loader.dataset)
+    embeddings = BatchWriter(num_samples, out)
+    true_labels = BatchWriter(num_samples)
+    steps = len(data_loader)
+    with torch.no_grad():
+        end = time.time()
+        start = time.time()
+        for batch_idx, batch in enumerate(data_loader):
+            model_inputs = {
+                key: val.to(device, non_blocking=True)
+                for key, val in batch.items()
+            }
+            model_outputs = model(**model_inputs, output_hidden_states=True)
+            # batch_size * seq_length * embedding_dim
+            last_hidden_state = model_outputs.hidden_states[-1]
+            if 'cls' in pool_mode:
+                # keep class token only
+                batch_embeddings = last_hidden_state[:, 0]
+            elif 'mean' in pool_mode:
+                # mean of the sequence tokens, class and end tokens and
+                # padding removed
+                batch_embeddings = mean_pool_tokens(
+                    last_hidden_state, model_inputs['attention_mask'])
+            else:
+                raise ValueError(f'{pool_mode} is not a supported pooling')
+            embeddings.write(batch_embeddings)
+            true_labels.write(model_inputs['labels'])
 
             batch_time = time.time() - end
             total_time = time.time() - start
@@ -85,38 +290,45 @@ def extract_seq_embedds(model, data_loader, pool_mode, logger, device='cuda'):
                         'Total Time: {total_time:.3f} '.format(
                             'Extract embeddings',
                             batch_idx + 1,
-                            steps + 1,
+                            steps,
                             batch_time=batch_time,
                             total_time=total_time))
-    embeddings = embeddings.numpy()
-    true_labels = true_labels.numpy()
-    return embeddings, true_labels
+    return embeddings.close(), true_labels.close()
 
 
 def extract_sentence_embedds(model,
                              data_loader,
                              pool_mode,
                              logger,
-                             device='cuda'):
-    embeddings = torch.Tensor()
+                             device='cuda',
+                             out=None):
+    """Pooled last hidden states of a transformers model, see
+    `extract_seq_embedds`; `mean` averages over all positions.
+
+    :param out: optional (len(dataset), hidden_size) output array
+    """
+    embeddings = BatchWriter(len(data_loader.dataset), out)
     steps = len(data_loader)
     with torch.no_grad():
         end = time.time()
         start = time.time()
         for batch_idx, batch in enumerate(data_loader):
-            model_inputs = {key: val.to(device) for key, val in batch.items()}
+            model_inputs = {
+                key: val.to(device, non_blocking=True)
+                for key, val in batch.items()
+            }
             model_outputs = model(**model_inputs, output_hidden_states=True)
-            last_hidden_state = model_outputs.hidden_states[-1].detach().cpu()
-            # batch_embeddings: batch_size * seq_length * embedding_dim
-            if 'mean' in pool_mode:
-                mean_embedding = torch.mean(last_hidden_state, dim=1)
-                batch_embeddings = torch.squeeze(mean_embedding, 1)
-            # keep class token only
+            # batch_size * seq_length * embedding_dim
+            last_hidden_state = model_outputs.hidden_states[-1]
             if 'cls' in pool_mode:
-                mean_embedding = last_hidden_state[:, 0, :]
-                batch_embeddings = torch.squeeze(mean_embedding, 1)
+                # keep class token only
+                batch_embeddings = last_hidden_state[:, 0]
+            elif 'mean' in pool_mode:
+                batch_embeddings = torch.mean(last_hidden_state, dim=1)
+            else:
+                raise ValueError(f'{pool_mode} is not a supported pooling')
+            embeddings.write(batch_embeddings)
 
-            embeddings = torch.cat((embeddings, batch_embeddings), dim=0)
             batch_time = time.time() - end
             total_time = time.time() - start
             end = time.time()
@@ -125,8 +337,7 @@ def extract_sentence_embedds(model,
                         'Total Time: {total_time:.3f} '.format(
                             'Extract embeddings',
                             batch_idx + 1,
-                            steps + 1,
+                            steps,
                             batch_time=batch_time,
                             total_time=total_time))
-    embeddings = embeddings.numpy()
-    return embeddings
+    return embeddings.close()
@@ -12,22 +12,48 @@ from deepfold.utils.model import reduce_tensor, save_checkpoint
 from deepfold.utils.summary import update_summary
 
 
-def get_train_step(model, optimizer, scaler, gradient_accumulation_steps,
-                   use_amp):
+def get_train_step(model,
+                   optimizer,
+                   scaler,
+                   gradient_accumulation_steps,
+                   use_amp,
+                   sample_weighted=False):
+    """One forward / backward pass, followed by an optimizer step when
+    `optimizer_step` is set.
+
+    With `sample_weighted`, for batches of variable size (token-budget
+    batching), every batch contributes to the accumulated gradient in
+    proportion to its number of samples: the batch losses are summed over
+    samples and the gradient is divided by the number of samples of the
+    accumulation window (averaged over processes) before the step.
+    """
+    num_samples = 0
+
     def _step(inputs, optimizer_step=True):
+        nonlocal num_samples
         # Runs the forward pass with autocasting.
         with autocast(enabled=use_amp):
             outputs = model(**inputs)
             loss = outputs[0]
-            loss /= gradient_accumulation_steps
+            if sample_weighted:
+                batch_size = inputs['labels'].shape[0]
+                num_samples += batch_size
+            else:
+                loss /= gradient_accumulation_steps
             if torch.distributed.is_initialized():
                 reduced_loss = reduce_tensor(loss.data)
             else:
                 reduced_loss = loss.data
 
-        scaler.scale(loss).backward()
+        if sample_weighted:
+            scaler.scale(loss * batch_size).backward()
+        else:
+            scaler.scale(loss).backward()
 
         if optimizer_step:
+            if sample_weighted:
+                scale_gradients(model, num_samples)
+                num_samples = 0
             scaler.step(optimizer)
             scaler.update()
             optimizer.zero_grad()
@@ -38,6 +64,20 @@ def get_train_step(model, optimizer, scaler, gradient_accumulation_steps,
     return _step
 
 
+def scale_gradients(model, num_samples):
+    """Turn the gradients of summed sample losses into the gradients of
+    the mean loss over all samples of all processes."""
+    device = next(model.parameters()).device
+    # DistributedDataParallel averages the gradients over the processes
+    num_samples = torch.tensor(float(num_samples), device=device)
+    if torch.distributed.is_initialized():
+        torch.distributed.all_reduce(num_samples)
+        num_samples /= torch.distributed.get_world_size()
+    for param in model.parameters():
+        if param.grad is not None:
+            param.grad.div_(num_samples)
+
+
 def train(model,
           loader,
           optimizer,
@@ -46,13 +86,15 @@ def train(model,
           use_amp,
           epoch,
           logger,
-          log_interval=1):
+          log_interval=1,
+          sample_weighted=False):
     batch_time_m = AverageMeter('Time', ':6.3f')
     data_time_m = AverageMeter('Data', ':6.3f')
     losses_m = AverageMeter('Loss', ':.4e')
 
     step = get_train_step(model, optimizer, scaler,
-                          gradient_accumulation_steps, use_amp)
+                          gradient_accumulation_steps, use_amp,
+                          sample_weighted)
 
     model.train()
     optimizer.zero_grad()
@@ -65,6 +107,9 @@ def train(model,
         data_time = time.time() - end
 
         optimizer_step = ((idx + 1) % gradient_accumulation_steps) == 0
+        if sample_weighted:
+            # a partial window is still averaged correctly
+            optimizer_step = optimizer_step or idx == steps_per_epoch - 1
         loss = step(batch, optimizer_step)
         batch_size = batch['labels'].shape[0]
 
@@ -290,7 +335,8 @@ def train_loop(model,
                save_checkpoints=True,
                output_dir='./',
                log_wandb=False,
-               log_interval=10):
+               log_interval=10,
+               sample_weighted=False):
     is_best = True
     if early_stopping_patience > 0:
         epochs_since_improvement = 0
@@ -301,10 +347,15 @@ def train_loop(model,
     logger.info('Evaluation: %s' % (eval_metrics))
     logger.info(f'RUNNING EPOCHS FROM {start_epoch} TO {end_epoch}')
     for epoch in range(start_epoch, end_epoch):
+        # reshuffle distributed / length-bucketed samplers every epoch
+        for sampler in (train_loader, getattr(train_loader, 'sampler', None),
+                        getattr(train_loader, 'batch_sampler', None)):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
         if not skip_training:
             train_metrics = train(model, train_loader, optimizer, scaler,
                                   gradient_accumulation_steps, use_amp, epoch,
-                                  logger, log_interval)
+                                  logger, log_interval, sample_weighted)
 
             logger.info('[Epoch %d] training: %s' % (epoch + 1, train_metrics))
 
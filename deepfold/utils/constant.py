@@ -10,6 +10,24 @@ ESM_LIST = [
     'esm1v_t33_650M_UR90S_1',
 ]
 
+# architecture of the alphabet of every esm model, see
+# `esm.Alphabet.from_architecture`
+ESM_ALPHABET_ARCH = {
+    'esm1_t34_670M_UR50S': 'ESM-1',
+    'esm1_t34_670M_UR50D': 'ESM-1',
+    'esm1_t34_670M_UR100': 'ESM-1',
+    'esm1_t12_85M_UR50S': 'ESM-1',
+    'esm1_t6_43M_UR50S': 'ESM-1',
+    'esm1b_t33_650M_UR50S': 'ESM-1b',
+    'esm_msa1_t12_100M_UR50S': 'msa_transformer',
+    'esm_msa1b_t12_100M_UR50S': 'msa_transformer',
+    'esm1v_t33_650M_UR90S_1': 'ESM-1b',
+    'esm1v_t33_650M_UR90S_2': 'ESM-1b',
+    'esm1v_t33_650M_UR90S_3': 'ESM-1b',
+    'esm1v_t33_650M_UR90S_4': 'ESM-1b',
+    'esm1v_t33_650M_UR90S_5': 'ESM-1b',
+}
+
 ROSTLAB_LIST = ['Rostlab/prot_bert', 'Rostlab/prot_bert_bfd']
 
 MAPPING_PROTBERT = {
@@ -28,4 +46,8 @@ POOLING_MODE_LIST = [
     'cls', 'mean', 'mean_max', 'pooler', 'cnn', 'weighted', 'attention', 'lstm'
 ]
 
+# parameter-free poolings computed from the residue representations of a
+# frozen backbone, see `EsmTransformer.compute_pooled_embeddings`
+EXTRACTION_POOLING_MODES = ['cls', 'mean', 'max', 'mean_max']
+
 DEFAULT_POOL_MODE = 'cls'
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from deepfold.utils.embedding_db import EmbeddingDB
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = 'cache.json'
+
+
+def sequence_hash(sequence):
+    """Content hash of a protein sequence."""
+    return hashlib.blake2b(sequence.encode(), digest_size=16).hexdigest()
+
+
+class EmbeddingCache(object):
+    """Persistent cache of sequence embeddings, addressed by content.
+
+    The embeddings of one extraction setting (model, layer, pooling and
+    truncation) are kept in an append-only `EmbeddingDB` whose row ids are
+    the hashes of the sequences, so a sequence is embedded once whatever
+    protein, split or release it comes from. Extraction asks for the
+    `missing` sequences, embeds only those, `add`s them and reads every
+    output row back from the cache with `get`, so re-embedding a dataset
+    costs time proportional to its new sequences. The store of a setting is
+    a sub directory of `cache_dir` named after the setting; it has a single
+    writer at a time.
+
+    Args:
+        cache_dir: root directory of the cache.
+        model_name: name of the embedding model.
+        layer: layer the embeddings are taken from.
+        pool_mode: pooling of the residue embeddings.
+        max_length: length sequences are truncated to, None if they are not.
+        dtype: storage dtype of the embeddings.
+    """
+    def __init__(self,
+                 cache_dir,
+                 model_name,
+                 layer=-1,
+                 pool_mode='mean',
+                 max_length=None,
+                 dtype='float32'):
+        self.config = {
+            'model': model_name,
+            'layer': layer,
+            'pool_mode': pool_mode,
+            'max_length': max_length,
+            'dtype': dtype
+        }
+        key = hashlib.blake2b(json.dumps(self.config, sort_keys=True).encode(),
+                              digest_size=8).hexdigest()
+        name = os.path.basename(str(model_name).rstrip('/'))
+        self.db_dir = os.path.join(cache_dir, f'{name}_{pool_mode}_{key}')
+        self.dtype = dtype
+        self.db = None
+        if EmbeddingDB.exists(self.db_dir):
+            self.db = EmbeddingDB(self.db_dir, mode='r+')
+
+    def __len__(self):
+        return 0 if self.db is None else len(self.db)
+
+    def __contains__(self, sequence):
+        return self.db is not None and sequence_hash(sequence) in self.db
+
+    def missing(self, sequences):
+        """Indices of the sequences that are not cached, one index per
+        distinct sequence."""
+        indices = []
+        seen = set()
+        for i, sequence in enumerate(sequences):
+            key = sequence_hash(sequence)
+            if key in seen or (self.db is not None and key in self.db):
+                continue
+            seen.add(key)
+            indices.append(i)
+        return indices
+
+    def add(self, sequences, embeddings):
+        """Append the (len(sequences), dim) embeddings of `sequences`,
+        sequences that are already cached are skipped."""
+        embeddings = np.asarray(embeddings).reshape(len(sequences), -1)
+        if self.db is None:
+            self.db = EmbeddingDB.create(self.db_dir,
+                                         embeddings.shape[1],
+                                         dtype=self.dtype)
+            with open(os.path.join(self.db_dir, CONFIG_FILE), 'w') as f:
+                json.dump(self.config, f, indent=2)
+        keys = []
+        rows = []
+        seen = set()
+        for i, sequence in enumerate(sequences):
+            key = sequence_hash(sequence)
+            if key not in seen and key not in self.db:
+                seen.add(key)
+                keys.append(key)
+                rows.append(i)
+        if keys:
+            self.db.append(keys, embeddings[rows])
+
+    def get(self, sequences):
+        """Cached embeddings of `sequences` as one (len(sequences), dim)
+        array, raises KeyError if one of them is not cached."""
+        if self.db is None:
+            if len(sequences) == 0:
+                return np.empty((0, 0), dtype=self.dtype)
+            raise KeyError(f'{self.db_dir} is empty')
+        return self.db.get_rows([sequence_hash(seq) for seq in sequences])
+
+    def get_or_compute(self, sequences, compute_fn):
+        """Embeddings of `sequences`, only the missing ones are computed.
+
+        :param sequences: list of protein sequences
+        :param compute_fn: maps a list of indices into `sequences` to the
+            (len(indices), dim) embeddings of those sequences
+        """
+        missing = self.missing(sequences)
+        logger.info(f'Embedding {len(missing)} distinct sequences of '
+                    f'{len(sequences)} missing from the cache {self.db_dir}')
+        if missing:
+            self.add([sequences[i] for i in missing], compute_fn(missing))
+        return self.get(sequences)
+
+
+def get_or_compute_many(caches, sequences, compute_fn):
+    """`EmbeddingCache.get_or_compute` for several caches filled by the
+    same computation (e.g. several layers or poolings of one forward pass).
+
+    :param caches: dict key -> `EmbeddingCache`
+    :param compute_fn: maps a list of indices into `sequences` to a dict
+        key -> (len(indices), dim) embeddings
+    :return: dict key -> (len(sequences), dim) embeddings
+    """
+    missing = sorted(
+        set(i for cache in caches.values() for i in cache.missing(sequences)))
+    logger.info(f'Embedding {len(missing)} distinct sequences of '
+                f'{len(sequences)} missing from {len(caches)} caches')
+    if missing:
+        embeddings = compute_fn(missing)
+        missing_seqs = [sequences[i] for i in missing]
+        for key, cache in caches.items():
+            cache.add(missing_seqs, embeddings[key])
+    return {key: cache.get(sequences) for key, cache in caches.items()}
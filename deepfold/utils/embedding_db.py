@@ -0,0 +1,241 @@
+import json
+import os
+import pickle
+
+import h5py
+import numpy as np
+import pandas as pd
+
+META_FILE = 'meta.json'
+DATA_FILE = 'embeddings.bin'
+IDS_FILE = 'ids.txt'
+SUPPORTED_DTYPES = ['float32', 'float16']
+
+
+class EmbeddingDB(object):
+    """On-disk database of fixed-size protein embeddings.
+
+    A database is a directory holding
+
+    - ``embeddings.bin``: one contiguous row-major (size, dim) matrix,
+    - ``ids.txt``: the protein id of every row, one per line,
+    - ``meta.json``: the header with `dim`, `dtype` and `size`.
+
+    The matrix is memory-mapped when the database is opened, so opening a
+    multi-GB reference set is instant, rows are only read when they are
+    used and the pages are shared between processes that open the same
+    database. The database behaves like the dict of embeddings returned by
+    ``file_utils.read_embeddings`` (`keys`, `items`, `[id]`), and `matrix`
+    gives the whole matrix without copying.
+
+    `append` writes the header last and an opened database only sees the
+    rows counted in its header, so an interrupted append is invisible and
+    its partial rows are truncated by the next one.
+
+    Args:
+        db_dir: database directory, see `create` for a new database.
+        mode: `r` to open read-only, `r+` to allow `append`.
+    """
+    def __init__(self, db_dir, mode='r'):
+        self.db_dir = db_dir
+        self.mode = mode
+        with open(os.path.join(db_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(db_dir, IDS_FILE)) as f:
+            ids = [line.rstrip('\n') for line in f]
+        assert len(ids) >= self.meta['size'], (
+            'Number of ids does not match the database header')
+        # ids past the header are leftovers of an interrupted append
+        self._ids_complete = len(ids) == self.meta['size']
+        self.ids = ids[:self.meta['size']]
+        self._id_to_index = None
+        self._matrix = None
+
+    @classmethod
+    def create(cls, db_dir, dim, dtype='float32', overwrite=False):
+        """Create an empty database opened for appending."""
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f'{dtype} is not a supported dtype, valid dtypes '
+                             f'are {SUPPORTED_DTYPES}')
+        if os.path.exists(os.path.join(db_dir, META_FILE)) and not overwrite:
+            raise FileExistsError(f'{db_dir} already holds an embedding db')
+        os.makedirs(db_dir, exist_ok=True)
+        open(os.path.join(db_dir, DATA_FILE), 'wb').close()
+        open(os.path.join(db_dir, IDS_FILE), 'w').close()
+        meta = {'dim': int(dim), 'dtype': dtype, 'size': 0}
+        with open(os.path.join(db_dir, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+        return cls(db_dir, mode='r+')
+
+    @staticmethod
+    def exists(db_dir):
+        return os.path.exists(os.path.join(db_dir, META_FILE))
+
+    @property
+    def dim(self):
+        return self.meta['dim']
+
+    @property
+    def dtype(self):
+        return np.dtype(self.meta['dtype'])
+
+    @property
+    def matrix(self):
+        """(size, dim) memory-mapped embedding matrix."""
+        if self._matrix is None:
+            if len(self) == 0:
+                self._matrix = np.empty((0, self.dim), dtype=self.dtype)
+            else:
+                self._matrix = np.memmap(os.path.join(self.db_dir, DATA_FILE),
+                                         dtype=self.dtype,
+                                         mode='r',
+                                         shape=(len(self), self.dim))
+        return self._matrix
+
+    @property
+    def id_to_index(self):
+        if self._id_to_index is None:
+            self._id_to_index = {k: i for i, k in enumerate(self.ids)}
+        return self._id_to_index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, prot_id):
+        return prot_id in self.id_to_index
+
+    def __getitem__(self, prot_id):
+        return self.matrix[self.id_to_index[prot_id]]
+
+    def keys(self):
+        return list(self.ids)
+
+    def values(self):
+        return iter(self.matrix)
+
+    def items(self):
+        return zip(self.ids, self.matrix)
+
+    def get_rows(self, prot_ids):
+        """Embeddings of `prot_ids` as one (len(prot_ids), dim) array."""
+        return self.matrix[[self.id_to_index[k] for k in prot_ids]]
+
+    def append(self, prot_ids, embeddings):
+        """Append a block of embeddings at the end of the database.
+
+        :param prot_ids: protein id of every row
+        :param embeddings: (len(prot_ids), dim) array
+        """
+        if self.mode != 'r+':
+            raise RuntimeError(
+                f'{self.db_dir} is opened read-only, open it with mode r+')
+        prot_ids = [str(k) for k in prot_ids]
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype)
+        if embeddings.ndim != 2 or embeddings.shape[1] != self.dim:
+            raise ValueError(
+                f'Expected embeddings of shape (n, {self.dim}), got '
+                f'{embeddings.shape}')
+        if embeddings.shape[0] != len(prot_ids):
+            raise ValueError('Number of ids and embeddings do not match')
+        if any('\n' in k for k in prot_ids):
+            raise ValueError('Protein ids must not contain newlines')
+
+        with open(os.path.join(self.db_dir, DATA_FILE), 'r+b') as f:
+            f.seek(len(self) * self.dim * self.dtype.itemsize)
+            f.truncate()
+            f.write(embeddings.tobytes())
+        if not self._ids_complete:
+            with open(os.path.join(self.db_dir, IDS_FILE), 'w') as f:
+                f.writelines(k + '\n' for k in self.ids)
+            self._ids_complete = True
+        with open(os.path.join(self.db_dir, IDS_FILE), 'a') as f:
+            f.writelines(k + '\n' for k in prot_ids)
+        # rows only count once the header is rewritten
+        self.ids.extend(prot_ids)
+        self.meta['size'] = len(self.ids)
+        with open(os.path.join(self.db_dir, META_FILE), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        self._matrix = None
+        self._id_to_index = None
+
+    def to_dict(self):
+        """Copy the database into a dict of numpy arrays."""
+        return {k: np.array(v) for k, v in self.items()}
+
+
+def iter_embedding_file(file_in,
+                        id_column='proteins',
+                        embedding_column='embeddings',
+                        chunk_size=10000):
+    """Iterate over (ids, embeddings) chunks of an existing embedding file.
+
+    Supported formats:
+
+    - `.h5`/`.hdf5`: one dataset per protein (bio_embeddings pipeline),
+    - `.npz`: `ids` and `embeddings` arrays, or one array per protein,
+    - `.pkl`: a DataFrame with `id_column` and `embedding_column`, or a
+      dict protein id -> embedding.
+    """
+    ext = os.path.splitext(file_in)[1]
+    if ext in ('.h5', '.hdf5'):
+        with h5py.File(file_in, 'r') as f:
+            keys = list(f.keys())
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                yield chunk, np.stack([np.array(f[k]) for k in chunk])
+        return
+
+    if ext == '.npz':
+        data = np.load(file_in)
+        if 'ids' in data.files and 'embeddings' in data.files:
+            ids = [str(k) for k in data['ids']]
+            embeddings = data['embeddings']
+        else:
+            ids = data.files
+            embeddings = None
+    elif ext == '.pkl':
+        with open(file_in, 'rb') as f:
+            data = pickle.load(f)
+        if isinstance(data, pd.DataFrame):
+            ids = [str(k) for k in data[id_column]]
+            embeddings = data[embedding_column].values
+        else:
+            ids = list(data.keys())
+            embeddings = None
+    else:
+        raise ValueError(f'Unsupported embedding file format: {file_in}')
+
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        if embeddings is None:
+            block = np.stack([np.asarray(data[k]) for k in chunk])
+        else:
+            block = np.stack(
+                [np.asarray(e) for e in embeddings[start:start + chunk_size]])
+        yield chunk, block
+
+
+def convert_embeddings(file_in,
+                       db_dir,
+                       dtype='float32',
+                       id_column='proteins',
+                       embedding_column='embeddings',
+                       chunk_size=10000,
+                       overwrite=False):
+    """Convert an h5/npz/pkl embedding file into an `EmbeddingDB`."""
+    db = None
+    for ids, embeddings in iter_embedding_file(
+            file_in,
+            id_column=id_column,
+            embedding_column=embedding_column,
+            chunk_size=chunk_size):
+        embeddings = embeddings.reshape(len(ids), -1)
+        if db is None:
+            db = EmbeddingDB.create(db_dir,
+                                    embeddings.shape[1],
+                                    dtype=dtype,
+                                    overwrite=overwrite)
+        db.append(ids, embeddings)
+    if db is None:
+        raise ValueError(f'No embeddings found in {file_in}')
+    return EmbeddingDB(db_dir)
@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from deepfold.utils.embedding_db import EmbeddingDB
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'manifest.json'
+
+
+class ShardedExtraction(object):
+    """Resumable extraction of a dataset into fixed-size shards.
+
+    The samples are split into shards of `shard_size` consecutive rows.
+    Every finished shard is saved as ``shard_xxxxx.npy`` and recorded in
+    ``manifest.json``, which is replaced atomically after the shard file,
+    so an interrupted run loses at most the shard in progress and a restart
+    only computes the shards missing from the manifest. Only one shard is
+    held in memory at a time. `merge` streams the shards in order into an
+    `EmbeddingDB`.
+
+    Args:
+        shard_dir: directory of the shards and of the manifest.
+        num_samples: number of samples of the dataset.
+        shard_size: number of samples per shard.
+        config: settings of the extraction (model, pooling, data file...),
+            a restart with different settings is refused.
+    """
+    def __init__(self, shard_dir, num_samples, shard_size=50000, config=None):
+        self.shard_dir = shard_dir
+        manifest = {
+            'num_samples': int(num_samples),
+            'shard_size': int(shard_size),
+            'config': config or {},
+            'shards': {}
+        }
+        manifest_file = os.path.join(shard_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                saved = json.load(f)
+            for key in ('num_samples', 'shard_size', 'config'):
+                if saved[key] != manifest[key]:
+                    raise ValueError(
+                        f'{shard_dir} holds an extraction with {key} '
+                        f'{saved[key]}, not {manifest[key]}')
+            manifest = saved
+        else:
+            os.makedirs(shard_dir, exist_ok=True)
+        self.manifest = manifest
+
+    @property
+    def num_samples(self):
+        return self.manifest['num_samples']
+
+    @property
+    def shard_size(self):
+        return self.manifest['shard_size']
+
+    @property
+    def num_shards(self):
+        return -(-self.num_samples // self.shard_size)
+
+    def shard_range(self, shard):
+        start = shard * self.shard_size
+        return start, min(start + self.shard_size, self.num_samples)
+
+    def shard_file(self, shard):
+        return os.path.join(self.shard_dir, f'shard_{shard:05d}.npy')
+
+    def pending(self):
+        """Shards that are not finished yet."""
+        return [
+            shard for shard in range(self.num_shards)
+            if str(shard) not in self.manifest['shards']
+        ]
+
+    def is_complete(self):
+        return not self.pending()
+
+    def write_shard(self, shard, embeddings):
+        """Save the (shard length, ...) embeddings of `shard`."""
+        start, stop = self.shard_range(shard)
+        embeddings = np.asarray(embeddings)
+        if len(embeddings) != stop - start:
+            raise ValueError(f'Shard {shard} has {stop - start} samples, got '
+                             f'{len(embeddings)} embeddings')
+        tmp_file = self.shard_file(shard) + '.tmp.npy'
+        np.save(tmp_file, embeddings)
+        os.replace(tmp_file, self.shard_file(shard))
+        self.manifest['shards'][str(shard)] = {
+            'file': os.path.basename(self.shard_file(shard)),
+            'start': start,
+            'stop': stop
+        }
+        tmp_manifest = os.path.join(self.shard_dir, MANIFEST_FILE + '.tmp')
+        with open(tmp_manifest, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_manifest, os.path.join(self.shard_dir, MANIFEST_FILE))
+
+    def run(self, compute_fn):
+        """Compute and save every pending shard.
+
+        :param compute_fn: maps an array of sample indices to their
+            (len(indices), ...) embeddings
+        """
+        pending = self.pending()
+        logger.info(f'{self.num_shards - len(pending)} of {self.num_shards} '
+                    f'shards already extracted in {self.shard_dir}')
+        for shard in pending:
+            start, stop = self.shard_range(shard)
+            self.write_shard(shard, compute_fn(np.arange(start, stop)))
+            logger.info(f'Shard {shard + 1}/{self.num_shards} saved, '
+                        f'samples {start} to {stop}')
+
+    def merge(self, db_dir, ids, dtype='float32', overwrite=False):
+        """Append the shards in order to a new `EmbeddingDB`.
+
+        :param db_dir: directory of the database
+        :param ids: id of every sample
+        """
+        if not self.is_complete():
+            raise RuntimeError(f'{len(self.pending())} shards of '
+                               f'{self.shard_dir} are not extracted yet')
+        if len(ids) != self.num_samples:
+            raise ValueError(f'Expected {self.num_samples} ids, got '
+                             f'{len(ids)}')
+        db = None
+        for shard in range(self.num_shards):
+            start, stop = self.shard_range(shard)
+            embeddings = np.load(self.shard_file(shard), mmap_mode='r')
+            embeddings = embeddings.reshape(len(embeddings), -1)
+            if db is None:
+                db = EmbeddingDB.create(db_dir,
+                                        embeddings.shape[1],
+                                        dtype=dtype,
+                                        overwrite=overwrite)
+            db.append([ids[i] for i in range(start, stop)], embeddings)
+        if db is None:
+            raise ValueError(f'No embeddings in {self.shard_dir}')
+        return EmbeddingDB(db_dir)
+
+
+def run_extractions(extractions, compute_fn):
+    """Run several extractions of the same samples, filled by one
+    computation (e.g. several layers or poolings of one forward pass).
+
+    :param extractions: dict key -> `ShardedExtraction`, with the same
+        number of samples and shard size
+    :param compute_fn: maps an array of sample indices to a dict key ->
+        (len(indices), ...) embeddings
+    """
+    first = next(iter(extractions.values()))
+    if any(e.num_samples != first.num_samples
+           or e.shard_size != first.shard_size for e in extractions.values()):
+        raise ValueError('Extractions must have the same samples and shards')
+    pending = sorted(
+        set(shard for e in extractions.values() for shard in e.pending()))
+    logger.info(f'{first.num_shards - len(pending)} of {first.num_shards} '
+                f'shards already extracted')
+    for shard in pending:
+        start, stop = first.shard_range(shard)
+        embeddings = compute_fn(np.arange(start, stop))
+        for key, extraction in extractions.items():
+            if shard in extraction.pending():
+                extraction.write_shard(shard, embeddings[key])
+        logger.info(f'Shard {shard + 1}/{first.num_shards} saved, '
+                    f'samples {start} to {stop}')
@@ -7,6 +7,8 @@ import h5py
 import numpy as np
 import pandas as pd
 
+from deepfold.utils.embedding_db import EmbeddingDB
+
 logger = logging.getLogger(__name__)
 
 
@@ -77,9 +79,14 @@ def save_annotations(data_path):
 def read_embeddings(embeddings_in):
     """Read embeddings from h5 file generated by bio_embeddings pipeline.
 
+    If `embeddings_in` is an `EmbeddingDB` directory, the memory-mapped
+    database is returned instead of a dict.
+
     :param embeddings_in:
     :return:
     """
+    if EmbeddingDB.exists(embeddings_in):
+        return EmbeddingDB(embeddings_in)
     embeddings = dict()
     with h5py.File(embeddings_in, 'r') as f:
         for sequence_id, embedding in f.items():
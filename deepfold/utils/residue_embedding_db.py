@@ -0,0 +1,212 @@
+import json
+import os
+
+import numpy as np
+
+from deepfold.utils import whitening
+
+META_FILE = 'meta.json'
+DATA_FILE = 'values.bin'
+LENGTHS_FILE = 'lengths.bin'
+IDS_FILE = 'ids.txt'
+PCA_FILE = 'pca.npz'
+SUPPORTED_DTYPES = ['float16', 'float32']
+
+
+class ResidueEmbeddingDB(object):
+    """On-disk database of per-residue protein embeddings.
+
+    A database is a directory holding
+
+    - ``values.bin``: the (num_residues, dim) residue embeddings of all
+      proteins back to back,
+    - ``lengths.bin``: the int64 number of residues of every protein,
+    - ``ids.txt``: the protein id of every protein, one per line,
+    - ``meta.json``: the header with `dim`, `dtype`, `size` and
+      `num_residues`,
+    - ``pca.npz`` (optional): the `mean` and `components` the embeddings
+      were projected with, see `fit_pca`.
+
+    The values are memory-mapped and stored as float16 by default, the
+    embeddings of protein `i` are ``values[offsets[i]:offsets[i + 1]]``.
+    Appends are not atomic: values, lengths and ids go first and the
+    header last, and only the proteins counted in the header are read, so
+    the leftovers of an interrupted append are ignored and then cut off by
+    the next `append`.
+
+    Args:
+        db_dir: database directory, see `create` for a new database.
+        mode: `r` to open read-only, `r+` to allow `append`.
+    """
+    def __init__(self, db_dir, mode='r'):
+        self.db_dir = db_dir
+        self.mode = mode
+        with open(os.path.join(db_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(db_dir, IDS_FILE)) as f:
+            ids = [line.rstrip('\n') for line in f]
+        # rows past the header are leftovers of a crashed append
+        self._ids_complete = len(ids) == self.meta['size']
+        self.ids = ids[:self.meta['size']]
+        lengths = np.fromfile(os.path.join(db_dir, LENGTHS_FILE),
+                              dtype=np.int64)
+        self.lengths = lengths[:self.meta['size']]
+        self.offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.projection = None
+        if os.path.exists(os.path.join(db_dir, PCA_FILE)):
+            pca = np.load(os.path.join(db_dir, PCA_FILE))
+            self.projection = (pca['mean'], pca['components'])
+        self._id_to_index = None
+        self._values = None
+
+    @classmethod
+    def create(cls,
+               db_dir,
+               dim,
+               dtype='float16',
+               projection=None,
+               overwrite=False):
+        """Create an empty database opened for appending.
+
+        :param dim: dimension of the embeddings passed to `append`
+        :param projection: optional (mean, components) of a PCA, see
+            `fit_pca`, the stored embeddings then have
+            ``len(components)`` dimensions
+        """
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f'{dtype} is not a supported dtype, valid dtypes '
+                             f'are {SUPPORTED_DTYPES}')
+        if os.path.exists(os.path.join(db_dir, META_FILE)) and not overwrite:
+            raise FileExistsError(f'{db_dir} already holds a residue db')
+        os.makedirs(db_dir, exist_ok=True)
+        for name in (DATA_FILE, LENGTHS_FILE, IDS_FILE):
+            open(os.path.join(db_dir, name), 'wb').close()
+        if os.path.exists(os.path.join(db_dir, PCA_FILE)):
+            os.remove(os.path.join(db_dir, PCA_FILE))
+        if projection is not None:
+            mean, components = projection
+            if components.shape[1] != dim:
+                raise ValueError(f'Expected PCA components of dimension '
+                                 f'{dim}, got {components.shape[1]}')
+            np.savez(os.path.join(db_dir, PCA_FILE),
+                     mean=mean,
+                     components=components)
+            dim = len(components)
+        meta = {'dim': int(dim), 'dtype': dtype, 'size': 0, 'num_residues': 0}
+        with open(os.path.join(db_dir, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+        return cls(db_dir, mode='r+')
+
+    @staticmethod
+    def exists(db_dir):
+        return os.path.exists(os.path.join(db_dir, META_FILE))
+
+    @property
+    def dim(self):
+        return self.meta['dim']
+
+    @property
+    def dtype(self):
+        return np.dtype(self.meta['dtype'])
+
+    @property
+    def values(self):
+        """(num_residues, dim) memory-mapped residue embeddings."""
+        if self._values is None:
+            if self.meta['num_residues'] == 0:
+                self._values = np.empty((0, self.dim), dtype=self.dtype)
+            else:
+                self._values = np.memmap(os.path.join(self.db_dir, DATA_FILE),
+                                         dtype=self.dtype,
+                                         mode='r',
+                                         shape=(self.meta['num_residues'],
+                                                self.dim))
+        return self._values
+
+    @property
+    def id_to_index(self):
+        if self._id_to_index is None:
+            self._id_to_index = {k: i for i, k in enumerate(self.ids)}
+        return self._id_to_index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, prot_id):
+        return prot_id in self.id_to_index
+
+    def get_row(self, idx):
+        """(length, dim) residue embeddings of the `idx`-th protein."""
+        return self.values[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __getitem__(self, prot_id):
+        return self.get_row(self.id_to_index[prot_id])
+
+    def project(self, embeddings):
+        """Apply the PCA of the database to raw residue embeddings."""
+        if self.projection is None:
+            return embeddings
+        mean, components = self.projection
+        return (embeddings - mean) @ components.T
+
+    def append(self, prot_ids, embeddings):
+        """Append the residue embeddings of several proteins.
+
+        :param prot_ids: protein id of every protein
+        :param embeddings: list of (length, dim) arrays, projected with the
+            PCA of the database if it has one
+        """
+        if self.mode != 'r+':
+            raise RuntimeError(
+                f'{self.db_dir} is opened read-only, open it with mode r+')
+        prot_ids = [str(k) for k in prot_ids]
+        if len(embeddings) != len(prot_ids):
+            raise ValueError('Number of ids and embeddings do not match')
+        if any('\n' in k for k in prot_ids):
+            raise ValueError('Protein ids must not contain newlines')
+        lengths = np.array([len(e) for e in embeddings], dtype=np.int64)
+        with open(os.path.join(self.db_dir, DATA_FILE), 'r+b') as f:
+            f.seek(int(self.offsets[-1]) * self.dim * self.dtype.itemsize)
+            f.truncate()
+            for emb in embeddings:
+                emb = self.project(np.asarray(emb, dtype=np.float32))
+                if emb.ndim != 2 or emb.shape[1] != self.dim:
+                    raise ValueError(f'Expected embeddings of shape (length, '
+                                     f'{self.dim}), got {emb.shape}')
+                f.write(np.ascontiguousarray(emb, dtype=self.dtype).tobytes())
+        with open(os.path.join(self.db_dir, LENGTHS_FILE), 'r+b') as f:
+            f.seek(len(self.lengths) * 8)
+            f.truncate()
+            f.write(lengths.tobytes())
+        if not self._ids_complete:
+            with open(os.path.join(self.db_dir, IDS_FILE), 'w') as f:
+                f.writelines(k + '\n' for k in self.ids)
+            self._ids_complete = True
+        with open(os.path.join(self.db_dir, IDS_FILE), 'a') as f:
+            f.writelines(k + '\n' for k in prot_ids)
+        # the proteins of this append exist once the header is updated
+        self.ids.extend(prot_ids)
+        self.lengths = np.concatenate([self.lengths, lengths])
+        self.offsets = np.concatenate(
+            [self.offsets, self.offsets[-1] + np.cumsum(lengths)])
+        self.meta['size'] = len(self.ids)
+        self.meta['num_residues'] = int(self.offsets[-1])
+        with open(os.path.join(self.db_dir, META_FILE), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        self._values = None
+        self._id_to_index = None
+
+
+def fit_pca(residue_embeddings, n_components):
+    """PCA of a sample of residue embeddings, see `whitening.fit_pca`.
+
+    :param residue_embeddings: iterable of (num_residues, dim) arrays, e.g.
+        the residues of one batch at a time, accumulated one by one
+    :return: mean (dim, ), components (n_components, dim)
+    """
+    stats = whitening.StreamingCovariance()
+    for embeddings in residue_embeddings:
+        stats.partial_fit(embeddings)
+    projection = whitening.pca_projection(stats, n_components)
+    return -projection.bias, projection.kernel.T
@@ -0,0 +1,187 @@
+import numpy as np
+
+from deepfold.utils.embedding_db import EmbeddingDB
+
+
+def iter_chunks(matrix, chunk_size=65536):
+    """Row chunks of a (memory-mapped) matrix, as float64 arrays."""
+    for start in range(0, len(matrix), chunk_size):
+        yield np.asarray(matrix[start:start + chunk_size], dtype=np.float64)
+
+
+class StreamingCovariance(object):
+    """Mean and covariance of rows accumulated chunk by chunk.
+
+    Chunks are merged with the pairwise update of Chan et al. in float64,
+    so the estimate matches the one of the whole matrix without holding
+    it in memory.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.comoment = None
+
+    def partial_fit(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if len(chunk) == 0:
+            return self
+        chunk_mean = chunk.mean(axis=0)
+        centered = chunk - chunk_mean
+        chunk_comoment = centered.T @ centered
+        if self.count == 0:
+            self.count = len(chunk)
+            self.mean = chunk_mean
+            self.comoment = chunk_comoment
+            return self
+        count = self.count + len(chunk)
+        delta = chunk_mean - self.mean
+        self.mean = self.mean + delta * (len(chunk) / count)
+        self.comoment += chunk_comoment + np.outer(
+            delta, delta) * (self.count * len(chunk) / count)
+        self.count = count
+        return self
+
+    def fit(self, matrix, chunk_size=65536):
+        for chunk in iter_chunks(matrix, chunk_size):
+            self.partial_fit(chunk)
+        return self
+
+    def covariance(self):
+        return self.comoment / max(self.count - 1, 1)
+
+
+class LinearProjection(object):
+    """Affine map ``y = (x + bias) @ kernel`` of embeddings.
+
+    Fitted on the train embeddings (see `fit_whitening`, `fit_pca` and
+    `randomized_pca`) and applied chunk by chunk to memory-mapped stores,
+    so it scales to embedding sets larger than memory.
+
+    Args:
+        kernel: (dim, n_components) matrix.
+        bias: (dim, ) bias, the negated mean.
+    """
+    def __init__(self, kernel, bias):
+        self.kernel = np.asarray(kernel, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32).reshape(-1)
+
+    @property
+    def n_components(self):
+        return self.kernel.shape[1]
+
+    def transform(self, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        return (embeddings + self.bias) @ self.kernel
+
+    def iter_transform(self, matrix, chunk_size=65536):
+        """Lazily transform a (memory-mapped) matrix chunk by chunk."""
+        for start in range(0, len(matrix), chunk_size):
+            yield self.transform(matrix[start:start + chunk_size])
+
+    def transform_db(self,
+                     db,
+                     db_dir,
+                     dtype='float32',
+                     chunk_size=65536,
+                     overwrite=False):
+        """Write the transformed embeddings of an `EmbeddingDB` to a new
+        one, with the same ids."""
+        out = EmbeddingDB.create(db_dir,
+                                 self.n_components,
+                                 dtype=dtype,
+                                 overwrite=overwrite)
+        for start, chunk in zip(range(0, len(db), chunk_size),
+                                self.iter_transform(db.matrix, chunk_size)):
+            out.append(db.ids[start:start + chunk_size], chunk)
+        return EmbeddingDB(db_dir)
+
+    def save(self, file_path):
+        np.savez(file_path, kernel=self.kernel, bias=self.bias)
+
+    @classmethod
+    def load(cls, file_path):
+        data = np.load(file_path)
+        return cls(data['kernel'], data['bias'])
+
+
+def fit_whitening(matrix, n_components=None, chunk_size=65536, eps=1e-12):
+    """Whitening of the rows of `matrix`, optionally keeping only the
+    `n_components` leading directions.
+
+    The mean and covariance are accumulated in float64 chunk by chunk,
+    the kernel is ``U / sqrt(S)`` of the eigendecomposition of the
+    covariance.
+    """
+    stats = StreamingCovariance().fit(matrix, chunk_size)
+    eigvals, eigvecs = np.linalg.eigh(stats.covariance())
+    order = np.argsort(eigvals)[::-1][:n_components]
+    kernel = eigvecs[:, order] / np.sqrt(np.maximum(eigvals[order], eps))
+    return LinearProjection(kernel, -stats.mean)
+
+
+def fit_pca(matrix, n_components, chunk_size=65536):
+    """Exact PCA of the rows of `matrix` from the streamed covariance."""
+    return pca_projection(StreamingCovariance().fit(matrix, chunk_size),
+                          n_components)
+
+
+def pca_projection(stats, n_components):
+    """PCA onto the `n_components` leading directions of a fitted
+    `StreamingCovariance`."""
+    eigvals, eigvecs = np.linalg.eigh(stats.covariance())
+    order = np.argsort(eigvals)[::-1][:n_components]
+    return LinearProjection(eigvecs[:, order], -stats.mean)
+
+
+def randomized_pca(matrix,
+                   n_components,
+                   n_oversamples=10,
+                   n_iter=4,
+                   chunk_size=65536,
+                   whiten=False,
+                   seed=0):
+    """Randomized PCA of the rows of `matrix` (Halko et al.).
+
+    A random subspace of ``n_components + n_oversamples`` directions is
+    refined by `n_iter` power iterations, each one a pass over the chunks
+    of the centered matrix, so the covariance is never formed and a pass
+    costs ``O(n * dim * n_components)``. With `whiten` the components are
+    scaled to unit variance.
+    """
+    mean = np.zeros(matrix.shape[1])
+    count = 0
+    for chunk in iter_chunks(matrix, chunk_size):
+        count += len(chunk)
+        mean += chunk.sum(axis=0)
+    mean /= max(count, 1)
+
+    rng = np.random.RandomState(seed)
+    size = min(n_components + n_oversamples, matrix.shape[1])
+    basis, _ = np.linalg.qr(rng.standard_normal((matrix.shape[1], size)))
+    for _ in range(n_iter):
+        # basis <- orth(X^T X basis) of the centered X
+        product = np.zeros_like(basis)
+        for chunk in iter_chunks(matrix, chunk_size):
+            centered = chunk - mean
+            product += centered.T @ (centered @ basis)
+        basis, _ = np.linalg.qr(product)
+
+    # covariance restricted to the subspace, then rotated to its principal
+    # directions
+    reduced_cov = np.zeros((size, size))
+    for chunk in iter_chunks(matrix, chunk_size):
+        projected = (chunk - mean) @ basis
+        reduced_cov += projected.T @ projected
+    eigvals, eigvecs = np.linalg.eigh(reduced_cov / max(count - 1, 1))
+    order = np.argsort(eigvals)[::-1][:n_components]
+    kernel = basis @ eigvecs[:, order]
+    if whiten:
+        kernel = kernel / np.sqrt(np.maximum(eigvals[order], 1e-12))
+    return LinearProjection(kernel, -mean)
+
+
+def compute_kernel_bias(vecs, n_components=None):
+    """Whitening kernel and bias of `vecs`, the transformation is
+    ``y = (x + bias).dot(kernel)``, see `fit_whitening`."""
+    projection = fit_whitening(vecs, n_components)
+    return projection.kernel, projection.bias[None]
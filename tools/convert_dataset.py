@@ -0,0 +1,51 @@
+import argparse
+import logging
+
+from deepfold.data.utils.columnar import convert_pickle, store_path
+
+parser = argparse.ArgumentParser(
+    description='Convert pickled DataFrames into memory-mapped column stores')
+parser.add_argument('--input',
+                    '-i',
+                    required=True,
+                    nargs='+',
+                    type=str,
+                    help='pickled DataFrames, e.g. train_data.pkl terms.pkl')
+parser.add_argument('--output_dir',
+                    '-o',
+                    default=None,
+                    type=str,
+                    help='column store directory, defaults to the input '
+                    'file with a .columns suffix (only with a single input)')
+parser.add_argument('--columns',
+                    default=None,
+                    nargs='+',
+                    type=str,
+                    help='columns to convert, defaults to all columns')
+parser.add_argument('--overwrite',
+                    action='store_true',
+                    help='overwrite an existing store')
+
+
+def main(args):
+    if args.output_dir is not None and len(args.input) > 1:
+        raise ValueError('--output_dir only applies to a single input file')
+    for file_in in args.input:
+        store_dir = args.output_dir or store_path(file_in)
+        store = convert_pickle(file_in,
+                               store_dir,
+                               columns=args.columns,
+                               overwrite=args.overwrite)
+        columns = ', '.join(f"{name} ({meta['kind']})"
+                            for name, meta in store.meta['columns'].items())
+        logger.info(f'Converted {len(store)} rows of {file_in} to '
+                    f'{store_dir}: {columns}')
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger('')
+    streamhandler = logging.StreamHandler()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(streamhandler)
+    args = parser.parse_args()
+    main(args)
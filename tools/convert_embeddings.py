@@ -0,0 +1,57 @@
+import argparse
+import logging
+
+from deepfold.utils.embedding_db import convert_embeddings
+
+parser = argparse.ArgumentParser(
+    description='Convert h5/npz/pkl embeddings into a memory-mapped db')
+parser.add_argument('--input',
+                    '-i',
+                    required=True,
+                    type=str,
+                    help='embedding file (.h5, .npz or .pkl)')
+parser.add_argument('--output_dir',
+                    '-o',
+                    required=True,
+                    type=str,
+                    help='directory of the embedding db')
+parser.add_argument('--dtype',
+                    default='float32',
+                    choices=['float32', 'float16'],
+                    help='storage dtype of the embeddings')
+parser.add_argument('--id_column',
+                    default='proteins',
+                    type=str,
+                    help='protein id column of a DataFrame pkl')
+parser.add_argument('--embedding_column',
+                    default='embeddings',
+                    type=str,
+                    help='embedding column of a DataFrame pkl')
+parser.add_argument('--chunk_size',
+                    default=10000,
+                    type=int,
+                    help='number of embeddings converted at once')
+parser.add_argument('--overwrite',
+                    action='store_true',
+                    help='overwrite an existing db')
+
+
+def main(args):
+    db = convert_embeddings(args.input,
+                            args.output_dir,
+                            dtype=args.dtype,
+                            id_column=args.id_column,
+                            embedding_column=args.embedding_column,
+                            chunk_size=args.chunk_size,
+                            overwrite=args.overwrite)
+    logger.info(f'Converted {len(db)} embeddings of dim {db.dim} '
+                f'({db.dtype}) to {args.output_dir}')
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger('')
+    streamhandler = logging.StreamHandler()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(streamhandler)
+    args = parser.parse_args()
+    main(args)
@@ -9,7 +9,8 @@ import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 
-from deepfold.core.metrics.custom_metrics import evaluate_annotations
+from deepfold.core.evaluation.group_evaluation import (GroupedEvaluator,
+                                                       log_group_results)
 from deepfold.data.utils.data_utils import FUNC_DICT, NAMESPACES
 from deepfold.data.utils.ontology import Ontology
 
@@ -43,6 +44,12 @@ parser.add_argument('--ontology-obo-file',
                     default='data/go.obo',
                     help='Ontology file')
 parser.add_argument('--output_dir', '-o', default='./', help='output dir')
+parser.add_argument(
+    '--group-column',
+    '-gc',
+    default=None,
+    help='Column of the test data (e.g. orgs, cafa_target) used to report '
+    'per-group metrics')
 
 alphas = {NAMESPACES['mf']: 0, NAMESPACES['bp']: 0, NAMESPACES['cc']: 0}
 
@@ -59,7 +66,12 @@ def get_model_preds(test_df, terms):
     return model_preds
 
 
-def evaluate_model_prediction(labels, terms, model_preds, go_rels, ont):
+def evaluate_model_prediction(labels,
+                              terms,
+                              model_preds,
+                              go_rels,
+                              ont,
+                              groups=None):
     fmax = 0.0
     tmax = 0.0
     smin = 1000.0
@@ -70,8 +82,9 @@ def evaluate_model_prediction(labels, terms, model_preds, go_rels, ont):
     go_set.remove(FUNC_DICT[ont])
     # labels
     labels = list(map(lambda x: set(filter(lambda y: y in go_set, x)), labels))
-    for t in range(0, 101, 10):
-        threshold = t / 100.0
+    thresholds = [t / 100.0 for t in range(0, 101, 10)]
+    evaluator = GroupedEvaluator(thresholds, groups)
+    for t_idx, threshold in enumerate(thresholds):
         preds = []
         for i, _ in enumerate(model_preds):
             annots = set()
@@ -88,8 +101,7 @@ def evaluate_model_prediction(labels, terms, model_preds, go_rels, ont):
         preds = list(
             map(lambda x: set(filter(lambda y: y in go_set, x)), preds))
 
-        fscore, prec, rec, s, _, _, _, _ = evaluate_annotations(
-            go_rels, labels, preds)
+        fscore, prec, rec, s = evaluator.update(t_idx, go_rels, labels, preds)
 
         precisions.append(prec)
         recalls.append(rec)
@@ -108,7 +120,12 @@ def evaluate_model_prediction(labels, terms, model_preds, go_rels, ont):
     precisions = precisions[sorted_index]
     aupr = np.trapz(precisions, recalls)
     logger.info(f'AUPR: {aupr:0.3f}')
-    return precisions, recalls, aupr
+
+    group_results = None
+    if groups is not None:
+        log_group_results(evaluator.compute(), logger)
+        group_results = evaluator.to_frame()
+    return precisions, recalls, aupr, group_results
 
 
 def plot_diamond_aupr(precisions, recalls, aupr, ont, save_path):
@@ -133,6 +150,7 @@ def main(train_data_file,
          terms_file,
          go_obo_file,
          output_dir=None,
+         group_column=None,
          onts=('bp', 'mf', 'cc')):
 
     go_rels = Ontology(go_obo_file, with_rels=True)
@@ -157,11 +175,15 @@ def main(train_data_file,
         prot_index[row.proteins] = i
 
     model_preds = list(test_df.preds)
+    groups = test_df[group_column].values if group_column else None
     for ont in onts:
         logger.info(f'Evaluate the {ont} protein family')
-        precisions, recalls, aupr = evaluate_model_prediction(
-            test_annotations, terms, model_preds, go_rels, ont)
+        precisions, recalls, aupr, group_results = evaluate_model_prediction(
+            test_annotations, terms, model_preds, go_rels, ont, groups)
         plot_diamond_aupr(precisions, recalls, aupr, ont, output_dir)
+        if group_results is not None:
+            group_results.to_csv(
+                os.path.join(output_dir, ont + '_group_metrics.csv'))
 
 
 if __name__ == '__main__':
@@ -172,4 +194,4 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     main(args.train_data_file, args.test_data_file, args.terms_file,
-         args.ontology_obo_file, args.output_dir)
+         args.ontology_obo_file, args.output_dir, args.group_column)
@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 import argparse
 import logging
+import os
 import sys
 
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 
-from deepfold.core.metrics.custom_metrics import evaluate_annotations
+from deepfold.core.evaluation.group_evaluation import (GroupedEvaluator,
+                                                       log_group_results)
 from deepfold.data.utils.data_utils import FUNC_DICT, NAMESPACES
 from deepfold.data.utils.ontology import Ontology
 
@@ -36,6 +38,12 @@ parser.add_argument('--ontology-obo-file',
                     default='data/go.obo',
                     help='Ontology file')
 parser.add_argument('--output_dir', '-o', default='./', help='output dir')
+parser.add_argument(
+    '--group-column',
+    '-gc',
+    default=None,
+    help='Column of the test data (e.g. orgs, cafa_target) used to report '
+    'per-group metrics')
 
 
 def get_diamond_scores(diamond_scores_file):
@@ -102,7 +110,7 @@ def get_diamond_preds(train_df, test_df, diamond_scores):
     return diamond_preds
 
 
-def evaluate_diamond(test_df, blast_preds, go_rels, ont):
+def evaluate_diamond(test_df, blast_preds, go_rels, ont, groups=None):
     fmax = 0.0
     tmax = 0.0
     smin = 1000.0
@@ -122,8 +130,9 @@ def evaluate_diamond(test_df, blast_preds, go_rels, ont):
     labels = test_annotations
     labels = list(map(lambda x: set(filter(lambda y: y in go_set, x)), labels))
 
-    for t in range(0, 101, 10):
-        threshold = t / 100.0
+    thresholds = [t / 100.0 for t in range(0, 101, 10)]
+    evaluator = GroupedEvaluator(thresholds, groups)
+    for t_idx, threshold in enumerate(thresholds):
         preds = []
         for i, row in enumerate(test_df.itertuples()):
             annots = set()
@@ -140,8 +149,7 @@ def evaluate_diamond(test_df, blast_preds, go_rels, ont):
         preds = list(
             map(lambda x: set(filter(lambda y: y in go_set, x)), preds))
 
-        fscore, prec, rec, s, _, _, _, _ = evaluate_annotations(
-            go_rels, labels, preds)
+        fscore, prec, rec, s = evaluator.update(t_idx, go_rels, labels, preds)
         precisions.append(prec)
         recalls.append(rec)
         logger.info(f'Fscore: {fscore}, S: {s}, threshold: {threshold}')
@@ -159,7 +167,12 @@ def evaluate_diamond(test_df, blast_preds, go_rels, ont):
     precisions = precisions[sorted_index]
     aupr = np.trapz(precisions, recalls)
     logger.info(f'AUPR: {aupr:0.3f}')
-    return precisions, recalls, aupr
+
+    group_results = None
+    if groups is not None:
+        log_group_results(evaluator.compute(), logger)
+        group_results = evaluator.to_frame()
+    return precisions, recalls, aupr, group_results
 
 
 def plot_diamond_aupr(precisions, recalls, aupr, ont, save_path):
@@ -183,6 +196,7 @@ def main(train_data_file,
          diamond_scores_file,
          go_obo_file,
          output_dir=None,
+         group_column=None,
          onts=('bp', 'mf', 'cc')):
 
     go_rels = Ontology(go_obo_file, with_rels=True)
@@ -203,9 +217,13 @@ def main(train_data_file,
         go_set = go_rels.get_namespace_terms(NAMESPACES[ont])
         go_set.remove(FUNC_DICT[ont])
 
-        precisions, recalls, aupr = evaluate_diamond(test_df, blast_preds,
-                                                     go_rels, ont)
+        groups = test_df[group_column].values if group_column else None
+        precisions, recalls, aupr, group_results = evaluate_diamond(
+            test_df, blast_preds, go_rels, ont, groups)
         plot_diamond_aupr(precisions, recalls, aupr, ont, output_dir)
+        if group_results is not None:
+            group_results.to_csv(
+                os.path.join(output_dir, ont + '_group_metrics.csv'))
 
 
 if __name__ == '__main__':
@@ -216,4 +234,4 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     main(args.train_data_file, args.test_data_file, args.diamond_scores_file,
-         args.ontology_obo_file, args.output_dir)
+         args.ontology_obo_file, args.output_dir, args.group_column)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from deepfold.core.evaluation.group_evaluation import (evaluate_score_matrix,
+                                                       label_matrix,
+                                                       propagation_matrix)
+from deepfold.data.utils.data_utils import FUNC_DICT, NAMESPACES
+from deepfold.data.utils.ontology import Ontology
+from deepfold.gosim.function_prediction import FunctionPrediction
+from deepfold.gosim.gene_ontology import GeneOntology
+from deepfold.gosim.index import build_index, compute_recall
+
+parser = argparse.ArgumentParser(
+    description='Evaluate embedding-based annotation transfer for k = 1..K')
+parser.add_argument('--train-data-file',
+                    '-trdf',
+                    default='data/train_embeddings.pkl',
+                    help='Training data with embeddings and annotations')
+parser.add_argument('--test-data-file',
+                    '-tsdf',
+                    default='data/test_embeddings.pkl',
+                    help='Test data with embeddings and annotations')
+parser.add_argument('--embedding-column',
+                    default='esm_embeddings',
+                    help='Column of the data files holding the embeddings')
+parser.add_argument('--ontology-obo-file',
+                    '-obo',
+                    default='data/go.obo',
+                    help='Ontology file')
+parser.add_argument('--max-k',
+                    default=10,
+                    type=int,
+                    help='evaluate the k closest hits for k = 1..max-k')
+parser.add_argument('--distance',
+                    default='euclidean',
+                    help='distance measure [euclidean|cosine]')
+parser.add_argument('--index-type',
+                    default='exact',
+                    help='nearest-neighbour index [exact|ivf|quantized]')
+parser.add_argument('--nlist', default=1024, type=int, help='ivf lists')
+parser.add_argument('--nprobe', default=16, type=int, help='ivf probes')
+parser.add_argument('--quantizer',
+                    default='sq8',
+                    help='quantized index codes [sq8|pq]')
+parser.add_argument('--pq-m', default=64, type=int, help='pq subspaces')
+parser.add_argument('--rerank',
+                    default=10,
+                    type=int,
+                    help='quantized index shortlist size as a multiple of k')
+parser.add_argument('--output_dir', '-o', default='./', help='output dir')
+
+GO_TYPES = {'bp': 'bpo', 'mf': 'mfo', 'cc': 'cco'}
+
+
+def get_index_kwargs(args):
+    if args.index_type == 'ivf':
+        return {'nlist': args.nlist, 'nprobe': args.nprobe}
+    if args.index_type == 'quantized':
+        return {
+            'quantizer': args.quantizer,
+            'pq_m': args.pq_m,
+            'rerank': args.rerank
+        }
+    return {}
+
+
+def to_embedding_db(df, embedding_column):
+    return {
+        prot_id: np.asarray(emb, dtype=np.float32)
+        for prot_id, emb in zip(df['proteins'], df[embedding_column])
+    }
+
+
+def main(train_data_file,
+         test_data_file,
+         embedding_column,
+         go_obo_file,
+         max_k,
+         distance='euclidean',
+         index_type='exact',
+         index_kwargs=None,
+         output_dir=None,
+         onts=('bp', 'mf', 'cc')):
+    go_rels = Ontology(go_obo_file, with_rels=True)
+    gene_ontology = GeneOntology(go_obo_file)
+
+    train_df = pd.read_pickle(train_data_file)
+    test_df = pd.read_pickle(test_data_file)
+    annotations = list(map(lambda x: set(x), train_df['prop_annotations']))
+    test_annotations = list(map(lambda x: set(x), test_df['prop_annotations']))
+    go_rels.calculate_ic(annotations + test_annotations)
+
+    embedding_db = to_embedding_db(train_df, embedding_column)
+    go_annotations = dict(zip(train_df['proteins'], annotations))
+    querys = to_embedding_db(test_df, embedding_column)
+
+    thresholds = [t / 100.0 for t in range(0, 101, 10)]
+    results = []
+    for ont in onts:
+        logger.info(f'Evaluate the {ont} protein family')
+        go_set = go_rels.get_namespace_terms(NAMESPACES[ont])
+        go_set.remove(FUNC_DICT[ont])
+        go_set = sorted(go_set)
+        labels = label_matrix(test_annotations, go_set)
+        ic = np.array([go_rels.get_ic(go_id) for go_id in go_set])
+
+        predictor = FunctionPrediction(embedding_db, go_annotations,
+                                       gene_ontology, GO_TYPES[ont],
+                                       index_type, **(index_kwargs or {}))
+        propagation = propagation_matrix(go_rels, predictor.terms, go_set)
+        # one neighbour search with its ties gives the predictions of every k
+        _, scores, _, knn_indices = predictor.run_prediction_knn_sweep(
+            querys, distance, range(1, max_k + 1))
+        recall = 1.0
+        if index_type != 'exact':
+            lookup = predictor.embedding_lookup
+            exact = build_index(np.asarray(lookup.embedding_mat,
+                                           dtype=np.float32),
+                                metric=distance)
+            _, exact_indices = exact.search(np.stack(list(querys.values())),
+                                            max_k)
+            recall = compute_recall(knn_indices, exact_indices)
+            logger.info(f'{index_type} index recall@{max_k}: {recall:0.3f}')
+        for k, score_mat in scores.items():
+            evaluator = evaluate_score_matrix(score_mat, propagation, labels,
+                                              ic, thresholds)
+            metrics = evaluator.compute()['all']
+            logger.info(f"k: {k}, Fmax: {metrics['fmax']:0.3f}, "
+                        f"Smin: {metrics['smin']:0.3f}, "
+                        f"AUPR: {metrics['aupr']:0.3f}, "
+                        f"threshold: {metrics['tmax']}")
+            metrics.update({'ont': ont, 'k': k, 'recall': recall})
+            results.append(metrics)
+
+    results = pd.DataFrame(results)
+    if output_dir is not None:
+        results.to_csv(os.path.join(output_dir, 'gosim_knn_sweep.csv'),
+                       index=False)
+    return results
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger('')
+    streamhandler = logging.StreamHandler()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(streamhandler)
+    args = parser.parse_args()
+    main(args.train_data_file, args.test_data_file, args.embedding_column,
+         args.ontology_obo_file, args.max_k, args.distance, args.index_type,
+         get_index_kwargs(args), args.output_dir)
@@ -7,11 +7,15 @@ import numpy as np
 import pandas as pd
 import torch
 import torch.backends.cudnn as cudnn
-from torch.utils.data import DataLoader
 
 from deepfold.data.esm_dataset import EsmDataset
+from deepfold.data.utils.columnar import read_columns
 from deepfold.models.esm_model import EsmTransformer
-from deepfold.trainer.embeds import extract_esm_embedds
+from deepfold.trainer.embeds import extract_pooled_embedds, extraction_loader
+from deepfold.utils.constant import EXTRACTION_POOLING_MODES
+from deepfold.utils.embedding_cache import EmbeddingCache, get_or_compute_many
+from deepfold.utils.embedding_shards import (ShardedExtraction,
+                                             run_extractions)
 
 sys.path.append('../')
 
@@ -35,6 +39,18 @@ parser.add_argument('--pool_mode',
                     metavar='MODEL',
                     default='mean',
                     help='embedding method')
+parser.add_argument('--pool-modes',
+                    nargs='+',
+                    default=None,
+                    choices=EXTRACTION_POOLING_MODES,
+                    help='poolings extracted in one pass, each to its own '
+                    'output (default: --pool_mode)')
+parser.add_argument('--layers',
+                    nargs='+',
+                    type=int,
+                    default=None,
+                    help='layers extracted in one pass, negative layers '
+                    'count from the last one (default: -1)')
 parser.add_argument('--fintune', default=True, type=bool, help='fintune model')
 parser.add_argument('-j',
                     '--workers',
@@ -48,18 +64,25 @@ parser.add_argument('-b',
                     type=int,
                     metavar='N',
                     help='mini-batch size (default: 256) per gpu')
-
-
-def compute_kernel_bias(vecs):
-    """计算kernel和bias
-    最后的变换：y = (x + bias).dot(kernel)
-    """
-    # vecs = np.concatenate(vecs, axis=0)
-    mu = vecs.mean(axis=0, keepdims=True)
-    cov = np.cov(vecs.T)
-    u, s, vh = np.linalg.svd(cov)
-    W = np.dot(u, np.diag(1 / np.sqrt(s)))
-    return W, -mu
+parser.add_argument('--cache-dir',
+                    default=None,
+                    type=str,
+                    help='embedding cache, only the sequences missing from '
+                    'it are embedded')
+parser.add_argument('--output-db',
+                    default=None,
+                    type=str,
+                    help='extract in resumable shards and merge them into an '
+                    'embedding db in this directory instead of a pickle')
+parser.add_argument('--shard-size',
+                    default=50000,
+                    type=int,
+                    help='number of sequences per shard of --output-db')
+parser.add_argument('--max-tokens',
+                    default=None,
+                    type=int,
+                    help='token budget of a batch, batches then hold at most '
+                    '--batch-size sequences')
 
 
 def main(args):
@@ -72,44 +95,112 @@ def main(args):
         file_name = 'cco/cco_test_data.pkl'
 
     assert os.path.exists(data_file)
-    save_path = os.path.join(
-        args.data_path, 'cco_' + model_name + '_embeddings_' + args.pool_mode +
-        '_' + args.split + '.pkl')
-    print(
-        'Pretrained model %s, pool_mode: %s,  data split: %s , file path: %s' %
-        (model_name, args.pool_mode, args.split, data_file))
-    print('Embeddings save path: ', save_path)
+    layers = args.layers or [-1]
+    pool_modes = args.pool_modes or [args.pool_mode]
+    print('Pretrained model %s, layers: %s, pool_modes: %s, data split: %s, '
+          'file path: %s' %
+          (model_name, layers, pool_modes, args.split, data_file))
     # Dataset and DataLoader
     dataset = EsmDataset(data_path=args.data_path,
                          file_name=file_name,
                          model_dir=model_name)
-    # dataloders
-    data_loader = DataLoader(dataset,
-                             batch_size=args.batch_size,
-                             shuffle=False,
-                             num_workers=args.workers,
-                             collate_fn=dataset.collate_fn,
-                             pin_memory=True)
     # model
     num_labels = dataset.num_classes
     model = EsmTransformer(model_dir=model_name,
-                           pool_mode=args.pool_mode,
+                           repr_layers=layers,
                            fintune=args.fintune,
                            num_labels=num_labels)
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model = model.to(device)
+
+    # every (layer, pool_mode) is written to its own output
+    keys = [(layer, pool_mode) for layer in model.repr_layers
+            for pool_mode in pool_modes]
+
+    def output_name(key):
+        # the last layer keeps the names of a single pooling extraction
+        if key[0] == model.num_layers:
+            return key[1]
+        return f'{key[1]}_layer{key[0]}'
+
+    def extract(indices):
+        # sequences of similar length are batched together with
+        # --max-tokens, the outputs are put back in order
+        data_loader, order = extraction_loader(dataset, indices,
+                                               args.batch_size, args.workers,
+                                               args.max_tokens)
+        embeddings, true_labels = extract_pooled_embedds(
+            model,
+            data_loader,
+            layers=model.repr_layers,
+            pool_modes=pool_modes,
+            logger=logger,
+            device=device)
+        if order is not None:
+            embeddings = {key: val[order] for key, val in embeddings.items()}
+            true_labels = true_labels[order]
+        return embeddings, true_labels
+
+    caches = None
+    if args.cache_dir is not None:
+        # only the sequences missing from the cache are embedded
+        caches = {
+            key: EmbeddingCache(args.cache_dir,
+                                model_name,
+                                layer=key[0],
+                                pool_mode=key[1],
+                                max_length=dataset.max_length -
+                                2 if dataset.truncate else None)
+            for key in keys
+        }
+
+    def embed(indices):
+        if caches is None:
+            return extract(indices)[0]
+        return get_or_compute_many(caches, [dataset.seqs[i] for i in indices],
+                                   lambda idx: extract(indices[idx])[0])
+
     # run predict
-    embeddings, true_labels = extract_esm_embedds(model,
-                                                  data_loader,
-                                                  pool_mode=args.pool_mode,
-                                                  logger=logger,
-                                                  device=device)
-    print(embeddings.shape, true_labels.shape)
+    if args.output_db is not None:
+        # resumable extraction in shards, merged into embedding dbs
+        proteins = read_columns(dataset.file_path, ['proteins'])[0]
+        db_dirs = {
+            key: args.output_db if len(keys) == 1 else args.output_db + '_' +
+            output_name(key)
+            for key in keys
+        }
+        extractions = {
+            key: ShardedExtraction(db_dirs[key] + '.shards',
+                                   len(dataset),
+                                   shard_size=args.shard_size,
+                                   config={
+                                       'data_file': dataset.file_path,
+                                       'model': model_name,
+                                       'layer': key[0],
+                                       'pool_mode': key[1]
+                                   })
+            for key in keys
+        }
+        run_extractions(extractions, embed)
+        for key, extraction in extractions.items():
+            extraction.merge(db_dirs[key], proteins, overwrite=True)
+            print('Embeddings saved to :', db_dirs[key])
+        return
+    if caches is None:
+        embeddings, true_labels = extract(np.arange(len(dataset)))
+    else:
+        embeddings = embed(np.arange(len(dataset)))
+        true_labels = dataset.label_mat.toarray()
     df = pd.read_pickle(data_file)
-    df['esm_embeddings'] = embeddings.tolist()
     df['labels'] = true_labels.tolist()
-    df.to_pickle(save_path)
-    print('Embeddings saved to :', save_path)
+    for key in keys:
+        save_path = os.path.join(
+            args.data_path, 'cco_' + model_name + '_embeddings_' +
+            output_name(key) + '_' + args.split + '.pkl')
+        print(embeddings[key].shape, true_labels.shape)
+        df['esm_embeddings'] = embeddings[key].tolist()
+        df.to_pickle(save_path)
+        print('Embeddings saved to :', save_path)
 
 
 if __name__ == '__main__':
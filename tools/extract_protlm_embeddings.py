@@ -7,13 +7,15 @@ import numpy as np
 import pandas as pd
 import torch
 import torch.backends.cudnn as cudnn
-from torch.utils.data import DataLoader
 from transformers import RobertaConfig
 
 from deepfold.data.protein_dataset import ProtRobertaDataset
+from deepfold.data.utils.columnar import read_columns
 from deepfold.models.transformers.multilabel_transformer import \
     RobertaForMultiLabelSequenceClassification
-from deepfold.trainer.embeds import extract_seq_embedds
+from deepfold.trainer.embeds import extract_seq_embedds, extraction_loader
+from deepfold.utils.embedding_cache import EmbeddingCache
+from deepfold.utils.embedding_shards import ShardedExtraction
 
 sys.path.append('../')
 
@@ -48,18 +50,25 @@ parser.add_argument('-b',
                     type=int,
                     metavar='N',
                     help='mini-batch size (default: 256) per gpu')
-
-
-def compute_kernel_bias(vecs):
-    """计算kernel和bias
-    最后的变换：y = (x + bias).dot(kernel)
-    """
-    # vecs = np.concatenate(vecs, axis=0)
-    mu = vecs.mean(axis=0, keepdims=True)
-    cov = np.cov(vecs.T)
-    u, s, vh = np.linalg.svd(cov)
-    W = np.dot(u, np.diag(1 / np.sqrt(s)))
-    return W, -mu
+parser.add_argument('--cache-dir',
+                    default=None,
+                    type=str,
+                    help='embedding cache, only the sequences missing from '
+                    'it are embedded')
+parser.add_argument('--output-db',
+                    default=None,
+                    type=str,
+                    help='extract in resumable shards and merge them into an '
+                    'embedding db in this directory instead of a pickle')
+parser.add_argument('--shard-size',
+                    default=50000,
+                    type=int,
+                    help='number of sequences per shard of --output-db')
+parser.add_argument('--max-tokens',
+                    default=None,
+                    type=int,
+                    help='token budget of a batch, batches then hold at most '
+                    '--batch-size sequences')
 
 
 def main(args):
@@ -82,12 +91,6 @@ def main(args):
                                  tokenizer_dir=args.pretrain_model_dir,
                                  split=args.split,
                                  max_length=1024)
-    # dataloders
-    data_loader = DataLoader(dataset,
-                             batch_size=args.batch_size,
-                             shuffle=False,
-                             num_workers=args.workers,
-                             pin_memory=True)
     # model
     num_classes = dataset.num_classes
     model_config = RobertaConfig.from_pretrained(
@@ -99,12 +102,58 @@ def main(args):
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model = model.to(device)
+
+    def extract(indices):
+        # sequences of similar length are batched together with
+        # --max-tokens, the outputs are put back in order
+        data_loader, order = extraction_loader(dataset, indices,
+                                               args.batch_size, args.workers,
+                                               args.max_tokens)
+        embeddings, true_labels = extract_seq_embedds(model,
+                                                      data_loader,
+                                                      pool_mode=args.pool_mode,
+                                                      logger=logger,
+                                                      device=device)
+        if order is not None:
+            embeddings, true_labels = embeddings[order], true_labels[order]
+        return embeddings, true_labels
+
+    cache = None
+    if args.cache_dir is not None:
+        # only the sequences missing from the cache are embedded
+        cache = EmbeddingCache(args.cache_dir,
+                               args.pretrain_model_dir,
+                               layer=-1,
+                               pool_mode=args.pool_mode,
+                               max_length=dataset.max_length)
+
+    def embed(indices):
+        if cache is None:
+            return extract(indices)[0]
+        return cache.get_or_compute([dataset.seqs[i] for i in indices],
+                                    lambda idx: extract(indices[idx])[0])
+
     # run predict
-    embeddings, true_labels = extract_seq_embedds(model,
-                                                  data_loader,
-                                                  pool_mode=args.pool_mode,
-                                                  logger=logger,
-                                                  device=device)
+    if args.output_db is not None:
+        # resumable extraction in shards, merged into an embedding db
+        proteins = read_columns(dataset.file_path, ['proteins'])[0]
+        extraction = ShardedExtraction(args.output_db + '.shards',
+                                       len(dataset),
+                                       shard_size=args.shard_size,
+                                       config={
+                                           'data_file': dataset.file_path,
+                                           'model': args.pretrain_model_dir,
+                                           'pool_mode': args.pool_mode
+                                       })
+        extraction.run(embed)
+        extraction.merge(args.output_db, proteins, overwrite=True)
+        print('Embeddings saved to :', args.output_db)
+        return
+    if cache is None:
+        embeddings, true_labels = extract(np.arange(len(dataset)))
+    else:
+        embeddings = embed(np.arange(len(dataset)))
+        true_labels = dataset.label_mat.toarray()
     print(embeddings.shape, true_labels.shape)
     df = pd.read_pickle(data_file)
     df['esm_embeddings'] = embeddings.tolist()
@@ -0,0 +1,152 @@
+import argparse
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+
+from deepfold.data.esm_dataset import EsmDataset
+from deepfold.data.utils.columnar import read_columns
+from deepfold.models.esm_model import EsmTransformer
+from deepfold.trainer.embeds import extract_residue_embedds, extraction_loader
+from deepfold.utils.residue_embedding_db import (SUPPORTED_DTYPES,
+                                                 ResidueEmbeddingDB, fit_pca)
+
+sys.path.append('../')
+
+parser = argparse.ArgumentParser(
+    description='Extract per-residue protein embeddings')
+parser.add_argument('--data_path',
+                    default='',
+                    type=str,
+                    help='data dir of dataset')
+parser.add_argument('--split',
+                    default='train',
+                    help=' train or test data split')
+parser.add_argument('--model',
+                    metavar='MODEL',
+                    default='esm1b_t33_650M_UR50S',
+                    help='esm model (default: esm1b_t33_650M_UR50S)')
+parser.add_argument('--layer',
+                    default=-1,
+                    type=int,
+                    help='layer of the residue embeddings (default: -1)')
+parser.add_argument('--output-db',
+                    required=True,
+                    type=str,
+                    help='directory of the residue embedding db')
+parser.add_argument('--dtype',
+                    default='float16',
+                    choices=SUPPORTED_DTYPES,
+                    help='storage dtype of the embeddings')
+parser.add_argument('--pca-dim',
+                    default=None,
+                    type=int,
+                    help='reduce the embeddings to this dimension with a PCA')
+parser.add_argument('--pca-residues',
+                    default=1000000,
+                    type=int,
+                    help='number of residues of the random sample of '
+                    'proteins the PCA is fitted on')
+parser.add_argument('--seed',
+                    type=int,
+                    default=42,
+                    metavar='S',
+                    help='random seed of the PCA sample (default: 42)')
+parser.add_argument('-j',
+                    '--workers',
+                    type=int,
+                    default=4,
+                    metavar='N',
+                    help='how many training processes to use (default: 1)')
+parser.add_argument('-b',
+                    '--batch-size',
+                    default=32,
+                    type=int,
+                    metavar='N',
+                    help='mini-batch size (default: 32)')
+parser.add_argument('--max-tokens',
+                    default=None,
+                    type=int,
+                    help='token budget of a batch, batches then hold at most '
+                    '--batch-size sequences')
+
+
+def main(args):
+    file_name = args.split + '_data.pkl'
+    data_file = os.path.join(args.data_path, file_name)
+    assert os.path.exists(data_file)
+    logger.info(f'Pretrained model {args.model}, layer {args.layer}, data '
+                f'file {data_file}, residue embeddings saved to '
+                f'{args.output_db}')
+    # Dataset and DataLoader
+    dataset = EsmDataset(data_path=args.data_path,
+                         file_name=file_name,
+                         model_dir=args.model)
+    proteins = read_columns(dataset.file_path, ['proteins'])[0]
+    data_loader, order = extraction_loader(dataset, np.arange(len(dataset)),
+                                           args.batch_size, args.workers,
+                                           args.max_tokens)
+    # dataset index of every sample, in the order of the batches
+    sample_order = np.arange(
+        len(dataset)) if order is None else np.argsort(order)
+    # model
+    model = EsmTransformer(model_dir=args.model,
+                           repr_layers=[args.layer],
+                           num_labels=dataset.num_classes)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = model.to(device)
+
+    projection = None
+    if args.pca_dim is not None:
+        # a first pass over a random sample of proteins, the covariance is
+        # accumulated batch by batch
+        rng = np.random.RandomState(args.seed)
+        sample = rng.permutation(len(dataset))
+        num_residues = np.cumsum(dataset.lengths[sample])
+        sample = np.sort(
+            sample[:np.searchsorted(num_residues, args.pca_residues) + 1])
+        sample_loader, _ = extraction_loader(dataset, sample, args.batch_size,
+                                             args.workers, args.max_tokens)
+        batches = extract_residue_embedds(model,
+                                          sample_loader,
+                                          layer=model.repr_layers[-1],
+                                          logger=logger,
+                                          device=device)
+        projection = fit_pca((np.concatenate(embeddings)
+                              for embeddings in batches), args.pca_dim)
+        logger.info(f'PCA to {args.pca_dim} dimensions fitted on '
+                    f'{len(sample)} random proteins')
+
+    db = None
+    start = 0
+    for embeddings in extract_residue_embedds(model,
+                                              data_loader,
+                                              layer=model.repr_layers[-1],
+                                              logger=logger,
+                                              device=device):
+        ids = [
+            proteins[i] for i in sample_order[start:start + len(embeddings)]
+        ]
+        start += len(embeddings)
+        if db is None:
+            db = ResidueEmbeddingDB.create(args.output_db,
+                                           embeddings[0].shape[1],
+                                           dtype=args.dtype,
+                                           projection=projection,
+                                           overwrite=True)
+        db.append(ids, embeddings)
+    logger.info(f'{len(db)} proteins, {db.meta["num_residues"]} residues of '
+                f'dimension {db.dim} saved to {args.output_db}')
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger('')
+    streamhandler = logging.StreamHandler()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(streamhandler)
+    args = parser.parse_args()
+    cudnn.benchmark = True
+    main(args)
@@ -3,11 +3,13 @@ import logging
 import os
 import sys
 
+import numpy as np
 import pandas as pd
 import torch
 import torch.backends.cudnn as cudnn
 from torch.utils.data import DataLoader
 
+from deepfold.data.samplers import TokenBudgetBatchSampler, batch_order
 from deepfold.data.seq2vec_dataset import Seq2VecDataset
 from deepfold.models.seq2vec_model import Seq2VecEmbedder
 from deepfold.trainer.embeds import extract_esm_embedds
@@ -43,6 +45,11 @@ parser.add_argument('-b',
                     type=int,
                     metavar='N',
                     help='mini-batch size (default: 256) per gpu')
+parser.add_argument('--max-tokens',
+                    default=None,
+                    type=int,
+                    help='token budget of a batch, batches then hold at most '
+                    '--batch-size sequences')
 
 
 def main(args):
@@ -65,12 +72,26 @@ def main(args):
     # Dataset and DataLoader
     dataset = Seq2VecDataset(data_path=args.data_path, file_name=file_name)
     # dataloders
-    data_loader = DataLoader(dataset,
-                             batch_size=args.batch_size,
-                             shuffle=False,
-                             num_workers=args.workers,
-                             collate_fn=dataset.collate_fn,
-                             pin_memory=True)
+    if args.max_tokens is not None:
+        # sequences of similar length are batched together, the outputs are
+        # put back in dataset order below
+        batch_sampler = TokenBudgetBatchSampler(dataset.lengths,
+                                                args.max_tokens,
+                                                max_batch_size=args.batch_size,
+                                                special_tokens=0,
+                                                shuffle=False)
+        data_loader = DataLoader(dataset,
+                                 batch_sampler=batch_sampler,
+                                 num_workers=args.workers,
+                                 collate_fn=dataset.collate_fn,
+                                 pin_memory=True)
+    else:
+        data_loader = DataLoader(dataset,
+                                 batch_size=args.batch_size,
+                                 shuffle=False,
+                                 num_workers=args.workers,
+                                 collate_fn=dataset.collate_fn,
+                                 pin_memory=True)
     # model
     num_labels = dataset.num_classes
     model = Seq2VecEmbedder(model_dir=model_dir,
@@ -84,6 +105,9 @@ def main(args):
                                                   pool_mode=args.pool_mode,
                                                   logger=logger,
                                                   device=device)
+    if args.max_tokens is not None:
+        order = np.argsort(batch_order(batch_sampler))
+        embeddings, true_labels = embeddings[order], true_labels[order]
     print(embeddings.shape, true_labels.shape)
     df = pd.read_pickle(data_file)
     df['esm_embeddings'] = embeddings.tolist()
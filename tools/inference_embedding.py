@@ -11,8 +11,8 @@ import torch.nn as nn
 import torch.utils.data
 import torch.utils.data.distributed
 import yaml
-from torch.utils.data import DataLoader
 
+from deepfold.data.dataset_factory import get_batched_dataloader
 from deepfold.data.esm_dataset import EmbeddingDataset
 from deepfold.models.esm_model import MLP
 from deepfold.trainer.training import predict
@@ -81,11 +81,9 @@ def main(args):
         data_path=args.data_path,
         file_name='esm1b_t33_650M_UR50S_embeddings_mean_test.pkl')
     # dataloders
-    test_loader = DataLoader(test_dataset,
-                             batch_size=args.batch_size,
-                             shuffle=False,
-                             num_workers=args.workers,
-                             pin_memory=True)
+    test_loader = get_batched_dataloader(
+        test_dataset, torch.utils.data.SequentialSampler(test_dataset),
+        args.batch_size, args.workers)
 
     # model
     num_labels = 5874
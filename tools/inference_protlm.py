@@ -85,6 +85,7 @@ def main(args):
                              batch_size=args.batch_size,
                              shuffle=False,
                              num_workers=args.workers,
+                             collate_fn=test_dataset.collate_fn,
                              pin_memory=True)
 
     # model
@@ -87,6 +87,27 @@ parser.add_argument('-b',
                     type=int,
                     metavar='N',
                     help='mini-batch size (default: 256) per gpu')
+parser.add_argument('--bucket-batches',
+                    action='store_true',
+                    help='batch sequences of similar length together')
+parser.add_argument('--num-buckets',
+                    default=16,
+                    type=int,
+                    help='number of length buckets of --bucket-batches')
+parser.add_argument('--max-tokens',
+                    default=None,
+                    type=int,
+                    help='token budget of a batch, replaces --batch-size')
+parser.add_argument('--attention-cost',
+                    default=0.0,
+                    type=float,
+                    help='weight of the quadratic attention cost of a '
+                    'sequence in the --max-tokens budget')
+parser.add_argument('--no-tensor-iterator',
+                    dest='tensor_iterator',
+                    action='store_false',
+                    help='use DataLoaders for embedding datasets that fit '
+                    'in device memory')
 parser.add_argument('--lr',
                     '--learning-rate',
                     default=0.1,
@@ -318,7 +339,8 @@ def main(args):
                save_checkpoints=args.save_checkpoints and not args.evaluate,
                output_dir=args.output_dir,
                log_wandb=args.log_wandb,
-               log_interval=args.log_interval)
+               log_interval=args.log_interval,
+               sample_weighted=args.max_tokens is not None)
     print('Experiment ended')
 
 
@@ -11,8 +11,9 @@ import torch.optim as optim
 import torch.utils.data
 import torch.utils.data.distributed
 import yaml
-from torch.utils.data import DataLoader
 
+from deepfold.data.dataset_factory import (get_batched_dataloader,
+                                           get_tensor_iterators)
 from deepfold.data.esm_dataset import EmbeddingDataset
 from deepfold.models.esm_model import EsmTransformer
 from deepfold.trainer.training import train_loop
@@ -72,6 +73,11 @@ parser.add_argument('-j',
                     default=4,
                     metavar='N',
                     help='how many training processes to use (default: 1)')
+parser.add_argument('--no-tensor-iterator',
+                    dest='tensor_iterator',
+                    action='store_false',
+                    help='use DataLoaders for embeddings that fit in device '
+                    'memory')
 parser.add_argument('-b',
                     '--batch-size',
                     default=256,
@@ -236,33 +242,27 @@ def main(args):
     val_dataset = EmbeddingDataset(data_path=args.data_path,
                                    file_name='test_data.pkl')
 
-    if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(
-            train_dataset)
-        val_sampler = torch.utils.data.distributed.DistributedSampler(
-            val_dataset)
+    # embeddings that fit in device memory are batched there directly
+    loaders = None
+    if args.tensor_iterator:
+        loaders = get_tensor_iterators(args, train_dataset, val_dataset)
+    if loaders is not None:
+        train_loader, val_loader = loaders
     else:
-        train_sampler = torch.utils.data.RandomSampler(train_dataset)
-        val_sampler = torch.utils.data.RandomSampler(val_dataset)
-
-    # dataloders
-    train_loader = DataLoader(
-        train_dataset,
-        batch_size=args.batch_size,
-        shuffle=(train_sampler is None),
-        num_workers=args.workers,
-        sampler=train_sampler,
-        pin_memory=True,
-    )
-
-    val_loader = DataLoader(
-        val_dataset,
-        batch_size=args.batch_size,
-        shuffle=(val_sampler is None),
-        num_workers=args.workers,
-        sampler=val_sampler,
-        pin_memory=True,
-    )
+        if args.distributed:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(
+                train_dataset)
+            val_sampler = torch.utils.data.distributed.DistributedSampler(
+                val_dataset)
+        else:
+            train_sampler = torch.utils.data.RandomSampler(train_dataset)
+            val_sampler = torch.utils.data.RandomSampler(val_dataset)
+
+        # dataloders, whole batches are gathered from the embedding matrix
+        train_loader = get_batched_dataloader(train_dataset, train_sampler,
+                                              args.batch_size, args.workers)
+        val_loader = get_batched_dataloader(val_dataset, val_sampler,
+                                            args.batch_size, args.workers)
 
     # model
     num_labels = 5874
@@ -259,6 +259,7 @@ def main(args):
         batch_size=args.batch_size,
         shuffle=(train_sampler is None),
         num_workers=args.workers,
+        collate_fn=train_dataset.collate_fn,
         sampler=train_sampler,
         pin_memory=True,
     )
@@ -268,6 +269,7 @@ def main(args):
         batch_size=args.batch_size,
         shuffle=(val_sampler is None),
         num_workers=args.workers,
+        collate_fn=val_dataset.collate_fn,
         sampler=val_sampler,
         pin_memory=True,
     )
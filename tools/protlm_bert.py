@@ -111,6 +111,7 @@ if __name__ == '__main__':
         args=training_args,  # training arguments, defined above
         train_dataset=train_dataset,  # training dataset
         eval_dataset=val_dataset,  # evaluation dataset
+        data_collator=train_dataset.collate_fn,
         compute_metrics=compute_metrics,  # evaluation metrics
         callbacks=[EarlyStoppingCallback(early_stopping_patience=3)],
     )
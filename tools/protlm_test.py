@@ -40,7 +40,7 @@ if __name__ == '__main__':
     model = BertForMultiLabelSequenceClassification.from_pretrained(
         model_path, num_labels=num_classes)
     # Define test trainer
-    test_trainer = Trainer(model)
+    test_trainer = Trainer(model, data_collator=test_dataset.collate_fn)
     predictions = test_trainer.predict(test_dataset)
     results = compute_metrics(predictions)
     print(results)
@@ -0,0 +1,91 @@
+import argparse
+import logging
+import os
+
+from deepfold.utils.embedding_db import EmbeddingDB
+from deepfold.utils.whitening import (LinearProjection, fit_whitening,
+                                      randomized_pca)
+
+parser = argparse.ArgumentParser(
+    description='Whiten or reduce embedding dbs with a streamed projection')
+parser.add_argument('--fit_db',
+                    default=None,
+                    type=str,
+                    help='embedding db the projection is fitted on, e.g. '
+                    'the train embeddings')
+parser.add_argument('--projection',
+                    required=True,
+                    type=str,
+                    help='npz file of the projection, written when it is '
+                    'fitted and read otherwise')
+parser.add_argument('--method',
+                    default='whitening',
+                    choices=['whitening', 'pca'],
+                    help='whitening, or randomized PCA')
+parser.add_argument('--n_components',
+                    default=None,
+                    type=int,
+                    help='number of dimensions kept (required for pca)')
+parser.add_argument('--whiten',
+                    action='store_true',
+                    help='scale the PCA components to unit variance')
+parser.add_argument('--dbs',
+                    nargs='*',
+                    default=[],
+                    help='embedding dbs the projection is applied to')
+parser.add_argument('--suffix',
+                    default='_whitened',
+                    type=str,
+                    help='suffix of the output db directories')
+parser.add_argument('--dtype',
+                    default='float32',
+                    choices=['float32', 'float16'],
+                    help='storage dtype of the output embeddings')
+parser.add_argument('--chunk_size',
+                    default=65536,
+                    type=int,
+                    help='number of embeddings processed at once')
+parser.add_argument('--overwrite',
+                    action='store_true',
+                    help='overwrite existing output dbs')
+
+
+def main(args):
+    if args.fit_db is not None:
+        db = EmbeddingDB(args.fit_db)
+        if args.method == 'whitening':
+            projection = fit_whitening(db.matrix,
+                                       n_components=args.n_components,
+                                       chunk_size=args.chunk_size)
+        else:
+            if args.n_components is None:
+                parser.error('--n_components is required for pca')
+            projection = randomized_pca(db.matrix,
+                                        args.n_components,
+                                        chunk_size=args.chunk_size,
+                                        whiten=args.whiten)
+        projection.save(args.projection)
+        logger.info(f'{args.method} of {len(db)} embeddings of dim {db.dim} '
+                    f'to {projection.n_components} dims saved to '
+                    f'{args.projection}')
+    else:
+        projection = LinearProjection.load(args.projection)
+
+    for db_dir in args.dbs:
+        out_dir = os.path.normpath(db_dir) + args.suffix
+        out = projection.transform_db(EmbeddingDB(db_dir),
+                                      out_dir,
+                                      dtype=args.dtype,
+                                      chunk_size=args.chunk_size,
+                                      overwrite=args.overwrite)
+        logger.info(f'Projected {len(out)} embeddings of {db_dir} to '
+                    f'{out_dir}')
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger('')
+    streamhandler = logging.StreamHandler()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(streamhandler)
+    args = parser.parse_args()
+    main(args)